@@ -48,10 +48,25 @@ def insert_many(self, data, resort=False, reindex=False, restat=False, commit=Tr
     )
 
 
+# Functions called with the name of the table before each write through it (see seminars/dbpool.py and seminars/pagecache.py)
+write_hooks = []
+
+
+def records_write(func, tname):
+    def call(*args, **kwargs):
+        for hook in write_hooks:
+            hook(tname)
+        return func(*args, **kwargs)
+
+    return call
+
+
 for tname in db.tablenames:
     db[tname].log_db_change = nothing
     # db[tname].add_column = are_you_REALLY_sure(db[tname].add_column)
     db[tname].drop_column = are_you_REALLY_sure(db[tname].drop_column)
-    db[tname].update = update.__get__(db[tname])
+    db[tname].update = records_write(update.__get__(db[tname]), tname)
     db[tname].count = count.__get__(db[tname])
-    db[tname].insert_many = insert_many.__get__(db[tname])
+    db[tname].insert_many = records_write(insert_many.__get__(db[tname]), tname)
+    db[tname].upsert = records_write(db[tname].upsert, tname)
+    db[tname].delete = records_write(db[tname].delete, tname)
@@ -35,6 +35,21 @@ def search_series_post():
     assert url
     #FIXME: not clear what is supposed to happen here, if anything...
 
+def changes():
+    from requests import get
+    # Store the cursor between runs; an empty cursor starts from the beginning
+    cursor = ""
+    complete = False
+    while not complete:
+        r = get("https://researchseminars.org/api/0/changes?since=%s" % cursor)
+        if r.status_code != 200:
+            break
+        J = r.json()
+        for talk in J["talks"]:
+            print("%s/%s %s" % (talk["series_id"], talk["series_ctr"], talk["action"]))
+        cursor = J["cursor"]
+        complete = J["complete"]
+
 def authorization():
     # We suggest keeping your api token in a separate file and adding it to your .gitignore
     # so that you don't accidentlly commit it to your repository
@@ -138,6 +153,24 @@ def create_talk():
         print("Creation failed")
         print(J)
 
+def create_talks():
+    from requests import post
+    url = "https://researchseminars.org/api/0/save/talks/"
+    payload = {"series_id": "test_conf",
+               "talks": [{"speaker": "Example Speaker",
+                          "start_time": "2020-09-01 15:00",
+                          "end_time": "2020-09-01 16:00"},
+                         {"series_ctr": 3,
+                          "title": "A new title for an existing talk"}]}
+    r = post(url, json=payload, headers={"authorization": authorization()})
+    J = r.json()
+    if r.status_code == 200:
+        for result in J["results"]:
+            print(result["code"], result.get("series_ctr"), result["description"])
+    else:
+        print("Saving failed")
+        print(J)
+
 def topics():
     from requests import get
     url = "https://researchseminars.org/api/0/topics"
@@ -4,8 +4,8 @@ from seminars import db
 from seminars.app import app
 from seminars.api import api_page
 from seminars.seminar import WebSeminar, seminars_lookup, seminars_search
-from seminars.talk import WebTalk, talks_lookup, talks_search
-from seminars.users.pwdmanager import SeminarsUser, ilike_query
+from seminars.talk import WebTalk, talks_lookup, talks_max, talks_search, save_talks
+from seminars.users.pwdmanager import SeminarsUser, ilike_query, userdb
 from seminars.users.main import creator_required
 from seminars.utils import (
     allowed_shortname,
@@ -13,17 +13,23 @@ from seminars.utils import (
     process_user_input,
     sanitized_table,
     APIError,
+    changes_distinct,
     MAX_SLOTS,
     MAX_ORGANIZERS,
 )
 from seminars.create.main import process_save_seminar, process_save_talk
-from functools import wraps
+from seminars.institution import institutions_json
+from seminars.topic import topic_dag
+from seminars.cache import LRUCache
+from seminars.localstore import TokenBucket
+from functools import lru_cache, wraps
+from math import ceil
 
+import hashlib
+import hmac
 import inspect
 import json
-from pygments import highlight
-from pygments.lexers import PythonLexer
-from pygments.formatters import HtmlFormatter
+import time
 
 def format_error(msg, *args):
     return msg % args
@@ -76,23 +82,37 @@ def _get_col(col, raw_data, activity):
 def handle_api_error(err):
     response = jsonify(err.error)
     response.status_code = err.status
+    if "retry_after" in err.error:
+        response.headers["Retry-After"] = str(int(ceil(err.error["retry_after"])))
     return response
 
+@lru_cache(maxsize=None)
+def _highlight_css():
+    from pygments.formatters import HtmlFormatter
+    css = HtmlFormatter().get_style_defs('.highlight')
+    return css, hashlib.md5(css.encode()).hexdigest()
+
 @api_page.route("/pyhighlight.css")
 def pyhighcss():
-    response = make_response(HtmlFormatter().get_style_defs('.highlight'))
+    css, etag = _highlight_css()
+    response = make_response(css)
     response.headers["Content-type"] = "text/css"
     if current_app.debug:
         response.headers["Cache-Control"] = "no-cache, no-store"
     else:
-        response.headers["Cache-Control"] = "public, max-age=600"
+        response.headers["Cache-Control"] = "public, max-age=86400"
+        response.set_etag(etag)
+        response.make_conditional(request)
     return response
 
-@api_page.route("/")
-def help():
-    code_examples = {}
+@lru_cache(maxsize=None)
+def _help_data():
+    # The highlighted examples and column lists only change when the code does
     from . import example
     from types import FunctionType
+    from pygments import highlight
+    from pygments.lexers import PythonLexer
+    from pygments.formatters import HtmlFormatter
     code_examples = {name: highlight(inspect.getsource(func), PythonLexer(), HtmlFormatter())
                      for (name, func) in example.__dict__.items()
                      if isinstance(func, FunctionType)}
@@ -108,14 +128,25 @@ def help():
             "talks_other": to}
     types = dict(sems.col_type)
     types.update(talks.col_type)
-    return render_template(
+    return code_examples, cols, types
+
+@api_page.route("/")
+def help():
+    code_examples, cols, types = _help_data()
+    response = make_response(render_template(
         "api_help.html",
         title="API",
         section="Info",
         code_examples=code_examples,
         cols=cols,
         types=types,
-    )
+    ))
+    if current_app.debug or current_user.is_authenticated:
+        # The page includes the user's API token
+        response.headers["Cache-Control"] = "private, no-cache"
+    else:
+        response.headers["Cache-Control"] = "private, max-age=600"
+    return response
 
 # Unlike most routes in this module, this one requires a live user to be logged in
 @api_page.route("/review/", methods=["POST"])
@@ -141,23 +172,36 @@ def review_api():
 
     return redirect(url_for("create.index"))
 
+def _static_json(body, etag, max_age):
+    # Clients polling these routes get a 304 without the body when nothing has changed
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, max-age=%s" % max_age
+    return response.make_conditional(request)
+
+@lru_cache(maxsize=None)
+def _topics_json():
+    # The topic DAG is loaded once per process, so this never changes
+    topics = {topic.id: {"name": topic.name, "children": [child.id for child in topic.children]}
+              for topic in topic_dag.by_id.values()}
+    body = json.dumps(topics, sort_keys=True)
+    return body, hashlib.sha1(body.encode()).hexdigest()
+
 # This static route allows access to the topic graph
 @api_page.route("/<int:version>/topics")
 def topics(version=0):
     if version != 0:
         raise version_error(version)
-    topics = {rec["topic_id"]: {"name": rec["name"], "children": rec["children"]}
-              for rec in db.new_topics.search()}
-    return jsonify(topics)
+    body, etag = _topics_json()
+    return _static_json(body, etag, 86400)
 
 # This static route allows access to a list of all institutions
 @api_page.route("/<int:version>/institutions")
 def institutions(version=0):
     if version != 0:
         raise version_error(version)
-    institutions = {rec["shortname"]: {key: rec[key] for key in ["name", "city", "timezone", "type", "homepage"]}
-                    for rec in db.institutions.search()}
-    return jsonify(institutions)
+    body, etag = institutions_json()
+    return _static_json(body, etag, 3600)
 
 @api_page.route("/<int:version>/lookup/series", methods=["GET", "POST"])
 def lookup_series(version=0):
@@ -246,19 +290,84 @@ def search_talks(version=0):
         projection = 1
         raw_data = {}
     query["hidden"] = False
-    visible_series = set(seminars_search({"visibility": 2}, "shortname"))
-    # TODO: Need to check visibility on the seminar
     try:
-        results = talks_search(query, projection, objects=False, **raw_data)
+        results = list(talks_search(query, projection, objects=False, public_series=True, **raw_data))
     except Exception as err:
         raise APIError({"code": "search_error",
                         "description": "error in executing search",
                         "error": str(err)})
-    results = [rec for rec in results if rec["seminar_id"] in visible_series]
     ans = {"code": "success", "results": results}
     callback = raw_data.get("callback", False)
     return str_jsonify(ans, callback)
 
+MAX_CHANGES = 1000
+
+def _parse_cursor(cursor):
+    # Cursors have the form SERIESID-TALKID, where these are the largest row ids already returned
+    if not cursor:
+        return 0, 0
+    try:
+        series_since, talks_since = [int(x) for x in cursor.split("-")]
+        if series_since < 0 or talks_since < 0:
+            raise ValueError
+    except (ValueError, AttributeError, TypeError):
+        raise APIError({"code": "invalid_cursor",
+                        "description": "Cursor %s not valid; use the cursor returned by a previous call" % cursor})
+    return series_since, talks_since
+
+@api_page.route("/<int:version>/changes", methods=["GET", "POST"])
+def changes(version=0):
+    # The change feed is based on row ids: every save creates a new row, and deletions and revivals
+    # add a new version recording the change.  Talks of a deleted series are not listed separately.
+    if version != 0:
+        raise version_error(version)
+    if request.method == "POST":
+        raw_data = get_request_json()
+        if not isinstance(raw_data, dict):
+            raise APIError({"code": "invalid_json",
+                            "description": "request must contain a json dictionary"})
+    else:
+        raw_data = dict(request.args)
+    series_since, talks_since = _parse_cursor(raw_data.get("since"))
+    try:
+        limit = int(raw_data.get("limit", MAX_CHANGES))
+    except (ValueError, TypeError):
+        raise APIError({"code": "invalid_limit",
+                        "description": "limit must be an integer"})
+    limit = max(1, min(limit, MAX_CHANGES))
+
+    def action(rec, public):
+        if rec["deleted"] or not rec["display"] or not public:
+            return "deleted"
+        return "created" if rec["created"] else "updated"
+
+    series = []
+    for rec in changes_distinct(sanitized_table("seminars"), ["shortname"], series_since, limit):
+        series_since = rec["id"]
+        item = {"series_id": rec["shortname"], "action": action(rec, rec["visibility"] == 2)}
+        if item["action"] != "deleted":
+            item["properties"] = {col: rec[col] for col in sanitized_table("seminars").search_cols}
+        series.append(item)
+    talks = []
+    talk_recs = changes_distinct(sanitized_table("talks"), ["seminar_id", "seminar_ctr"], talks_since, limit, ["hidden"])
+    public = set(seminars_search({"shortname": {"$in": list(set(rec["seminar_id"] for rec in talk_recs))},
+                                  "visibility": 2}, "shortname"))
+    for rec in talk_recs:
+        talks_since = rec["id"]
+        item = {"series_id": rec["seminar_id"],
+                "series_ctr": rec["seminar_ctr"],
+                "action": action(rec, not rec["hidden"] and rec["seminar_id"] in public)}
+        if item["action"] != "deleted":
+            item["properties"] = {col: rec[col] for col in sanitized_table("talks").search_cols}
+        talks.append(item)
+    ans = {"code": "success",
+           "series": series,
+           "talks": talks,
+           "cursor": "%s-%s" % (series_since, talks_since),
+           "complete": len(series) < limit and len(talks) < limit}
+    callback = raw_data.get("callback", False)
+    return str_jsonify(ans, callback)
+
 def api_auth_required(fn):
     # Note that this wrapper will pass the user as a keyword argument to the wrapped function
     @wraps(fn)
@@ -272,18 +381,56 @@ def api_auth_required(fn):
             raise APIError({"code": "invalid_header",
                             "description": "Authorization header must have length 2"}, 401)
         email, token = pieces
-        user = SeminarsUser(email=email)
-        if user.id is None:
-            raise APIError({"code": "missing_user",
-                            "description": "User %s not found" % email}, 401)
-        if token == user.api_token:
-            kwds["user"] = user
-            return fn(*args, **kwds)
-        else:
-            raise APIError({"code": "invalid_token",
-                            "description": "Token not valid"}, 401)
+        # Failed attempts are limited by client address, so that guessing tokens is slow
+        # without letting anyone use up the quota of someone whose email they know
+        wait = api_auth_failures.wait(request.remote_addr)
+        if wait:
+            raise APIError({"code": "rate_limited",
+                            "description": "Too many failed authentication attempts; try again in %.1f seconds" % wait,
+                            "retry_after": wait}, 429)
+        try:
+            user = _api_user(email, token)
+        except APIError:
+            api_auth_failures.take(request.remote_addr)
+            raise
+        wait = api_rate_limiter.take(user.id)
+        if wait:
+            raise APIError({"code": "rate_limited",
+                            "description": "Too many requests; try again in %.1f seconds" % wait,
+                            "retry_after": wait}, 429)
+        kwds["user"] = user
+        return fn(*args, **kwds)
     return inner
 
+# The users authenticated through the API, keyed by email and a digest of the token, as pairs
+# (the columns in SeminarsUser.auth_properties, time authenticated)
+api_users = LRUCache("api_users", maxsize=1024, ttl=300)
+# Each API user may make bursts of up to 60 calls, and one call per second on average
+api_rate_limiter = TokenBucket("api_rate_limits", capacity=60, rate=1)
+# Each client address may fail to authenticate 10 times in a row, and then once a minute
+api_auth_failures = TokenBucket("api_auth_failures", capacity=10, rate=1 / 60)
+
+def _api_user(email, token):
+    # Cached records are dropped whenever the user's row changes (see userdb.auth_changed),
+    # so that a new token, email or rights apply at once
+    key = (email.lower(), hashlib.sha256(token.encode()).hexdigest())
+    cached = api_users.get(key)
+    if cached is not None:
+        record, authenticated = cached
+        if userdb.auth_changed_at(record["id"]) < authenticated:
+            return SeminarsUser(record=record)
+        api_users.pop(key)
+    authenticated = time.time()
+    user = SeminarsUser(email=email)
+    if user.id is None:
+        raise APIError({"code": "missing_user",
+                        "description": "User %s not found" % email}, 401)
+    if not hmac.compare_digest(token.encode(), user.api_token.encode()):
+        raise APIError({"code": "invalid_token",
+                        "description": "Token not valid"}, 401)
+    api_users.set(key, (user.auth_record(), authenticated))
+    return user
+
 @api_page.route("/<int:version>/test")
 @api_auth_required
 def test_api(version, user):
@@ -471,3 +618,112 @@ def save_talk(version=0, user=None):
                             "series_ctr": new_version.seminar_ctr, # FIXME seminar_ctr -> series_ctr
                             "description": "series successfully %s" % edittype})
     return response
+
+MAX_BULK_TALKS = 200
+
+@api_page.route("/<int:version>/save/talks/", methods=["POST"])
+@api_auth_required
+def bulk_save_talks(version=0, user=None):
+    if version != 0:
+        raise version_error(version)
+    raw_data = get_request_json()
+    if not isinstance(raw_data, dict):
+        raise APIError({"code": "invalid_json",
+                        "description": "request must contain a json dictionary"})
+    series_id = _get_col("series_id", raw_data, "saving talks")
+    talk_list = _get_col("talks", raw_data, "saving talks")
+    if not isinstance(talk_list, list):
+        raise APIError({"code": "invalid_talks",
+                        "description": "talks must be a list"})
+    if len(talk_list) > MAX_BULK_TALKS:
+        raise APIError({"code": "too_many_talks",
+                        "description": "You can save at most %s talks at once" % MAX_BULK_TALKS})
+    series = seminars_lookup(series_id)
+    if series is None:
+        raise APIError({"code": "no_series",
+                        "description": "The series %s does not exist (or is deleted)" % series_id})
+    if not series.user_can_edit(user):
+        raise APIError({"code": "unauthorized_user",
+                        "description": "You do not have permission to edit %s." % series_id}, 401)
+    # Load all of the talks being edited at once
+    ctrs = [item.get("series_ctr") for item in talk_list if isinstance(item, dict)]
+    ctrs = [ctr for ctr in ctrs if isinstance(ctr, int) and not isinstance(ctr, bool)]
+    existing = {}
+    if ctrs:
+        for talk in talks_search({"seminar_id": series_id, "seminar_ctr": {"$in": ctrs}}, seminar_dict={series_id: series}):
+            existing[talk.seminar_ctr] = talk
+    # seminar_ctr values for new talks are allocated sequentially after the current maximum
+    curmax = None
+    seen = set()
+    results = []
+    to_save = []
+    for item in talk_list:
+        if not isinstance(item, dict):
+            results.append({"code": "invalid_talk",
+                            "description": "Each talk must be a dictionary"})
+            continue
+        raw_item = dict(item)
+        raw_item.pop("series_id", None)
+        series_ctr = raw_item.pop("series_ctr", None)
+        raw_item["seminar_id"] = series_id
+        raw_item["seminar_ctr"] = series_ctr
+        if series_ctr is None:
+            talk = WebTalk(series_id, seminar=series, editing=True)
+            if curmax is None:
+                curmax = talks_max("seminar_ctr", {"seminar_id": series_id}, include_deleted=True) or 0
+        elif not isinstance(series_ctr, int) or isinstance(series_ctr, bool):
+            results.append({"code": "invalid_series_ctr",
+                            "description": "series_ctr must be an integer"})
+            continue
+        elif series_ctr in seen:
+            results.append({"code": "duplicate_talk",
+                            "series_ctr": series_ctr,
+                            "description": "The talk %s/%s appears more than once" % (series_id, series_ctr)})
+            continue
+        else:
+            seen.add(series_ctr)
+            talk = existing.get(series_ctr)
+            if talk is None:
+                results.append({"code": "no_talk",
+                                "series_ctr": series_ctr,
+                                "description": "The talk %s/%s does not exist (or is deleted)" % (series_id, series_ctr)})
+                continue
+        warnings = []
+        def warn(msg, *args):
+            warnings.append(msg % args)
+        new_version, errmsgs = process_save_talk(talk, raw_item, warn, format_error, format_input_error, incremental_update=True,
+                                                 seminar_ctr=(curmax + 1 if talk.new else None))
+        if new_version is None:
+            results.append({"code": "processing_error",
+                            "series_ctr": series_ctr,
+                            "description": "Error in processing input",
+                            "errors": errmsgs})
+            continue
+        if not talk.new and new_version == talk:
+            results.append({"code": "no_changes",
+                            "series_ctr": series_ctr,
+                            "description": "No changes detected"})
+            continue
+        if talk.new:
+            curmax += 1
+        # Talks saved by the API are not displayed until user approves
+        new_version.display = False
+        new_version.by_api = True
+        to_save.append(new_version)
+        edittype = "created" if talk.new else "edited"
+        if warnings:
+            results.append({"code": "warning",
+                            "series_ctr": new_version.seminar_ctr,
+                            "description": "talk successfully %s, but..." % edittype,
+                            "warnings": warnings})
+        else:
+            results.append({"code": "success",
+                            "series_ctr": new_version.seminar_ctr,
+                            "description": "talk successfully %s" % edittype})
+    save_talks(to_save, user)
+    # Talks without changes are neither saved nor failures
+    unchanged = sum(1 for result in results if result["code"] == "no_changes")
+    failed = len(talk_list) - len(to_save) - unchanged
+    return jsonify({"code": "success" if failed == 0 else "partial_success",
+                    "description": "%s talks saved, %s unchanged, %s not saved" % (len(to_save), unchanged, failed),
+                    "results": results})
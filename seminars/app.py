@@ -14,10 +14,14 @@ from flask import (
     current_app,
     abort,
 )
-from flask_mail import Mail, Message
+from flask_mail import Mail
 from flask_cors import CORS
 
 from lmfdb.logger import logger_file_handler
+from seminars.assets import init_app as init_assets, generated_asset, generated_content
+from seminars.dbpool import init_app as init_db_pool
+from seminars.pagecache import init_app as init_page_cache
+from seminars.sqlstats import init_app as init_sqlstats
 from seminars.utils import (
     domain,
     top_menu,
@@ -38,14 +42,16 @@ SEMINARS_VERSION = "Seminars Release 0.1"
 ############################
 
 app = Flask(__name__, static_url_path="", static_folder="static",)
-# disable cache temporarily
-app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+# Pages refer to static files through fingerprinted urls, which are cached for good (see
+# seminars/assets.py); requests for the plain urls are cached for an hour and then revalidated
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
 
 mail_settings = {
-    "MAIL_SERVER": "heaviside.mit.edu",
-    "MAIL_PORT": 465,
+    # The environment variables can be used to point at a local SMTP server for testing (see seminars/mailqueue.py)
+    "MAIL_SERVER": os.environ.get("SEMINARS_MAIL_SERVER", "heaviside.mit.edu"),
+    "MAIL_PORT": int(os.environ.get("SEMINARS_MAIL_PORT", 465)),
     "MAIL_USE_TLS": False,
-    "MAIL_USE_SSL": True,
+    "MAIL_USE_SSL": os.environ.get("SEMINARS_MAIL_SSL", "1") == "1",
     "MAIL_USERNAME": "researchseminarsnoreply",
     "MAIL_PASSWORD": os.environ.get("EMAIL_PASSWORD_MIT", ""),
 }
@@ -53,9 +59,19 @@ mail_settings = {
 app.config.update(mail_settings)
 mail = Mail(app)
 
+# Each request uses a connection from a per-process pool (see seminars/dbpool.py)
+init_db_pool(app)
+# Count and time the queries made by each request (see seminars/sqlstats.py)
+init_sqlstats(app)
+# Fingerprinted urls for static files (see seminars/assets.py)
+init_assets(app)
+# Invalidate the pages cached for anonymous visitors when what they show changes (see seminars/pagecache.py)
+init_page_cache(app)
+
 
 # Enable cross origin for fonts
-CORS(app, resources={r"/fontawesome/webfonts/*": {"origins": "*"}, r"/api/*": {"origins": "*"}})
+CORS(app, resources={r"/fontawesome/webfonts/*": {"origins": "*"}, r"/assets/\w+/fontawesome/webfonts/*": {"origins": "*"},
+                     r"/api/*": {"origins": "*"}})
 
 ############################
 # App attribute functions  #
@@ -339,9 +355,17 @@ def add_colors():
     return {"color": Slate().dict()}
 
 
+@generated_asset("style.css", "text/css", "css")
+def render_css():
+    from .color import Slate
+
+    # Only depends on the colors and the other assets, so it is rendered once (see seminars/assets.py)
+    return current_app.jinja_env.get_template("style.css").render(color=Slate().dict())
+
+
 @app.route("/style.css")
 def css():
-    response = make_response(render_template("style.css"))
+    response = make_response(generated_content("style.css"))
     response.headers["Content-type"] = "text/css"
     # don't cache css file, if in debug mode.
     if current_app.debug:
@@ -357,20 +381,12 @@ def css():
 
 
 def send_email(to, subject, message):
-    from html2text import html2text
+    # The email is queued and sent by a background thread, so that we don't wait on the mail server
+    from .mailqueue import enqueue
 
     sender = "researchseminarsnoreply@math.mit.edu"
-    app.logger.info("%s sending email from %s to %s..." % (timestamp(), sender, to))
-    mail.send(
-        Message(
-            subject=subject,
-            html=message,
-            body=html2text(message),  # a plain text version of our email
-            sender=sender,
-            recipients=[to],
-        )
-    )
-    app.logger.info("%s sending email from %s to %s..." % (timestamp(), sender, to))
+    app.logger.info("%s queueing email from %s to %s..." % (timestamp(), sender, to))
+    enqueue(to, subject, message, sender)
 
 
 def git_infos():
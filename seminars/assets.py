@@ -0,0 +1,128 @@
+"""
+Static assets with fingerprinted urls, which browsers can keep for good.
+
+``asset_url(filename)`` (available in templates) gives the url of a file in the static folder, or
+of a generated asset such as style.css, with a hash of its contents in the path::
+
+    /assets/<hash>/<filename>
+
+Changing a file changes its url, so these responses are sent with a one-year ``immutable``
+``Cache-Control`` header and repeat visitors don't even ask whether they have changed.  Relative
+urls in stylesheets (such as the fonts used by fontawesome) resolve under the same prefix, with a
+hash that isn't theirs: those responses are cached for a day, and then revalidated using their ETag.
+
+The hashes of the static files (the manifest) are computed once per process, since the files only
+change with a deploy, which restarts the workers.  Generated assets are rendered once and served
+from memory.  In debug mode ``asset_url`` gives the usual urls and nothing is kept, so that edits
+show up right away.
+"""
+import hashlib
+import os
+from functools import lru_cache
+from flask import current_app, make_response, request, send_from_directory, url_for
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+# For files requested with a hash other than their own
+RELATIVE_MAX_AGE = 86400
+
+# filename: (function returning the content, mimetype, endpoint serving it without a hash)
+_generators = {}
+
+
+def generated_asset(filename, mimetype, endpoint):
+    """
+    A decorator registering a function that renders an asset (without arguments, in an app context).
+    """
+    def register(func):
+        _generators[filename] = (func, mimetype, endpoint)
+        return func
+    return register
+
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+@lru_cache(maxsize=None)
+def _generated(filename):
+    content = _generators[filename][0]()
+    return content, _digest(content.encode())
+
+
+def generated_content(filename):
+    """
+    The content of a generated asset, rendered once (or on each call in debug mode).
+    """
+    if current_app.debug:
+        return _generators[filename][0]()
+    return _generated(filename)[0]
+
+
+@lru_cache(maxsize=None)
+def _manifest(folder):
+    ans = {}
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, "rb") as F:
+                ans[os.path.relpath(path, folder).replace(os.sep, "/")] = _digest(F.read())
+    return ans
+
+
+def manifest():
+    """
+    A dictionary giving the hash of each file in the static folder and of each generated asset,
+    by path relative to the static folder.
+    """
+    ans = dict(_manifest(current_app.static_folder))
+    ans.update((filename, _generated(filename)[1]) for filename in _generators)
+    return ans
+
+
+def fingerprint(filename):
+    """
+    The hash of a static file or generated asset, or None if there is no such asset.
+    """
+    if filename in _generators:
+        return _generated(filename)[1]
+    return _manifest(current_app.static_folder).get(filename)
+
+
+def asset_url(filename, **kwds):
+    """
+    The url of a static file or generated asset, including its hash.
+
+    Keyword arguments (such as ``_external``) are passed on to ``url_for``.
+    """
+    if not current_app.debug:
+        fp = fingerprint(filename)
+        if fp is not None:
+            return url_for("asset", fingerprint=fp, filename=filename, **kwds)
+    if filename in _generators:
+        return url_for(_generators[filename][2], **kwds)
+    return url_for("static", filename=filename, **kwds)
+
+
+def serve_asset(fingerprint, filename):
+    if filename in _generators:
+        content, fp = _generated(filename)
+        response = make_response(content)
+        response.headers["Content-Type"] = _generators[filename][1]
+        response.set_etag(fp)
+        response.make_conditional(request)
+    else:
+        response = send_from_directory(current_app.static_folder, filename, cache_timeout=RELATIVE_MAX_AGE)
+        fp = _manifest(current_app.static_folder).get(filename)
+    if fp == fingerprint:
+        response.headers["Cache-Control"] = IMMUTABLE
+    else:
+        response.headers["Cache-Control"] = "public, max-age=%s" % RELATIVE_MAX_AGE
+    return response
+
+
+def init_app(app):
+    """
+    Serves fingerprinted assets for ``app``, and makes ``asset_url`` available in its templates.
+    """
+    app.add_url_rule("/assets/<fingerprint>/<path:filename>", "asset", serve_asset)
+    app.add_template_global(asset_url)
@@ -0,0 +1,18 @@
+"""
+Benchmarks against a synthetic database.
+
+Typical use, against a local Postgres configured in config.ini::
+
+    python -m seminars.benchmark generate /tmp/benchdb --scale 2
+    python -m seminars.benchmark load /tmp/benchdb
+    python -m seminars.benchmark run --output before.json
+    # ... make changes ...
+    python -m seminars.benchmark run --output after.json
+    python -m seminars.benchmark compare before.json after.json
+
+The ``selecters`` command times the main search functions directly instead of whole pages
+(see ``seminars.indexes``), and the ``startup`` command times starting new worker processes.
+
+Loading replaces the contents of the seminars, talks, users, institutions, seminar_organizers and
+new_topics tables, so never point it at a database you care about.
+"""
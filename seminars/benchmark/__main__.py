@@ -0,0 +1,98 @@
+import argparse
+import json
+import sys
+
+
+def positive_int(value):
+    # Timing reports summarize at least one run
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m seminars.benchmark", description="Benchmarks against a synthetic database")
+    subparsers = parser.add_subparsers(dest="command")
+
+    gen = subparsers.add_parser("generate", help="write a synthetic database to a folder")
+    gen.add_argument("folder")
+    gen.add_argument("--scale", type=float, default=1.0, help="size of the database (default 1: 500 series and 2000 users)")
+    gen.add_argument("--seed", type=int, default=0)
+    gen.add_argument("--series-versions", type=float, default=4, help="average number of versions of each series")
+    gen.add_argument("--talk-versions", type=float, default=3, help="average number of versions of each talk")
+    gen.add_argument("--talks-per-series", type=float, default=30, help="average number of talks in each series")
+
+    load = subparsers.add_parser("load", help="replace the tables in the local database by a generated database")
+    load.add_argument("folder")
+    load.add_argument("--force", action="store_true", help="allow loading into a database that isn't on this machine")
+
+    run = subparsers.add_parser("run", help="time the scenarios, writing a json report")
+    run.add_argument("--repeat", type=positive_int, default=20)
+    run.add_argument("--warmup", type=int, default=3)
+    run.add_argument("--only", action="append", help="only run this scenario (can be repeated)")
+    run.add_argument("--page-cache", action="store_true", help="serve pages from the page cache, rather than rendering each")
+    run.add_argument("--output", help="file for the report (default: standard output)")
+
+    sel = subparsers.add_parser("selecters", help="time the main search functions directly, writing a json report")
+    sel.add_argument("--repeat", type=positive_int, default=20)
+    sel.add_argument("--warmup", type=int, default=3)
+    sel.add_argument("--only", action="append", help="only time this selecter (can be repeated)")
+    sel.add_argument("--output", help="file for the report (default: standard output)")
+
+    start = subparsers.add_parser("startup", help="time starting new worker processes, writing a json report")
+    start.add_argument("--repeat", type=positive_int, default=5, help="number of processes started for each kind of run")
+    start.add_argument("--forks", type=int, default=5, help="number of workers forked from each loaded process")
+    start.add_argument("--output", help="file for the report (default: standard output)")
+
+    cmp = subparsers.add_parser("compare", help="compare two reports, exiting with status 1 if there are regressions")
+    cmp.add_argument("old")
+    cmp.add_argument("new")
+    cmp.add_argument("--threshold", type=float, default=0.1, help="fractional slowdown counted as a regression (default 0.1)")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        from .generate import generate
+
+        counts = generate(args.folder, scale=args.scale, seed=args.seed, series_versions=args.series_versions,
+                          talk_versions=args.talk_versions, talks_per_series=args.talks_per_series)
+        for tablename, count in counts.items():
+            print("%s: %s rows" % (tablename, count))
+    elif args.command == "load":
+        from .generate import load
+
+        load(args.folder, force=args.force)
+    elif args.command in ["run", "selecters", "startup"]:
+        if args.command == "startup":
+            from .startup import run
+
+            report = run(repeat=args.repeat, forks=args.forks)
+        else:
+            if args.command == "run":
+                from .scenarios import run
+
+                report = run(repeat=args.repeat, warmup=args.warmup, only=args.only, page_cache=args.page_cache)
+            else:
+                from .selecters import run
+
+                report = run(repeat=args.repeat, warmup=args.warmup, only=args.only)
+        report = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, "w") as F:
+                F.write(report)
+        else:
+            print(report)
+    elif args.command == "compare":
+        from .scenarios import compare, load_report
+
+        lines, regressions = compare(load_report(args.old), load_report(args.new), args.threshold)
+        print("\n".join(lines))
+        if regressions:
+            print("\nRegressions: " + ", ".join(regressions))
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+Synthetic databases for benchmarking.
+
+``generate`` writes one file per table in the format produced by ``seminars.importing.sanitize``
+(a line of column names, a line of column types, a blank line and then tab separated rows), which
+``load`` then copies into the local database.  The columns are taken from the tables in the
+database, so the files always match the current schema; columns that we don't know how to fill
+are left null.
+
+The data is random but determined by the seed: series with several versions each, talks with deep
+version histories (as produced by repeated edits), users subscribed to series and talks, organizers
+and a tree of topics.
+"""
+import json
+import os
+import random
+from datetime import datetime, timedelta, date
+import pytz
+from seminars import db
+
+# The number of rows at scale 1
+SIZES = {"institutions": 100, "users": 2000, "seminars": 500, "subjects": 8}
+# The tables written by generate, in the order they are loaded
+TABLES = ["new_topics", "institutions", "users", "seminars", "talks", "seminar_organizers"]
+TIMEZONES = ["US/Eastern", "US/Pacific", "Europe/London", "Europe/Paris", "Asia/Tokyo", "Australia/Sydney", "America/Sao_Paulo", "Asia/Kolkata"]
+WORDS = """
+algebraic analytic arithmetic automorphic boundary category cohomology conjecture curves descent dynamics
+elliptic equations forms fields flows galois geometry groups harmonic homotopy invariants lattices
+manifolds measures moduli motives numbers operators periods points primes quantum random representations
+rigidity schemes sheaves singularities spaces spectral stacks structures surfaces symmetry theory
+topology varieties waves zeta
+""".split()
+NAMES = """
+Ada Alan Bernhard Carl David Emmy Evariste Felix Georg Henri Hermann Isaac Julia Karen Leonhard Maryam
+Niels Olga Pierre Sofia Srinivasa Terence Wei Yuri Zhou
+""".split()
+SURNAMES = """
+Abel Banach Cartan Dedekind Euler Fermat Gauss Hilbert Iwasawa Jacobi Klein Lagrange Mirzakhani Noether
+Ostrowski Poincare Ramanujan Serre Tate Uhlenbeck Weil Yau Zariski
+""".split()
+
+
+def _sentence(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize()
+
+
+def _person(rng):
+    return "%s %s" % (rng.choice(NAMES), rng.choice(SURNAMES))
+
+
+def _versions(rng, mean):
+    # Geometrically distributed number of versions, at least 1
+    n = 1
+    while rng.random() > 1 / mean:
+        n += 1
+    return n
+
+
+def _copy_value(value):
+    # Formats a value for COPY, as in the files written by copy_to
+    if value is None:
+        return r"\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    elif isinstance(value, dict):
+        value = json.dumps(value)
+    elif isinstance(value, list):
+        value = "{%s}" % ",".join(
+            "NULL" if x is None else '"%s"' % str(x).replace("\\", "\\\\").replace('"', '\\"') for x in value
+        )
+    else:
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _write(folder, tablename, rows):
+    table = db[tablename]
+    cols = ["id"] + table.search_cols
+    types = ["bigint"] + [table.col_type[col] for col in table.search_cols]
+    with open(os.path.join(folder, tablename + ".txt"), "w") as F:
+        F.write("\t".join(cols) + "\n" + "\t".join(types) + "\n\n")
+        for i, row in enumerate(rows, 1):
+            row["id"] = i
+            F.write("\t".join(_copy_value(row.get(col)) for col in cols) + "\n")
+    return len(rows)
+
+
+def _topics(rng, scale):
+    rows = []
+    for i in range(max(1, int(SIZES["subjects"] * min(scale, 1)))):
+        subject = "bench%s" % i
+        children = ["%s_%s" % (subject, j) for j in range(6)]
+        rows.append({"topic_id": subject, "name": _sentence(rng, 1), "children": children, "subject": subject})
+        for child in children:
+            rows.append({"topic_id": child, "name": _sentence(rng, 2), "children": [], "subject": subject})
+    return rows
+
+
+def _institutions(rng, scale):
+    rows = []
+    for i in range(int(SIZES["institutions"] * scale)):
+        rows.append({
+            "shortname": "inst%s" % i,
+            "name": "University of %s" % rng.choice(SURNAMES),
+            "city": rng.choice(SURNAMES) + "ville",
+            "type": rng.choice(["university", "institute", "other"]),
+            "timezone": rng.choice(TIMEZONES),
+            "homepage": "https://example.org/inst%s" % i,
+            "admin": "user0@example.org",
+            "deleted": False,
+            "edited_at": datetime(2020, 1, 1, tzinfo=pytz.UTC),
+            "edited_by": 0,
+        })
+    return rows
+
+
+def _users(rng, scale, series, talks):
+    # talks: dictionary from series shortname to the list of counters
+    rows = []
+    for i in range(int(SIZES["users"] * scale)):
+        subscribed = rng.sample(series, min(len(series), int(rng.expovariate(1 / 4))))
+        talk_subs = {}
+        for shortname in rng.sample(series, min(len(series), int(rng.expovariate(1 / 3)))):
+            if talks[shortname]:
+                talk_subs[shortname] = sorted(rng.sample(talks[shortname], min(len(talks[shortname]), rng.randint(1, 3))))
+        rows.append({
+            "email": "user%s@example.org" % i,
+            "name": _person(rng),
+            "affiliation": "University of %s" % rng.choice(SURNAMES),
+            "homepage": "https://example.org/~user%s" % i,
+            "admin": i == 0,
+            "creator": i == 0 or rng.random() < 0.3,
+            "email_confirmed": rng.random() < 0.9,
+            "password": "",  # no one can log in
+            "timezone": rng.choice(TIMEZONES),
+            "seminar_subscriptions": subscribed,
+            "talk_subscriptions": talk_subs,
+            "api_access": 0,
+            "api_token": "%032x" % rng.getrandbits(128),
+            "created": datetime(2020, 1, 1, tzinfo=pytz.UTC),
+            "endorser": 0,
+            "subject_admin": None,
+        })
+    return rows
+
+
+def generate(folder, scale=1.0, seed=0, now=None, series_versions=4, talk_versions=3, talks_per_series=30):
+    """
+    Writes a synthetic database to ``folder``.
+
+    INPUT:
+
+    - ``scale`` -- the number of series, users and institutions is proportional to this
+    - ``seed`` -- the random seed; the same seed and parameters give the same data
+    - ``now`` -- the time around which talks are scheduled (by default the current day, at midnight UTC)
+    - ``series_versions``, ``talk_versions`` -- the average number of versions of each series and talk
+    - ``talks_per_series`` -- the average number of talks in a series
+
+    OUTPUT:
+
+    A dictionary giving the number of rows written for each table.  It is also saved to ``manifest.json``.
+    """
+    rng = random.Random(seed)
+    if now is None:
+        now = datetime.now(pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+    os.makedirs(folder, exist_ok=True)
+    topics = _topics(rng, scale)
+    topic_ids = [row["topic_id"] for row in topics if not row["children"]]
+    institutions = _institutions(rng, scale)
+    nusers = int(SIZES["users"] * scale)
+    creators = ["user%s@example.org" % i for i in range(min(nusers, max(1, nusers // 3)))]
+
+    seminars, talks, organizers = [], [], []
+    counters = {}
+    for i in range(int(SIZES["seminars"] * scale)):
+        shortname = "bench%05d" % i
+        is_conference = rng.random() < 0.1
+        tz = rng.choice(TIMEZONES)
+        owner = rng.choice(creators)
+        created = now - timedelta(days=rng.randint(30, 700))
+        base = {
+            "shortname": shortname,
+            "owner": owner,
+            "is_conference": is_conference,
+            "timezone": tz,
+            "topics": rng.sample(topic_ids, rng.randint(1, 3)),
+            "institutions": ["inst%s" % j for j in rng.sample(range(len(institutions)), min(len(institutions), rng.randint(0, 2)))],
+            "language": "en" if rng.random() < 0.9 else rng.choice(["fr", "de", "es", "zh"]),
+            "visibility": rng.choices([2, 1, 0], [85, 10, 5])[0],
+            "display": rng.random() < 0.95,
+            "online": rng.random() < 0.8,
+            "access_control": 0,
+            "audience": rng.randint(0, 5),
+            "frequency": None if is_conference else rng.choice([0, 7, 7, 14]),
+            "weekdays": None if is_conference else [rng.randint(0, 4)],
+            "time_slots": None if is_conference else ["%02d:00-%02d:00" % (h, h + 1) for h in [rng.randint(9, 17)]],
+            "start_date": (now + timedelta(days=rng.randint(-60, 60))).date() if is_conference else None,
+            "per_day": 4 if is_conference else None,
+            "room": "Room %s" % rng.randint(1, 500) if rng.random() < 0.3 else "",
+            "live_link": "https://example.org/zoom/%s" % i,
+            "homepage": "https://example.org/seminar/%s" % i,
+            "chat_link": "",
+            "stream_link": "",
+            "deleted": False,
+            "by_api": False,
+            "edited_by": 0,
+        }
+        if is_conference:
+            base["end_date"] = base["start_date"] + timedelta(days=rng.randint(1, 5))
+        for v in range(_versions(rng, series_versions)):
+            version = dict(base)
+            version["name"] = _sentence(rng, rng.randint(2, 5)) + (" conference" if is_conference else " seminar")
+            version["comments"] = _sentence(rng, rng.randint(0, 30))
+            version["edited_at"] = created + timedelta(days=3 * v, seconds=rng.randint(0, 86400))
+            seminars.append(version)
+        organizers.append({"seminar_id": shortname, "email": owner, "name": _person(rng), "homepage": "",
+                           "curator": False, "display": True, "order": 0})
+        for j in range(rng.randint(0, 3)):
+            organizers.append({"seminar_id": shortname, "email": rng.choice(creators), "name": _person(rng), "homepage": "",
+                               "curator": rng.random() < 0.2, "display": rng.random() < 0.8, "order": j + 1})
+
+        # Talks, weekly around now, some of them edited many times
+        ntalks = max(1, int(rng.expovariate(1 / talks_per_series)))
+        first = now - timedelta(weeks=rng.randint(0, ntalks)) + timedelta(hours=rng.randint(9, 17))
+        counters[shortname] = []
+        for ctr in range(1, ntalks + 1):
+            start = first + timedelta(days=(1 if is_conference else 7) * (ctr - 1))
+            hidden = rng.random() < 0.02
+            if not hidden:
+                counters[shortname].append(ctr)
+            talk = {
+                "seminar_id": shortname,
+                "seminar_ctr": ctr,
+                "speaker": _person(rng),
+                "speaker_email": "speaker%s@example.org" % rng.randint(0, 10 ** 6),
+                "speaker_affiliation": "University of %s" % rng.choice(SURNAMES),
+                "speaker_homepage": "",
+                "start_time": start,
+                "end_time": start + timedelta(hours=1),
+                "timezone": tz,
+                "topics": base["topics"],
+                "language": base["language"],
+                "online": base["online"],
+                "live_link": base["live_link"],
+                "access_control": 0,
+                "audience": base["audience"],
+                "room": base["room"],
+                "display": base["display"],
+                "hidden": hidden,
+                "deleted": False,
+                "deleted_with_seminar": False,
+                "by_api": False,
+                "token": "%016x" % rng.getrandbits(64),
+                "paper_link": "",
+                "slides_link": "",
+                "video_link": "",
+                "stream_link": "",
+                "chat_link": "",
+                "comments": "",
+                "edited_by": 0,
+            }
+            edited = min(start, now) - timedelta(days=rng.randint(1, 30))
+            for v in range(_versions(rng, talk_versions)):
+                version = dict(talk)
+                version["title"] = _sentence(rng, rng.randint(3, 10)) + " and $\\mathbb{Z}_p$"
+                version["abstract"] = " ".join(_sentence(rng, rng.randint(8, 20)) + "." for _ in range(rng.randint(1, 6)))
+                version["edited_at"] = edited + timedelta(hours=v, seconds=rng.randint(0, 3600))
+                talks.append(version)
+    # Row ids follow the order in which the versions were saved
+    seminars.sort(key=lambda row: row["edited_at"])
+    talks.sort(key=lambda row: row["edited_at"])
+    users = _users(rng, scale, sorted({row["shortname"] for row in seminars if row["visibility"] == 2}), counters)
+
+    counts = {}
+    for tablename, rows in [("new_topics", topics), ("institutions", institutions), ("users", users),
+                            ("seminars", seminars), ("talks", talks), ("seminar_organizers", organizers)]:
+        counts[tablename] = _write(folder, tablename, rows)
+    manifest = {"scale": scale, "seed": seed, "now": now.isoformat(), "series_versions": series_versions,
+                "talk_versions": talk_versions, "talks_per_series": talks_per_series, "counts": counts}
+    with open(os.path.join(folder, "manifest.json"), "w") as F:
+        json.dump(manifest, F, indent=2)
+    return counts
+
+
+def _local_database():
+    from lmfdb.utils.config import Configuration
+
+    host = Configuration().get_postgresql().get("host", "localhost")
+    return host in ["localhost", "127.0.0.1", "::1", ""] or host.startswith("/")
+
+
+def load(folder, force=False):
+    """
+    Replaces the contents of our tables in the configured database by the files in ``folder``.
+
+    Refuses to run against a database that isn't on this machine unless ``force`` is set.
+    """
+    if not force and not _local_database():
+        raise RuntimeError("The configured database is not local; use force=True if you really want to replace its tables")
+    for tablename in TABLES:
+        filename = os.path.join(folder, tablename + ".txt")
+        if os.path.exists(filename):
+            db[tablename].reload(filename, restat=False, sep="\t")
@@ -0,0 +1,179 @@
+"""
+Timing scenarios.
+
+Each scenario is a request made to the app through Flask's test client, so the timings include
+everything but the network and gunicorn: routing, database queries and rendering.  The series,
+talk and user used are chosen deterministically from the database (the first in sort order), so
+that runs against the same data are comparable.
+
+The requests are anonymous, so pages would be served from the page cache after the first
+(see ``seminars.pagecache``): it is bypassed unless ``page_cache`` is set, so that the timings
+measure rendering.  Reports record which was used, and only comparable reports should be compared.
+"""
+import json
+import platform
+import statistics
+import time
+from datetime import datetime
+
+# name: (method, url, json data), with urls formatted using the targets
+SCENARIOS = {
+    "talks": ("GET", "/talks", None),
+    "past_talks": ("GET", "/past_talks", None),
+    "seminar_series": ("GET", "/seminar_series", None),
+    "conferences": ("GET", "/conferences", None),
+    "seminar": ("GET", "/seminar/{shortname}", None),
+    "talk": ("GET", "/talk/{shortname}/{ctr}/", None),
+    "seminar_ics": ("GET", "/seminar/{shortname}/ics", None),
+    "talk_ics": ("GET", "/talk/{shortname}/{ctr}/ics", None),
+    "user_ics": ("GET", "/user/ics/{ics_token}", None),
+    "embed_json": ("GET", "/seminar/{shortname}/json", None),
+    "api_lookup_series": ("POST", "/api/0/lookup/series", {"series_id": "{shortname}"}),
+    "api_search_series": ("POST", "/api/0/search/series", {"query": {"is_conference": False}}),
+    "api_search_talks": ("POST", "/api/0/search/talks", {"query": {"seminar_id": "{shortname}"}}),
+}
+
+
+def targets():
+    """
+    The series, talk and user used in the scenarios.
+    """
+    from seminars import db
+    from seminars.seminar import seminars_lucky
+    from seminars.talk import talks_lucky
+    from seminars.tokens import generate_token
+
+    shortname = seminars_lucky({"visibility": 2, "display": True}, projection="shortname", sort=["shortname"])
+    if shortname is None:
+        raise RuntimeError("There are no public series in the database; see seminars.benchmark.generate")
+    ctr = talks_lucky({"seminar_id": shortname, "hidden": False}, projection="seminar_ctr", sort=["seminar_ctr"])
+    uid = db.users.lucky({"email_confirmed": True}, projection="id", sort=["id"])
+    return {"shortname": shortname, "ctr": ctr, "ics_token": generate_token(uid, "ics")}
+
+
+def _fill(obj, values):
+    if isinstance(obj, str):
+        return obj.format(**values)
+    if isinstance(obj, dict):
+        return {key: _fill(val, values) for key, val in obj.items()}
+    return obj
+
+
+def _server_timing(response):
+    # As set by seminars.sqlstats: db;dur=12.3;desc="4 queries"
+    header = response.headers.get("Server-Timing", "")
+    if not header.startswith("db;"):
+        return 0, 0.0
+    parts = dict(part.split("=", 1) for part in header.split(";")[1:])
+    return int(parts["desc"].strip('"').split()[0]), float(parts["dur"])
+
+
+def _summarize(times):
+    times = sorted(times)
+    return {
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "p90": times[min(len(times) - 1, int(0.9 * len(times)))],
+        "min": times[0],
+        "max": times[-1],
+    }
+
+
+def run(repeat=20, warmup=3, only=None, page_cache=False):
+    """
+    Runs the scenarios, returning a report suitable for ``compare``.
+
+    INPUT:
+
+    - ``repeat`` -- the number of timed requests for each scenario
+    - ``warmup`` -- the number of untimed requests made first (filling caches)
+    - ``only`` -- a list of scenario names to run (all by default)
+    - ``page_cache`` -- whether pages may be served from the page cache
+    """
+    if repeat < 1:
+        raise ValueError("repeat must be at least 1")
+    from seminars.website import app
+    from seminars.app import git_infos
+    from seminars.pagecache import bypass
+
+    with app.test_request_context():
+        values = targets()
+    if page_cache:
+        results = _run(app, values, repeat, warmup, only)
+    else:
+        with bypass():
+            results = _run(app, values, repeat, warmup, only)
+    rev = git_infos()[0]
+    return {
+        "created": datetime.utcnow().isoformat(),
+        "git_revision": rev.decode().strip() if isinstance(rev, bytes) else rev,
+        "python": platform.python_version(),
+        "repeat": repeat,
+        "warmup": warmup,
+        "page_cache": page_cache,
+        "targets": values,
+        "scenarios": results,
+    }
+
+
+def _run(app, values, repeat, warmup, only):
+    client = app.test_client()
+    results = {}
+    for name, (method, url, data) in SCENARIOS.items():
+        if only and name not in only:
+            continue
+        url, data = _fill(url, values), _fill(data, values)
+        times, db_times, queries, sizes, statuses = [], [], [], [], set()
+        for i in range(warmup + repeat):
+            t0 = time.perf_counter()
+            response = client.open(url, method=method, json=data)
+            body = response.get_data()
+            elapsed = time.perf_counter() - t0
+            statuses.add(response.status_code)
+            if i >= warmup:
+                times.append(1000 * elapsed)
+                nqueries, db_ms = _server_timing(response)
+                queries.append(nqueries)
+                db_times.append(db_ms)
+                sizes.append(len(body))
+        results[name] = {
+            "url": url,
+            "method": method,
+            "status": sorted(statuses),
+            "ms": _summarize(times),
+            "db_ms": _summarize(db_times),
+            "queries": max(queries),
+            "bytes": max(sizes),
+        }
+    return results
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Compares two reports produced by ``run``.
+
+    Returns a list of lines describing each scenario, and a list of the scenarios whose median
+    time grew by more than ``threshold`` (as a fraction) or that make more queries.
+    """
+    lines = ["%-20s %12s %12s %8s %10s" % ("scenario", "old ms", "new ms", "change", "queries")]
+    if old.get("page_cache", False) != new.get("page_cache", False):
+        lines.insert(0, "Warning: only one of the reports was made with the page cache\n")
+    regressions = []
+    for name in sorted(set(old["scenarios"]) | set(new["scenarios"])):
+        if name not in old["scenarios"] or name not in new["scenarios"]:
+            lines.append("%-20s only in %s report" % (name, "new" if name in new["scenarios"] else "old"))
+            continue
+        a, b = old["scenarios"][name], new["scenarios"][name]
+        change = b["ms"]["median"] / a["ms"]["median"] - 1 if a["ms"]["median"] else 0
+        flag = ""
+        if change > threshold or b["queries"] > a["queries"]:
+            regressions.append(name)
+            flag = " <--"
+        lines.append("%-20s %12.1f %12.1f %+7.0f%% %4s -> %-4s%s" % (
+            name, a["ms"]["median"], b["ms"]["median"], 100 * change, a["queries"], b["queries"], flag))
+    return lines, regressions
+
+
+def load_report(filename):
+    with open(filename) as F:
+        return json.load(F)
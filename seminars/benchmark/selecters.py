@@ -0,0 +1,97 @@
+"""
+Timings of the main versioned selecters, called directly rather than through a page.
+
+These are the queries most affected by the indexes declared in ``seminars.indexes``.  The
+report has the same format as ``scenarios.run``, so the two can be compared in the same way.
+"""
+import platform
+import time
+from datetime import datetime
+import pytz
+from .scenarios import _summarize
+
+
+def _selecters(values):
+    from seminars import db
+    from seminars.seminar import seminars_search, seminars_lookup, all_seminars
+    from seminars.talk import talks_search, talks_lookup
+    from seminars.users.pwdmanager import ilike_query
+
+    now = datetime.now(pytz.UTC)
+    shortname, ctr, topic, owner = values["shortname"], values["ctr"], values["topic"], values["owner"]
+    return {
+        "talk_lookup": lambda: talks_lookup(shortname, ctr),
+        "talks_of_series": lambda: list(talks_search({"seminar_id": shortname}, sort=["start_time"])),
+        "talks_upcoming": lambda: talks_search({"start_time": {"$gte": now}}, sort=["start_time"], limit=100),
+        "talks_upcoming_public": lambda: talks_search({"start_time": {"$gte": now}, "hidden": False}, sort=["start_time"],
+                                                      limit=100, public_series=True),
+        "talks_by_topic": lambda: talks_search({"topics": {"$contains": [topic]}}, sort=["start_time"], limit=100),
+        # As on the browse page, with WebTalk objects and with the compact rows
+        "talks_listing": lambda: list(talks_search({"end_time": {"$gte": now}}, sort=["start_time"],
+                                                   seminar_dict=all_seminars())),
+        "talks_listing_rows": lambda: list(talks_search({"end_time": {"$gte": now}}, sort=["start_time"],
+                                                        seminar_dict=all_seminars(rows=True), rows=True)),
+        "seminar_lookup": lambda: seminars_lookup(shortname),
+        "seminars_public": lambda: list(seminars_search({"visibility": 2}, sort=["shortname"])),
+        "seminars_by_owner": lambda: list(seminars_search({"owner": ilike_query(owner)}, "shortname")),
+        "organizers_of_series": lambda: list(db.seminar_organizers.search({"seminar_id": shortname})),
+    }
+
+
+def targets():
+    from seminars.seminar import seminars_lookup
+    from seminars.talk import talks_lucky
+
+    from .scenarios import targets as page_targets
+
+    values = page_targets()
+    seminar = seminars_lookup(values["shortname"], objects=False)
+    values["topic"] = (seminar.get("topics") or [""])[0]
+    values["owner"] = seminar.get("owner") or ""
+    if values["ctr"] is None:
+        values["ctr"] = talks_lucky({}, projection="seminar_ctr")
+    del values["ics_token"]
+    return values
+
+
+def run(repeat=20, warmup=3, only=None):
+    """
+    Times the selecters, returning a report in the format of ``scenarios.run``.
+    """
+    if repeat < 1:
+        raise ValueError("repeat must be at least 1")
+    from seminars.app import app, git_infos
+    from seminars.sqlstats import totals
+
+    with app.test_request_context():
+        values = targets()
+        selecters = _selecters(values)
+        results = {}
+        for name, func in selecters.items():
+            if only and name not in only:
+                continue
+            times = []
+            # The most queries made by a timed run (the count can drop once caches are filled)
+            max_queries = 0
+            for i in range(warmup + repeat):
+                queries = totals["queries"]
+                t0 = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - t0
+                if i >= warmup:
+                    times.append(1000 * elapsed)
+                    max_queries = max(max_queries, totals["queries"] - queries)
+            results[name] = {
+                "ms": _summarize(times),
+                "queries": max_queries,
+            }
+    rev = git_infos()[0]
+    return {
+        "created": datetime.utcnow().isoformat(),
+        "git_revision": rev.decode().strip() if isinstance(rev, bytes) else rev,
+        "python": platform.python_version(),
+        "repeat": repeat,
+        "warmup": warmup,
+        "targets": values,
+        "scenarios": results,
+    }
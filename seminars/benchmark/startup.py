@@ -0,0 +1,123 @@
+"""
+Startup timings: how long a new gunicorn worker takes before it serves requests quickly.
+
+Each run is a fresh Python process, timing
+
+- ``import`` -- importing ``seminars.website`` (connecting to the database and registering the pages)
+- ``warm`` -- ``seminars.website.warm``, which gunicorn calls before a worker accepts requests
+- ``first_request`` and ``second_request`` -- requests for the browse page made afterwards
+- ``fork`` -- forking a child from the loaded and warmed process and serving its first request,
+  as for a worker forked by a master with ``preload_app``
+- ``cold_request`` -- a request for the browse page made right after importing, without warming,
+  in a separate process (what a worker's first visitor waits for when nothing is loaded ahead)
+
+The report has the same format as ``scenarios.run``, so the two can be compared in the same way.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from .scenarios import _summarize
+
+URL = "/talks"
+MARKER = "STARTUP "
+
+_CHILD = """
+import time
+t0 = time.perf_counter()
+import seminars.website
+t1 = time.perf_counter()
+from seminars.benchmark.startup import _measure
+_measure(t0, t1, %r, %r)
+"""
+
+
+def _request(client):
+    t0 = time.perf_counter()
+    response = client.get(URL)
+    response.get_data()
+    return 1000 * (time.perf_counter() - t0)
+
+
+def _measure(t0, t1, warm, forks):
+    # Runs in the process being timed, printing the results on a line starting with MARKER
+    from seminars.website import app
+    from seminars.sqlstats import totals
+
+    results = {"import": (1000 * (t1 - t0), totals["queries"])}
+    client = app.test_client()
+    if warm:
+        from seminars.website import warm as warm_app
+        queries = totals["queries"]
+        t0 = time.perf_counter()
+        warm_app()
+        results["warm"] = (1000 * (time.perf_counter() - t0), totals["queries"] - queries)
+        for name in ["first_request", "second_request"]:
+            queries = totals["queries"]
+            results[name] = (_request(client), totals["queries"] - queries)
+        if forks:
+            from seminars.dbpool import before_fork, after_fork
+            before_fork()
+            times = []
+            for i in range(forks):
+                read, write = os.pipe()
+                t0 = time.perf_counter()
+                pid = os.fork()
+                if pid == 0:
+                    os.close(read)
+                    after_fork()
+                    _request(app.test_client())
+                    os.write(write, str(1000 * (time.perf_counter() - t0)).encode())
+                    os._exit(0)
+                os.close(write)
+                with os.fdopen(read) as F:
+                    times.append(float(F.read() or "nan"))
+                os.waitpid(pid, 0)
+            results["fork"] = (times, None)
+    else:
+        queries = totals["queries"]
+        results["cold_request"] = (_request(client), totals["queries"] - queries)
+    print(MARKER + json.dumps(results))
+
+
+def _run_child(warm, forks):
+    output = subprocess.run([sys.executable, "-c", _CHILD % (warm, forks)], check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout
+    for line in output.splitlines():
+        if line.startswith(MARKER):
+            return json.loads(line[len(MARKER):])
+    raise RuntimeError("No timings in the output of the timed process")
+
+
+def run(repeat=5, forks=5):
+    """
+    Times worker startup, returning a report in the format of ``scenarios.run``.
+
+    INPUT:
+
+    - ``repeat`` -- the number of processes started for each kind of run
+    - ``forks`` -- the number of children forked from each warmed process
+    """
+    from seminars.app import git_infos
+
+    samples = {}
+    for i in range(repeat):
+        for warm in [True, False]:
+            for name, (ms, queries) in _run_child(warm, forks).items():
+                entry = samples.setdefault(name, {"ms": [], "queries": 0})
+                entry["ms"].extend(ms if isinstance(ms, list) else [ms])
+                entry["queries"] = max(entry["queries"], queries or 0)
+    results = {name: {"ms": _summarize(entry["ms"]), "queries": entry["queries"]}
+               for name, entry in samples.items()}
+    rev = git_infos()[0]
+    return {
+        "created": datetime.utcnow().isoformat(),
+        "git_revision": rev.decode().strip() if isinstance(rev, bytes) else rev,
+        "python": platform.python_version(),
+        "repeat": repeat,
+        "forks": forks,
+        "scenarios": results,
+    }
@@ -0,0 +1,65 @@
+"""
+In-process caches.
+
+Each worker process has its own copy of these caches, so they should only hold data
+that can be slightly stale, or that is invalidated by the process that changes it.
+"""
+from collections import OrderedDict
+from threading import RLock
+import time
+
+# All caches, by name, so that their hit rates can be reported
+caches = {}
+
+
+class LRUCache(object):
+    """
+    A thread-safe cache holding at most ``maxsize`` entries, discarding the least recently used.
+
+    If ``ttl`` is given, entries older than ``ttl`` seconds are treated as missing.
+    """
+
+    def __init__(self, name, maxsize=1024, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+        caches[name] = self
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, (default, None))[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
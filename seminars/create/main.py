@@ -15,7 +15,7 @@ from seminars.utils import (
     sanity_check_times,
     short_weekdays,
     show_input_errors,
-    timezones,
+    timezone_options,
     midnight,
     daytime_minutes,
     daytimes_early,
@@ -44,6 +44,7 @@ from seminars.seminar import (
 from seminars.talk import (
     WebTalk,
     can_edit_talk,
+    save_talks_admin,
     talks_lookup,
     talks_lucky,
     talks_max,
@@ -61,7 +62,7 @@ from seminars.language import languages
 from seminars.lock import get_lock
 from seminars.users.pwdmanager import ilike_query, ilike_escape, userdb
 from lmfdb.utils import flash_error
-from lmfdb.backend.utils import IdentifierWrapper
+from lmfdb.backend.utils import DelayCommit, IdentifierWrapper
 from psycopg2.sql import SQL
 from datetime import datetime, timedelta
 from math import ceil
@@ -74,7 +75,7 @@ TBA_CONVERSION_MESSAGE = 'To be announced title converted to a blank title that
 def seminar_options():
     return {
         'institution': institutions(),
-        'timezone' : timezones,
+        'timezone' : timezone_options(),
         'weekday' : short_weekdays,
         'access_control' : access_control_options,
         'access_time' : access_time_options,
@@ -85,7 +86,7 @@ def seminar_options():
 
 def talk_options():
     return {
-        'timezone' : timezones,
+        'timezone' : timezone_options(),
         'access_control' : access_control_options,
         'access_time' : access_time_options,
         'audience' : audience_options,
@@ -160,7 +161,8 @@ WHERE ({Tsems}.{Cowner} ~~* %s OR {Torgs}.{Cemail} ~~* %s) AND {Ttalks}.{Cdel} =
     if current_user.is_creator:
         api_series = [series for (series, r) in seminars + conferences if series.by_api and not series.display]
         api_series.sort(key = lambda S: S.edited_at, reverse=True)
-        api_talks = list(talks_search({"by_api": True, "display": False, "seminar_id": {"$in": [series.shortname for (series, r) in seminars + conferences]}, "seminar_ctr": {"$gt": 0}}, sort=[("edited_at", -1)], include_pending=True))
+        seminar_dict = {series.shortname: series for (series, r) in seminars + conferences}
+        api_talks = list(talks_search({"by_api": True, "display": False, "seminar_id": {"$in": list(seminar_dict)}, "seminar_ctr": {"$gt": 0}}, sort=[("edited_at", -1)], include_pending=True, seminar_dict=seminar_dict))
     else:
         api_series = api_talks = []
 
@@ -313,8 +315,17 @@ def revive_seminar(shortname):
     if not seminar.deleted:
         flash_error("%s %s does not need to be revived, it is not marked as deleted.", seminar.series_type.capitalize(), shortname)
     else:
-        db.seminars.update({"shortname": shortname}, {"deleted": False})
-        db.talks.update({"seminar_id": shortname, "deleted_with_seminar":True}, {"deleted": False})
+        with DelayCommit(db):
+            talks = list(talks_search({"seminar_id": shortname, "deleted_with_seminar": True},
+                                      seminar_dict={shortname: seminar}, include_deleted=True))
+            db.seminars.update({"shortname": shortname}, {"deleted": False})
+            db.talks.update({"seminar_id": shortname, "deleted_with_seminar":True}, {"deleted": False})
+            # Record the revival of the series and its talks as new versions, so that they appear in the API change feed
+            seminar.deleted = False
+            seminar.save_admin()
+            for talk in talks:
+                talk.deleted = False
+            save_talks_admin(talks)
         flash(
             "%s %s revived.  Note that any users who were subscribed no longer are."
             % (seminar.series_type, shortname)
@@ -410,7 +421,11 @@ def revive_talk(seminar_id, seminar_ctr):
         flash_error("Talk %s/%s does not need to be revived; it is not marked as deleted.", seminar_id, seminar_ctr)
         return redirect(url_for(".edit_talk", seminar_id=seminar_id, seminar_ctr=seminar_ctr), 302)
     else:
-        db.talks.update({"seminar_id": seminar_id, "seminar_ctr": seminar_ctr}, {"deleted": False})
+        with DelayCommit(db):
+            db.talks.update({"seminar_id": seminar_id, "seminar_ctr": seminar_ctr}, {"deleted": False})
+            # Record the revival as a new version, so that it appears in the API change feed
+            talk.deleted = False
+            talk.save_admin()
         flash("Talk revived.  Note that any users who were subscribed no longer are.")
         return redirect(url_for(".edit_talk", seminar_id=seminar_id, seminar_ctr=seminar_ctr), 302)
 
@@ -687,7 +702,7 @@ def edit_institution():
         "edit_institution.html",
         institution=institution,
         institution_types=institution_types,
-        timezones=timezones,
+        timezones=timezone_options(),
         title=title,
         section="Manage",
         subsection="editinst",
@@ -864,7 +879,8 @@ def save_talk():
         edit_kwds.pop("token", None)
     return redirect(url_for(".edit_talk", **edit_kwds), 302)
 
-def process_save_talk(talk, raw_data, warn=flash_warnmsg, format_error=format_errmsg, format_input_error=format_input_errmsg, incremental_update=True):
+def process_save_talk(talk, raw_data, warn=flash_warnmsg, format_error=format_errmsg, format_input_error=format_input_errmsg, incremental_update=True, seminar_ctr=None):
+    # seminar_ctr can be specified for new talks when the caller has already allocated it
     errmsgs = []
     data = {
         "seminar_id": talk.seminar_id,
@@ -872,10 +888,12 @@ def process_save_talk(talk, raw_data, warn=flash_warnmsg, format_error=format_er
         "display": talk.display,  # could be being edited by anonymous user
     }
     if talk.new:
-        curmax = talks_max("seminar_ctr", {"seminar_id": talk.seminar_id}, include_deleted=True)
-        if curmax is None:
-            curmax = 0
-        data["seminar_ctr"] = curmax + 1
+        if seminar_ctr is None:
+            curmax = talks_max("seminar_ctr", {"seminar_id": talk.seminar_id}, include_deleted=True)
+            if curmax is None:
+                curmax = 0
+            seminar_ctr = curmax + 1
+        data["seminar_ctr"] = seminar_ctr
     else:
         data["seminar_ctr"] = talk.seminar_ctr
     default_tz = talk.seminar.timezone
@@ -923,7 +941,7 @@ def process_save_talk(talk, raw_data, warn=flash_warnmsg, format_error=format_er
     # Don't try to create new_version using invalid input
     if errmsgs:
         return None, errmsgs
-    new_version = WebTalk(talk.seminar_id, data=data)
+    new_version = WebTalk(talk.seminar_id, data=data, seminar=talk.seminar)
 
     # Warnings
     sanity_check_times(new_version.start_time, new_version.end_time, warn=warn)
@@ -980,7 +998,8 @@ def layout_schedule(seminar, data):
     midnight_begin = midnight(begin, tz)
     midnight_end = midnight(end, tz)
     query = {"$gte": midnight_begin, "$lt": midnight_end + day}
-    talks = list(talks_search({"seminar_id": shortname, "seminar_ctr": {"$gt": 0}, "start_time": query}, sort=["start_time"]))
+    talks = list(talks_search({"seminar_id": shortname, "seminar_ctr": {"$gt": 0}, "start_time": query}, sort=["start_time"],
+                              seminar_dict={shortname: seminar}))
     if any(talk.by_api and not talk.display for talk in talks):
         raise APIError
     slots = [(t.show_date(tz), t.show_daytimes(tz), t) for t in talks]
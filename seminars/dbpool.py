@@ -0,0 +1,460 @@
+"""
+Connections to Postgres.
+
+The LMFDB backend opens a single connection when ``seminars.db`` is created, and every table
+object (including those returned by ``sanitized_table``) holds a reference to it.  This module
+keeps a small pool of connections in each worker process and attaches one to ``db`` and all of
+its tables at the start of each request:
+
+- connections are opened lazily, with jittered retries, so that a deploy starting many workers
+  at once doesn't fail on (or pile onto) a database that is briefly refusing connections;
+- connections that have been idle for a while are checked before use, and replaced if broken;
+- connections inherited from a parent process are never used (or closed) by its children;
+- queries made during a request are subject to a statement timeout, so that a runaway query
+  is cancelled before gunicorn kills the worker.
+
+Pool sizes and timeouts can be set with the environment variables ``SEMINARS_DB_POOL_SIZE``,
+``SEMINARS_DB_STATEMENT_TIMEOUT`` (in milliseconds, 0 to disable) and ``SEMINARS_DB_HEALTH_INTERVAL``
+(in seconds).  Scripts that don't run in a request keep using the connection opened at startup.
+
+Note that the connection is attached to the module-level ``db``, so it is shared by everything the
+process does: this is only request scoping when each process serves one request at a time, as
+gunicorn's sync workers do (the configurations in configfiles set ``worker_class = "sync"``).  With
+threaded or asynchronous workers, concurrent requests would all use the connection checked out by
+the first, and their transactions would interleave.  Attaching also relies on internals of the LMFDB
+backend (``db._objects`` and the ``conn`` attribute of each object), which ``_attach`` checks.
+When gunicorn loads the app before forking (``preload_app``), its configuration calls ``before_fork``
+in the master and ``after_fork`` in each worker.
+
+If ``SEMINARS_REPLICA_DSN`` is set (to a libpq connection string, such as
+``"host=replica.example.org"``, whose settings override those in config.ini), searches made
+through ``search_distinct``, ``lucky_distinct``, ``count_distinct`` and sanitized tables during a
+request are sent to that server instead, on read-only connections.  Once a request has written to
+the database, its remaining reads go to the primary, as do the reads of the same user for the next
+``SEMINARS_REPLICA_STICKY`` seconds (10 by default), so that people see their own changes even if the
+replica lags behind.  If the replica can't be reached, reads go to the primary for a while.
+
+To try this out locally, either run a second Postgres instance as a streaming replica, or point
+``SEMINARS_REPLICA_DSN`` at the same instance with a role that can only read (for example
+``"user=seminars_ro password=..."``), and run ``python -m seminars.dbpool`` to check where
+connections end up.
+"""
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request, session
+from lmfdb.logger import critical
+from psycopg2 import Error as PGError, OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN, parse_dsn
+import seminars
+from seminars import db
+
+CONNECT_ATTEMPTS = 5
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of connections to the database used by ``seminars.db``.
+
+    INPUT:
+
+    - ``maxsize`` -- the maximum number of connections open at once in this process
+    - ``statement_timeout`` -- if nonzero, the statement timeout (in milliseconds) for the pool's connections
+    - ``health_interval`` -- connections idle for longer than this (in seconds) are checked before use
+    - ``checkout_timeout`` -- how long to wait for a connection when all are in use before raising ``PoolTimeout``
+    - ``connect_kwargs`` -- connection settings overriding those in config.ini
+    - ``read_only`` -- whether transactions on the pool's connections are read only
+    - ``attempts`` -- the number of times to try connecting before giving up
+    """
+
+    def __init__(self, maxsize=2, statement_timeout=0, health_interval=30, checkout_timeout=10,
+                 connect_kwargs={}, read_only=False, attempts=CONNECT_ATTEMPTS):
+        self.maxsize = maxsize
+        self.statement_timeout = statement_timeout
+        self.connect_kwargs = dict(connect_kwargs)
+        self.read_only = read_only
+        self.attempts = attempts
+        self.health_interval = health_interval
+        self.checkout_timeout = checkout_timeout
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []  # pairs (connection, time returned)
+        self._in_use = 0
+        self.checkouts = 0
+        self.checkout_wait = 0.0
+        self.checkout_wait_max = 0.0
+        self.opened = 0
+        self.discarded = 0
+        self.health_check_failures = 0
+        self.connect_failures = 0
+        self.timeouts = 0
+
+    def _check_pid(self):
+        # After a fork the inherited connections belong to the parent: closing them would send
+        # a termination message on the parent's socket, so we just forget about them.
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _configure(self, conn):
+        if self.statement_timeout or self.read_only:
+            with conn.cursor() as cur:
+                if self.statement_timeout:
+                    cur.execute("SET statement_timeout = %s", [int(self.statement_timeout)])
+                if self.read_only:
+                    cur.execute("SET default_transaction_read_only = on")
+            conn.commit()
+        return conn
+
+    def _connect(self):
+        for attempt in range(self.attempts):
+            try:
+                conn = self._configure(db._new_connection(**self.connect_kwargs))
+            except OperationalError as err:
+                with self._cond:
+                    self.connect_failures += 1
+                if attempt == self.attempts - 1:
+                    critical("Unable to connect to the database: %s" % err)
+                    raise
+                # Back off, with jitter so that workers started together don't retry together
+                time.sleep(min(0.1 * 2 ** attempt, 2) * random.uniform(0.5, 1.5))
+            else:
+                with self._cond:
+                    self.opened += 1
+                return conn
+
+    def _close(self, conn):
+        with self._cond:
+            self.discarded += 1
+        try:
+            conn.close()
+        except PGError:
+            pass
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.time() - idle_since < self.health_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except PGError:
+            with self._cond:
+                self.health_check_failures += 1
+            return False
+        return True
+
+    def adopt(self, conn):
+        """
+        Adds an existing connection (such as the one opened when ``db`` was created) to the pool.
+        """
+        with self._cond:
+            self._check_pid()
+            if self._in_use + len(self._idle) >= self.maxsize:
+                return False
+        try:
+            self._configure(conn)
+        except PGError:
+            return False
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+        return True
+
+    def checkout(self):
+        """
+        Returns a working connection, opening a new one if necessary.
+        """
+        start = time.time()
+        while True:
+            with self._cond:
+                self._check_pid()
+                while not self._idle and self._in_use >= self.maxsize:
+                    remaining = self.checkout_timeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout("No database connection available after %ss" % self.checkout_timeout)
+                    self._cond.wait(remaining)
+                self._in_use += 1
+                idle = self._idle.pop() if self._idle else None
+            try:
+                if idle is None:
+                    conn = self._connect()
+                elif self._healthy(*idle):
+                    conn = idle[0]
+                else:
+                    # Try again, with another idle connection or a new one
+                    self._close(idle[0])
+                    with self._cond:
+                        self._in_use -= 1
+                    continue
+            except BaseException:
+                with self._cond:
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+            wait = time.time() - start
+            with self._cond:
+                self.checkouts += 1
+                self.checkout_wait += wait
+                self.checkout_wait_max = max(self.checkout_wait_max, wait)
+            return conn
+
+    def checkin(self, conn):
+        """
+        Returns a connection to the pool, rolling back any transaction left open.
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                # Checked out before a fork: not ours to reuse
+                return
+        reusable = not conn.closed
+        if reusable:
+            try:
+                status = conn.get_transaction_status()
+                if status == TRANSACTION_STATUS_UNKNOWN:
+                    reusable = False
+                elif status != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except PGError:
+                reusable = False
+        with self._cond:
+            self._in_use -= 1
+            if reusable and len(self._idle) + self._in_use < self.maxsize:
+                self._idle.append((conn, time.time()))
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._close(conn)
+
+    def discard(self, conn):
+        """
+        Closes a checked out connection instead of returning it to the pool.
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            self._cond.notify()
+        self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        A context manager providing a connection from the pool, for work done alongside ``db``.
+        """
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def stats(self):
+        """
+        A dictionary of statistics about this process's pool.
+        """
+        with self._cond:
+            self._check_pid()
+            return {
+                "active": self._in_use,
+                "idle": len(self._idle),
+                "checkouts": self.checkouts,
+                "checkout_wait_seconds": self.checkout_wait,
+                "checkout_wait_max_seconds": self.checkout_wait_max,
+                "opened": self.opened,
+                "discarded": self.discarded,
+                "health_check_failures": self.health_check_failures,
+                "connect_failures": self.connect_failures,
+                "timeouts": self.timeouts,
+            }
+
+
+pool = ConnectionPool(
+    maxsize=int(os.environ.get("SEMINARS_DB_POOL_SIZE", 2)),
+    # Below gunicorn's worker timeout, so that slow queries fail rather than the whole worker
+    statement_timeout=int(os.environ.get("SEMINARS_DB_STATEMENT_TIMEOUT", 25000)),
+    health_interval=float(os.environ.get("SEMINARS_DB_HEALTH_INTERVAL", 30)),
+)
+
+REPLICA_DSN = os.environ.get("SEMINARS_REPLICA_DSN")
+REPLICA_STICKY = float(os.environ.get("SEMINARS_REPLICA_STICKY", 10))
+# How long to send reads to the primary after failing to connect to the replica
+REPLICA_RETRY = 30
+
+replica_pool = None
+if REPLICA_DSN:
+    replica_pool = ConnectionPool(
+        maxsize=pool.maxsize,
+        statement_timeout=pool.statement_timeout,
+        health_interval=pool.health_interval,
+        connect_kwargs=parse_dsn(REPLICA_DSN),
+        read_only=True,
+        # We fall back on the primary rather than waiting for the replica
+        attempts=1,
+    )
+_replica_down_until = [0]
+
+_attached = {"conn": None, "requests": 0, "pid": None, "adopted": False}
+_attach_lock = threading.Lock()
+
+
+def _attach(conn):
+    # The same thing that db.reset_connection does: point db and every table (including
+    # sanitized tables, which register themselves with db) at the connection.  These are
+    # private attributes of the backend, so fail loudly if they change rather than leaving
+    # some tables on another connection.
+    assert hasattr(db, "_objects"), "the LMFDB backend no longer lists its objects in db._objects"
+    for obj in db._objects:
+        assert hasattr(obj, "conn"), "%r has no connection attribute" % (obj,)
+        obj.conn = conn
+
+
+def record_write(tname=None):
+    """
+    Notes that the current request has written to the database, so that reads stay on the primary.
+    """
+    if has_request_context():
+        g.db_wrote = True
+        if replica_pool is not None:
+            session["db_wrote"] = time.time()
+
+
+def _replica_conn():
+    if replica_pool is None or not has_request_context() or db._nocommit_stack or g.get("db_wrote"):
+        return None
+    if time.time() - session.get("db_wrote", 0) < REPLICA_STICKY:
+        return None
+    conn = g.get("replica_conn")
+    if conn is None:
+        if time.time() < _replica_down_until[0]:
+            return None
+        try:
+            conn = replica_pool.checkout()
+        except (PGError, PoolTimeout) as err:
+            critical("Unable to use the replica, reading from the primary: %s" % err)
+            _replica_down_until[0] = time.time() + REPLICA_RETRY
+            return None
+        g.replica_conn = conn
+    return conn
+
+
+@contextmanager
+def replica_reads(table):
+    """
+    A context manager within which queries on ``table`` go to the replica, if appropriate.
+
+    Only use this around code that doesn't write.
+    """
+    conn = _replica_conn()
+    if conn is None:
+        yield
+        return
+    saved = table.conn
+    table.conn = conn
+    try:
+        yield
+    finally:
+        # If the connection broke, the backend will have replaced it with a new primary connection
+        if table.conn is conn:
+            table.conn = saved
+
+
+def _begin_request():
+    if request.endpoint == "static":
+        return
+    with _attach_lock:
+        if _attached["pid"] != os.getpid():
+            _attached.update(conn=None, requests=0, pid=os.getpid(), adopted=False)
+        if _attached["requests"] == 0 and not db._nocommit_stack:
+            if not _attached["adopted"]:
+                # Reuse the connection opened at startup, unless we inherited it from our parent
+                _attached["adopted"] = True
+                if getattr(db, "_pool_pid", os.getpid()) == os.getpid():
+                    pool.adopt(db.conn)
+            conn = pool.checkout()
+            _attach(conn)
+            _attached["conn"] = conn
+        _attached["requests"] += 1
+    request._db_checkout = True
+
+
+def _end_request(exc=None):
+    replica_conn = g.pop("replica_conn", None)
+    if replica_conn is not None:
+        replica_pool.checkin(replica_conn)
+    if not getattr(request, "_db_checkout", False):
+        return
+    with _attach_lock:
+        _attached["requests"] -= 1
+        if _attached["requests"] == 0 and _attached["conn"] is not None:
+            conn, _attached["conn"] = _attached["conn"], None
+            if db.conn is not conn:
+                # The backend replaced a broken connection during the request
+                pool.discard(conn)
+                pool.adopt(db.conn)
+            else:
+                pool.checkin(conn)
+
+
+def init_app(app):
+    """
+    Checks out a connection for each request to ``app``.
+    """
+    # Remember which process opened the startup connection, so that forked workers don't reuse it
+    db._pool_pid = os.getpid()
+    seminars.write_hooks.append(record_write)
+    app.before_request(_begin_request)
+    app.teardown_request(_end_request)
+
+
+def before_fork():
+    """
+    Closes the connection opened at startup, in a process (such as gunicorn's master, with
+    ``preload_app``) about to fork workers that will open their own.
+
+    A child dropping its copy of an open connection would otherwise end the parent's session,
+    since psycopg2 says goodbye to the server when a connection object is freed.
+    """
+    if not db.conn.closed:
+        db.conn.close()
+
+
+def after_fork():
+    """
+    Forgets the connections inherited from the parent process, in a freshly forked worker
+    (the pools would otherwise notice on first use).
+    """
+    with _attach_lock:
+        _attached.update(conn=None, requests=0, pid=os.getpid(), adopted=True)
+    for p in [pool, replica_pool]:
+        if p is not None:
+            with p._cond:
+                p._check_pid()
+
+
+if __name__ == "__main__":
+    def describe(conn):
+        with conn.cursor() as cur:
+            cur.execute("SELECT inet_server_addr(), inet_server_port(), current_user, pg_is_in_recovery(), "
+                        "current_setting('transaction_read_only')")
+            addr, port, user, recovery, read_only = cur.fetchone()
+        conn.rollback()
+        return "%s:%s as %s (standby: %s, read only: %s)" % (addr, port, user, recovery, read_only)
+
+    with pool.connection() as conn:
+        print("Primary: " + describe(conn))
+    if replica_pool is None:
+        print("No replica configured (set SEMINARS_REPLICA_DSN)")
+    else:
+        with replica_pool.connection() as conn:
+            print("Replica: " + describe(conn))
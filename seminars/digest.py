@@ -0,0 +1,196 @@
+"""
+Daily digest emails.
+
+Each user with a confirmed email address who has favorited talks (or series with talks) in the
+next 24 hours is sent a list of them.  Everything is computed with a handful of queries: one for
+the series, one for the upcoming talks and one for the users subscribed to any of them.
+Emails are sent over a few concurrent SMTP connections (see ``seminars.mailqueue.deliver``).
+
+Run daily from cron::
+
+    python -m seminars.digest
+
+Use ``--dry-run`` to render the emails without sending them, and see ``seminars.mailqueue`` for
+a local SMTP server that can be used for testing.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from collections import defaultdict
+from flask import url_for
+from lmfdb.backend.utils import IdentifierWrapper
+from psycopg2.sql import SQL
+from seminars import db
+from seminars.mailqueue import deliver
+from seminars.seminar import all_seminars
+from seminars.talk import talks_search
+from seminars.utils import topdomain
+import pytz
+import time
+
+DIGEST_SENDER = "researchseminarsnoreply@math.mit.edu"
+
+
+def upcoming_talks(start, end):
+    """
+    Returns a dictionary, with keys series ids and values the list of talks starting in the interval [start, end),
+    for series that are not private.
+    """
+    seminars = all_seminars()
+    talks = defaultdict(list)
+    query = {"start_time": {"$gte": start, "$lt": end}, "hidden": {"$or": [False, {"$exists": False}]}, "seminar_ctr": {"$gt": 0}}
+    for talk in talks_search(query, sort=["start_time"], seminar_dict=seminars):
+        if talk.display and talk.seminar.visibility:
+            talks[talk.seminar_id].append(talk)
+    return talks
+
+
+def subscribed_users(series_ids, emails=None):
+    """
+    Iterates over the users with confirmed email subscribed to any of the given series (or talks in them).
+
+    If ``emails`` is given, only those users are included.
+    """
+    query = SQL(
+        "SELECT {0}, {1}, {2}, {3}, {4} FROM {5} WHERE {6} AND ({3} && %s OR {4} ?| %s)"
+    ).format(*map(IdentifierWrapper, ["email", "name", "timezone", "seminar_subscriptions", "talk_subscriptions", "users", "email_confirmed"]))
+    values = [series_ids, series_ids]
+    if emails is not None:
+        query = query + SQL(" AND lower({0}) = ANY(%s)").format(IdentifierWrapper("email"))
+        values.append([email.lower() for email in emails])
+    for email, name, timezone, seminar_subs, talk_subs in db._execute(query, values):
+        yield {"email": email,
+               "name": name,
+               "timezone": timezone,
+               "seminar_subscriptions": seminar_subs or [],
+               "talk_subscriptions": talk_subs or {}}
+
+
+def agenda(user, talks):
+    """
+    The talks among ``talks`` (as returned by ``upcoming_talks``) favorited by the user, sorted by start time.
+    """
+    ans = []
+    for series_id in user["seminar_subscriptions"]:
+        ans.extend(talks.get(series_id, []))
+    for series_id, ctrs in user["talk_subscriptions"].items():
+        if series_id not in user["seminar_subscriptions"]:
+            ans.extend(talk for talk in talks.get(series_id, []) if talk.seminar_ctr in ctrs)
+    ans.sort(key=lambda talk: talk.start_time)
+    return ans
+
+
+def build_digests(start=None, emails=None):
+    """
+    Returns a list of messages suitable for ``seminars.mailqueue.deliver``, one for each user with
+    favorited talks in the 24 hours after ``start`` (now by default).
+
+    Must be called in a request context (for url_for).
+    """
+    from html2text import html2text
+    from seminars.app import app
+
+    if start is None:
+        start = datetime.now(pytz.UTC)
+    talks = upcoming_talks(start, start + timedelta(days=1))
+    if not talks:
+        return []
+    template = app.jinja_env.get_template("digest_email.html")
+    # Most of the content of the emails is shared between users, so we compute it once per talk
+    links = {}
+    for series_talks in talks.values():
+        for talk in series_talks:
+            links[talk.seminar_id, talk.seminar_ctr] = {
+                "url": url_for("show_talk", seminar_id=talk.seminar_id, talkid=talk.seminar_ctr, _external=True, _scheme="https"),
+                "title": talk.show_title(),
+                "speaker": talk.show_speaker(raw=True),
+                "series": talk.seminar.name,
+            }
+    times = {}
+    tzs = {}
+    site = {"domain": url_for("index", _external=True, _scheme="https"), "topdomain": topdomain()}
+    messages = []
+    for user in subscribed_users(list(talks), emails):
+        user_talks = agenda(user, talks)
+        if not user_talks:
+            continue
+        tzname = user["timezone"] or "UTC"
+        if tzname not in tzs:
+            try:
+                tzs[tzname] = pytz.timezone(tzname)
+            except pytz.UnknownTimeZoneError:
+                tzs[tzname] = pytz.UTC
+        tz = tzs[tzname]
+        items = []
+        for talk in user_talks:
+            key = talk.seminar_id, talk.seminar_ctr
+            if (key, tzname) not in times:
+                times[key, tzname] = talk.show_time_and_duration(tz=tz)
+            item = dict(links[key])
+            item["time"] = times[key, tzname]
+            items.append(item)
+        html = template.render(name=user["name"], timezone=tz.zone, talks=items, **site)
+        messages.append({
+            "to": user["email"],
+            "subject": "Your talks on %s" % topdomain(),
+            "html": html,
+            "body": html2text(html),
+            "sender": DIGEST_SENDER,
+        })
+    return messages
+
+
+def send_digests(dry_run=False, emails=None, rate=20, connections=4, base_url="https://researchseminars.org"):
+    """
+    Builds and sends the daily digest.
+
+    INPUT:
+
+    - ``dry_run`` -- if True, build the emails but don't send them
+    - ``emails`` -- if given, only send to these users
+    - ``rate`` -- the maximum number of emails to send per second, in total
+    - ``connections`` -- the number of SMTP connections to use concurrently
+    - ``base_url`` -- used to construct the links in the emails
+
+    OUTPUT:
+
+    A dictionary of statistics.
+    """
+    from seminars.website import app
+
+    t0 = time.time()
+    with app.test_request_context(base_url=base_url):
+        messages = build_digests(emails=emails)
+    stats = {"messages": len(messages), "build_time": time.time() - t0, "errors": 0}
+    if dry_run or not messages:
+        if messages:
+            stats["sample"] = messages[0]
+        return stats
+    t0 = time.time()
+    # Deal the messages out to the connections
+    chunks = [messages[i::connections] for i in range(connections)]
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        results = executor.map(lambda chunk: deliver(chunk, rate=rate / connections), chunks)
+        for chunk, errors in zip(chunks, results):
+            for msg, error in zip(chunk, errors):
+                if error is not None:
+                    app.logger.error("Unable to send digest to %s: %s" % (msg["to"], error.description))
+                    stats["errors"] += 1
+    stats["send_time"] = time.time() - t0
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Send the daily digest of favorited talks")
+    parser.add_argument("--dry-run", action="store_true", help="build the emails without sending them")
+    parser.add_argument("--email", action="append", dest="emails", help="only send to this user (can be repeated)")
+    parser.add_argument("--rate", type=float, default=20, help="maximum emails per second (default 20)")
+    parser.add_argument("--connections", type=int, default=4, help="number of SMTP connections (default 4)")
+    args = parser.parse_args()
+    stats = send_digests(dry_run=args.dry_run, emails=args.emails, rate=args.rate, connections=args.connections)
+    sample = stats.pop("sample", None)
+    for key, val in sorted(stats.items()):
+        print("%s: %s" % (key, val))
+    if sample is not None:
+        print("\nSample email to %s:\n\n%s" % (sample["to"], sample["body"]))
@@ -1,12 +1,15 @@
 from seminars.app import app
 from seminars import db
-from seminars.talk import talks_search, talks_lucky, talks_lookup, WebTalk
+from seminars.cache import LRUCache
+from seminars.talk import talks_search, talks_lucky, talks_lookup, WebTalk, TalkRow
 from seminars.utils import (
     Toggle,
     ics_file,
+    domain,
     topdomain,
     maxlength,
     adapt_datetime,
+    preconvert_times,
     date_and_daytime_to_time,
     date_and_daytimes_to_times,
     process_user_input,
@@ -16,9 +19,11 @@ from seminars.topic import topic_dag
 from seminars.language import languages
 from seminars.institution import institutions, WebInstitution
 from seminars.knowls import static_knowl
+from seminars.pagecache import cached_page
 from flask import abort, render_template, request, redirect, url_for, Response, make_response
 from seminars.seminar import seminars_search, all_seminars, all_organizers, seminars_lucky, next_talk_sorted, series_sorted, audience_options
 from flask_login import current_user
+import hashlib
 import json
 from datetime import datetime, timedelta
 import pytz
@@ -378,6 +383,7 @@ class SeriesSearchArray(SemSearchArray):
         self.conference = conference
 
 @app.route("/", methods=["GET"])
+@cached_page
 def index():
     if request.args.get("submit"):
         x = request.args["submit"].strip().split(' ')
@@ -387,14 +393,17 @@ def index():
     return _talks_index(subsection="talks")
 
 @app.route("/talks")
+@cached_page
 def talks_index():
     return _talks_index(subsection="talks")
 
 @app.route("/conferences")
+@cached_page
 def conferences_index():
     return _series_index({"is_conference": True}, subsection="conferences", conference=True)
 
 @app.route("/seminar_series")
+@cached_page
 def seminar_series_index():
     return _series_index({"is_conference": False}, subsection="seminar_series", conference=False)
 
@@ -469,7 +478,7 @@ def _get_row_attributes(objects):
     visible_counter = 0
     for obj in objects:
         classes, filtered = filter_classes(obj)
-        if isinstance(obj, WebTalk) and obj.blackout_date() and obj.rescheduled():
+        if isinstance(obj, (WebTalk, TalkRow)) and obj.rescheduled() and obj.blackout_date():
             classes.append("blm")
         style = ""
         if filtered:
@@ -524,9 +533,11 @@ def _talks_index(query={}, sort=None, subsection=None, past=False, keywords=""):
         query["end_time"] = {"$gte": datetime.now(pytz.UTC)}
         if sort is None:
             sort = ["start_time", "seminar_id"]
-    talks = list(talks_search(query, sort=sort, seminar_dict=all_seminars(), more=more))
+    talks = list(talks_search(query, sort=sort, seminar_dict=all_seminars(rows=True), more=more, rows=True))
     # Filtering on display and hidden isn't sufficient since the seminar could be private
     talks = [talk for talk in talks if talk.searchable()]
+    # Convert the times into the user's time zone once, rather than in each display method
+    preconvert_times(talks)
     # While we may be able to write a query specifying inequalities on the timestamp in the user's timezone, it's not easily supported by talks_search.  So we filter afterward
     timerange = info.get("timerange", "").strip()
     if timerange:
@@ -589,13 +600,15 @@ def _series_index(query, sort=None, subsection=None, conference=True, past=False
     org_query, more = {}, {}
     # we will be selecting talks satsifying the query and recording whether they satisfy the "more" query
     seminars_parser(info, more, org_query)
-    results = list(seminars_search(kw_query, organizer_dict=all_organizers(org_query), more=more))
+    results = list(seminars_search(kw_query, organizer_dict=all_organizers(org_query), more=more, rows=True))
     if info.get("keywords", ""):
         parse_substring(info, org_query, "keywords", organizers_keyword_columns())
-        results += list(seminars_search(query, organizer_dict=all_organizers(org_query), more=more))
+        results += list(seminars_search(query, organizer_dict=all_organizers(org_query), more=more, rows=True))
         unique = {s.shortname:s for s in results}
         results = [unique[key] for key in unique]
     series = series_sorted(results, conference=conference, reverse=past)
+    if not conference:
+        preconvert_times(series, cols=("next_talk_time",))
     counters = _get_counters(series)
     row_attributes = _get_row_attributes(series)
     response = make_response(render_template(
@@ -631,6 +644,7 @@ def list_institutions():
 
 
 @app.route("/seminar/<shortname>")
+@cached_page
 def show_seminar(shortname):
     # We need organizers to be able to see seminars with display=False
     seminar = seminars_lucky({"shortname": shortname})
@@ -808,6 +822,7 @@ def ics_talk_file(seminar_id, talkid):
 
 
 @app.route("/talk/<seminar_id>/<int:talkid>/")
+@cached_page
 def show_talk(seminar_id, talkid):
     token = request.args.get("token", "")  # save the token so user can toggle between view and edit
     talk = talks_lucky({"seminar_id": seminar_id, "seminar_ctr": talkid})
@@ -868,15 +883,31 @@ def register_for_talk(seminar_id, talkid):
         return redirect(url_for('show_talk',seminar_id=seminar_id,talkid=talkid))
 
 
+# Talk knowls as seen by anonymous users, which only depend on the time zone.  They include
+# relative times ("starts in 5 minutes") and access links that open shortly before the talk,
+# so entries are only kept for a minute.
+title_knowl_cache = LRUCache("title_knowl", maxsize=2000, ttl=60)
+
 # We allow async queries for title knowls
+# These are loaded when a talk title in a listing is hovered over or clicked (see knowl.js)
 @app.route("/knowl/talk/<series_id>/<int:series_ctr>")
 def title_knowl(series_id, series_ctr, **kwds):
-    talk = talks_lookup(series_id, series_ctr)
-    if talk is None:
-        return render_template("404_content.html"), 404
-    else:
+    key = (series_id, series_ctr, str(current_user.tz), domain()) if current_user.is_anonymous else None
+    body = None if key is None else title_knowl_cache.get(key)
+    if body is None:
+        talk = talks_lookup(series_id, series_ctr)
+        if talk is None:
+            return render_template("404_content.html"), 404
         # tz = None, uses the users timezone
-        return render_template("talk-knowl.html", talk=talk, tz=None)
+        body = render_template("talk-knowl.html", talk=talk, tz=None)
+        if key is not None:
+            title_knowl_cache.set(key, body)
+    response = make_response(body)
+    response.set_etag(hashlib.sha1(body.encode()).hexdigest())
+    # Lets the click that follows a prefetch on hover reuse the response; the content depends on the user
+    response.headers["Cache-Control"] = "private, max-age=60"
+    response.headers["Vary"] = "Cookie"
+    return response.make_conditional(request)
 
 
 @app.route("/institution/<shortname>/")
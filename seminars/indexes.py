@@ -0,0 +1,190 @@
+"""
+The indexes that our queries rely on.
+
+``INDEXES`` declares the indexes we expect on each table, and why.  Running::
+
+    python -m seminars.indexes
+
+compares them with the indexes in the database (including invalid ones, left behind by an
+interrupted concurrent build), and with ``--apply`` creates the missing ones using
+``CREATE INDEX CONCURRENTLY``, so that the tables stay writable while the indexes are built.
+
+Keep in mind how our versioned searches work: the selecters in talk.py and seminar.py first find
+the most recent version of each talk or series with ``DISTINCT ON``, and only then apply the
+rest of the query.  Postgres can push conditions on the ``DISTINCT ON`` columns (``seminar_id``,
+``seminar_ctr``, ``shortname``) into the inner query, where they can use the composite indexes
+below; other conditions, such as those on ``start_time`` or ``topics``, are checked afterwards and
+mainly benefit direct queries on the tables (``db.talks.search``, updates and the like).
+
+Note that reloading a table (as in ``seminars.benchmark``) only restores the indexes recorded by
+the LMFDB backend, so run this again afterwards.
+
+To measure the effect on the selecters::
+
+    python -m seminars.benchmark selecters --output before.json
+    python -m seminars.indexes --apply
+    python -m seminars.benchmark selecters --output after.json
+    python -m seminars.benchmark compare before.json after.json
+"""
+import re
+from collections import namedtuple
+from psycopg2.sql import SQL, Identifier
+from seminars import db
+
+Index = namedtuple("Index", ["table", "name", "definition", "reason", "schema", "extension"])
+
+
+def _index(table, name, definition, reason, schema="public", extension=None):
+    return Index(table, name, definition, reason, schema, extension)
+
+
+INDEXES = [
+    _index("talks", "talks_seminar_id_seminar_ctr_id", "btree (seminar_id, seminar_ctr, id DESC)",
+           "the DISTINCT ON ordering in talks selecters, and lookups of talks by series"),
+    _index("talks", "talks_start_time_live", "btree (start_time) WHERE (deleted = false)",
+           "direct queries for talks in a time range, such as the digest and bulk updates"),
+    _index("talks", "talks_end_time_live", "btree (end_time) WHERE (deleted = false)",
+           "direct queries for talks that have not yet ended"),
+    _index("talks", "talks_topics", "gin (topics)",
+           "topic containment queries made directly on the table"),
+    _index("seminars", "seminars_shortname_id", "btree (shortname, id DESC)",
+           "the DISTINCT ON ordering in seminars selecters and the public series check in talks searches"),
+    _index("seminars", "seminars_topics", "gin (topics)",
+           "topic containment queries made directly on the table"),
+    _index("seminars", "seminars_institutions", "gin (institutions)",
+           "institution pages and institution containment queries"),
+    _index("seminars", "seminars_owner_trgm", "gin (owner gin_trgm_ops)",
+           "owner ILIKE queries, used when endorsing users and changing email addresses",
+           extension="pg_trgm"),
+    _index("seminar_organizers", "seminar_organizers_seminar_id", "btree (seminar_id)",
+           "the organizers of a series"),
+    _index("seminar_organizers", "seminar_organizers_email_trgm", "gin (email gin_trgm_ops)",
+           "email ILIKE queries, used to find the series a user organizes",
+           extension="pg_trgm"),
+    _index("talk_registrations", "talk_registrations_seminar_id_seminar_ctr", "btree (seminar_id, seminar_ctr)",
+           "the registrations for a talk"),
+    _index("talk_registrations", "talk_registrations_user_id", "btree (user_id)",
+           "the talks a user has registered for, fetched once per request for listings"),
+    _index("seminar_registrations", "seminar_registrations_email", "btree (email)",
+           "the series a user's email is registered for, fetched once per request for listings"),
+    _index("users", "users_email_trgm", "gin (email gin_trgm_ops)",
+           "email ILIKE lookups of users",
+           schema="userdb", extension="pg_trgm"),
+]
+
+
+def _normalize(definition):
+    # Reduces the output of pg_get_indexdef to the part after USING, for comparison
+    definition = definition.split(" USING ", 1)[-1]
+    return re.sub(r"\s+", " ", definition).strip().lower()
+
+
+def existing_indexes(tables=None):
+    """
+    Returns a dictionary, with keys pairs (schema, table) and values lists of dictionaries
+    with keys ``name``, ``definition`` and ``valid`` describing the indexes on that table.
+    """
+    if tables is None:
+        tables = sorted(set(index.table for index in INDEXES))
+    cur = db._execute(SQL(
+        "SELECT n.nspname, t.relname, c.relname, pg_get_indexdef(i.indexrelid), i.indisvalid "
+        "FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_class t ON t.oid = i.indrelid "
+        "JOIN pg_namespace n ON n.oid = t.relnamespace WHERE t.relname = ANY(%s) ORDER BY c.relname"
+    ), [tables])
+    ans = {}
+    for schema, table, name, definition, valid in cur:
+        ans.setdefault((schema, table), []).append({"name": name, "definition": definition, "valid": valid})
+    return ans
+
+
+def available_extensions():
+    return set(rec[0] for rec in db._execute(SQL("SELECT extname FROM pg_extension")))
+
+
+def diff():
+    """
+    Compares the declared indexes with the database.
+
+    OUTPUT:
+
+    A dictionary with keys
+
+    - ``missing`` -- declared indexes that don't exist (or only exist as invalid indexes)
+    - ``invalid`` -- pairs (schema, name) for invalid indexes, which should be dropped and rebuilt
+    - ``present`` -- pairs (declared index, name of the matching index in the database)
+    - ``undeclared`` -- indexes in the database on our tables that match no declaration
+    - ``unavailable`` -- declared indexes whose extension isn't installed
+    """
+    existing = existing_indexes()
+    extensions = available_extensions()
+    ans = {"missing": [], "invalid": [], "present": [], "undeclared": [], "unavailable": []}
+    matched = set()
+    for index in INDEXES:
+        found = None
+        for rec in existing.get((index.schema, index.table), []):
+            if rec["name"] == index.name or _normalize(rec["definition"]) == _normalize(index.definition):
+                if rec["valid"]:
+                    found = rec["name"]
+                elif (index.schema, rec["name"]) not in ans["invalid"]:
+                    ans["invalid"].append((index.schema, rec["name"]))
+                matched.add((index.schema, rec["name"]))
+        if found:
+            ans["present"].append((index, found))
+        elif index.extension and index.extension not in extensions:
+            ans["unavailable"].append(index)
+        else:
+            ans["missing"].append(index)
+    for (schema, table), recs in existing.items():
+        for rec in recs:
+            if (schema, rec["name"]) not in matched:
+                ans["undeclared"].append((schema, table, rec["name"], rec["definition"]))
+    return ans
+
+
+def apply(indexes, drop_invalid=(), verbose=True):
+    """
+    Drops the given invalid indexes (pairs (schema, name)) and creates the given indexes, concurrently.
+
+    This uses its own connection, in autocommit mode and without a statement timeout, since
+    concurrent index builds can't run inside a transaction and may take a while.
+    """
+    conn = db._new_connection()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SET statement_timeout = 0")
+            for schema, name in drop_invalid:
+                if verbose:
+                    print("Dropping invalid index %s.%s" % (schema, name))
+                cur.execute(SQL("DROP INDEX CONCURRENTLY IF EXISTS {0}.{1}").format(Identifier(schema), Identifier(name)))
+            for index in indexes:
+                if verbose:
+                    print("Creating %s on %s (%s)..." % (index.name, index.table, index.definition))
+                cur.execute(SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {0} ON {1}.{2} USING " + index.definition).format(
+                    Identifier(index.name), Identifier(index.schema), Identifier(index.table)))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare the declared indexes with the database, and create missing ones")
+    parser.add_argument("--apply", action="store_true", help="create missing indexes and rebuild invalid ones")
+    parser.add_argument("--undeclared", action="store_true", help="also list indexes that aren't declared")
+    args = parser.parse_args()
+    result = diff()
+    for index, name in result["present"]:
+        print("present:     %s.%s (%s)" % (index.table, name, index.definition))
+    for schema, name in result["invalid"]:
+        print("invalid:     %s.%s" % (schema, name))
+    for index in result["unavailable"]:
+        print("unavailable: %s.%s needs the %s extension (CREATE EXTENSION %s)" % (index.table, index.name, index.extension, index.extension))
+    for index in result["missing"]:
+        print("missing:     %s.%s (%s), for %s" % (index.table, index.name, index.definition, index.reason))
+    if args.undeclared:
+        for schema, table, name, definition in result["undeclared"]:
+            print("undeclared:  %s" % definition)
+    if args.apply:
+        # Invalid versions of declared indexes are listed as missing, so they are rebuilt
+        apply(result["missing"], drop_invalid=result["invalid"])
@@ -3,10 +3,15 @@ from flask_login import current_user
 from seminars import db
 from seminars.utils import allowed_shortname
 from seminars.users.pwdmanager import userdb
+from seminars.cache import LRUCache
+from seminars.localstore import data_versions
 from lmfdb.utils import flash_error
 from collections.abc import Iterable
 from lmfdb.logger import critical
+import hashlib
+import json
 import pytz
+import time
 from datetime import datetime
 
 institution_types = [
@@ -27,6 +32,28 @@ def institutions(query={}):
     )
 
 
+# The institution list served by the API, keyed by data version; the ttl covers changes made directly to the database
+_institutions_json = LRUCache("institutions_json", maxsize=1, ttl=3600)
+
+
+def institutions_json():
+    """
+    Returns a json serialization of the public data on all institutions, together with a hash of it.
+
+    The result is cached in each process until an institution is saved.
+    """
+    version = data_versions.get("institutions", 0)
+    result = _institutions_json.get(version)
+    if result is None:
+        keys = ["name", "city", "timezone", "type", "homepage"]
+        data = {rec["shortname"]: {key: rec[key] for key in keys}
+                for rec in db.institutions.search({}, ["shortname"] + keys)}
+        body = json.dumps(data, sort_keys=True)
+        result = body, hashlib.sha1(body.encode()).hexdigest()
+        _institutions_json.set(version, result)
+    return result
+
+
 def clean_institutions(inp):
     if inp is None:
         return []
@@ -104,6 +131,7 @@ class WebInstitution(object):
         else:
             assert data.get("shortname")
             db.institutions.upsert({"shortname": self.shortname}, data)
+        data_versions.set("institutions", time.time())
 
     def admin_link(self):
         rec = userdb.lookup(self.admin)
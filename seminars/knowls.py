@@ -1,32 +1,47 @@
 # To edit knowls, edit the knowls.yaml file
 
 import os, yaml
+from functools import lru_cache
 from markupsafe import Markup
-from flask import render_template
+from flask import current_app
 
 
+# Since we only load the knowls from disk once (on first use), note that you must restart the server when you update the knowl file
+@lru_cache(maxsize=None)
 def load_knowls():
     _curdir = os.path.dirname(os.path.abspath(__file__))
     with open(os.path.join(_curdir, "knowls.yaml")) as F:
         return yaml.load(F, Loader=yaml.FullLoader)
 
 
-# Since we load the knowls from disk on import, note that you must restart the server when you update the knowl file
-knowldb = load_knowls()
+@lru_cache(maxsize=None)
+def compiled_knowl(name):
+    """
+    The default title and the escaped html content of a static knowl (or None if there is no such knowl),
+    rendered once since they only depend on the knowl file.
+    """
+    knowl = load_knowls().get(name)
+    if knowl is None:
+        return None
+    knowl = dict(knowl, contents=Markup(knowl.get("contents", "")))
+    content = current_app.jinja_env.get_template("static-knowl.html").render(knowl=knowl)
+    return knowl.get("title", ""), Markup.escape(content)
+
+
+def compile_knowls():
+    for name in load_knowls():
+        compiled_knowl(name)
 
 
 def static_knowl(name, title=None):
-    knowl = knowldb.get(name)
-    if knowl is None:
+    compiled = compiled_knowl(name)
+    if compiled is None:
         if title is None:
             return ""
         else:
             return title
     if title is None:
-        title = knowl.get("title", "")
-    knowl["contents"]=Markup(knowl.get("contents",""))
+        title = compiled[0]
     return r'<a title="{title}" knowl="dynamic_show" kwargs="{content}">{title}</a>'.format(
-        title=title, content=Markup.escape(render_template("static-knowl.html", knowl=knowl))
+        title=title, content=compiled[1]
     )
-
-
@@ -1,22 +1,30 @@
-import iso639
 from seminars import db
 from seminars.toggle import toggle
 from seminars.utils import num_columns
 from flask import request
 
 class Languages(object):
+    # The language names are loaded on first use, rather than when each worker starts
     def __init__(self):
-        def simplify_language_name(name):
-            name = name.split(";")[0]
-            if "(" in name:
-                name = name[: name.find("(") - 1]
-            return name
+        self._names = None
 
-        self._data = {
-            lang["iso639_1"]: simplify_language_name(lang["name"])
-            for lang in iso639.data
-            if lang["iso639_1"]
-        }
+    @property
+    def _data(self):
+        if self._names is None:
+            import iso639
+
+            def simplify_language_name(name):
+                name = name.split(";")[0]
+                if "(" in name:
+                    name = name[: name.find("(") - 1]
+                return name
+
+            self._names = {
+                lang["iso639_1"]: simplify_language_name(lang["name"])
+                for lang in iso639.data
+                if lang["iso639_1"]
+            }
+        return self._names
 
     def show(self, code):
         return self._data.get(code, "Unknown language")
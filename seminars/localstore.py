@@ -0,0 +1,189 @@
+"""
+Data shared between the worker processes on one machine.
+
+Gunicorn runs many worker processes, each with its own memory.  State that they need to
+agree on (rate limiting counters, invalidation markers) is kept in small SQLite files in a
+local folder, which is much cheaper to reach than the database server.
+"""
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from threading import RLock
+from lmfdb.logger import critical
+
+
+def local_folder(*path):
+    """
+    Returns (creating it if necessary) a folder for files shared by the processes on this machine.
+
+    The location can be set with the SEMINARS_LOCAL_FOLDER environment variable.  By default it is
+    a folder in the system temporary directory, distinct for each checkout of the code, so that the
+    live and test sites running on the same machine do not share data.
+    """
+    folder = os.environ.get("SEMINARS_LOCAL_FOLDER")
+    if not folder:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        folder = os.path.join(tempfile.gettempdir(), "seminars-" + hashlib.md5(root.encode()).hexdigest()[:8])
+    folder = os.path.join(folder, *path)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def pid_alive(pid):
+    """
+    Whether there is a process with the given pid on this machine.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class LocalStore(object):
+    """
+    A key-value store backed by a SQLite file in ``local_folder()``.
+
+    Keys are strings and values are json-serializable.  Entries can be given a time to live,
+    after which they are treated as missing.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._conn = None
+        self._pid = None
+        self._lock = RLock()
+
+    def _connect(self):
+        # SQLite connections must not be shared with forked children
+        if self._conn is None or self._pid != os.getpid():
+            filename = os.path.join(local_folder(), self.name + ".sqlite")
+            conn = sqlite3.connect(filename, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _get(self, conn, key, default):
+        row = conn.execute("SELECT value, expires FROM store WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return default
+        return json.loads(row[0])
+
+    def _set(self, conn, key, value, ttl):
+        expires = None if ttl is None else time.time() + ttl
+        conn.execute("INSERT OR REPLACE INTO store (key, value, expires) VALUES (?, ?, ?)", (key, json.dumps(value), expires))
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM store WHERE expires < ?", (time.time(),))
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._get(self._connect(), key, default)
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(self._connect(), key, value, ttl)
+
+    def items(self):
+        """
+        Returns a list of the pairs (key, value) stored.
+        """
+        with self._lock:
+            rows = self._connect().execute("SELECT key, value FROM store WHERE expires IS NULL OR expires >= ?", (time.time(),)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def delete(self, key):
+        with self._lock:
+            self._connect().execute("DELETE FROM store WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute("DELETE FROM store")
+
+    def update(self, key, func, default=None, ttl=None):
+        """
+        Atomically replaces the value ``v`` stored at ``key`` by ``func(v)``, returning the new value.
+
+        ``default`` is passed to ``func`` if there is no value stored.
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                value = func(self._get(conn, key, default))
+                self._set(conn, key, value, ttl)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return value
+
+
+class TokenBucket(object):
+    """
+    A rate limiter shared between processes.
+
+    Each key has a bucket holding up to ``capacity`` tokens, refilled at ``rate`` tokens per second;
+    every event takes one token.
+    """
+
+    def __init__(self, name, capacity, rate):
+        self.store = LocalStore(name)
+        self.capacity = capacity
+        self.rate = rate
+
+    def _tokens(self, state, now):
+        if state is None:
+            return self.capacity
+        return min(self.capacity, state[0] + (now - state[1]) * self.rate)
+
+    def wait(self, key):
+        """
+        Returns 0 if an event for the given key would be allowed, and otherwise the number of seconds
+        until it would be, without recording an event.
+        """
+        try:
+            tokens = self._tokens(self.store.get(key), time.time())
+        except sqlite3.Error as err:
+            critical("Rate limiter %s failed: %s" % (self.store.name, err))
+            return 0
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, key):
+        """
+        Records an event for the given key.
+
+        Returns 0 if the event is allowed, and otherwise the number of seconds until it would be.
+        """
+        wait = [0]
+
+        def refill(state):
+            now = time.time()
+            tokens = self._tokens(state, now)
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait[0] = (1 - tokens) / self.rate
+            return [tokens, now]
+
+        try:
+            # Once the bucket would be full again there's no need to store it
+            self.store.update(key, refill, ttl=self.capacity / self.rate)
+        except sqlite3.Error as err:
+            # Don't turn away requests because of a problem with the local file
+            critical("Rate limiter %s failed: %s" % (self.store.name, err))
+            return 0
+        return wait[0]
+
+
+# The times at which shared data (such as the list of institutions) last changed,
+# used to invalidate caches held by each process
+data_versions = LocalStore("data_versions")
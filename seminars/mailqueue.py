@@ -0,0 +1,342 @@
+"""
+Outbound email.
+
+Requests don't talk to the mail server: ``send_email`` writes the message to a spool folder
+(see ``seminars.localstore.local_folder``) and wakes a background thread, which sends queued
+messages in batches over a single SMTP connection.  Messages that fail are retried with
+exponential backoff, and moved to the ``failed`` folder after ``MAX_ATTEMPTS`` attempts, or at once
+if the server rejects them permanently (a 5xx reply, such as an unknown recipient).
+
+Every worker starts its sender thread when it starts (see configfiles/gunicorn-config-*), so that
+retries are sent even when no new email is queued.  Any worker's thread may send any queued message,
+and the threads regularly put back in the queue the messages claimed by a process that died.  You can
+also send everything queued from the command line::
+
+    python -m seminars.mailqueue --flush
+
+For testing, ``LocalSMTPServer`` accepts mail without delivering it.  Run it with::
+
+    python -m seminars.mailqueue --standin 8025
+
+and start the site with ``SEMINARS_MAIL_SERVER=localhost SEMINARS_MAIL_PORT=8025 SEMINARS_MAIL_SSL=0``.
+"""
+import json
+import os
+import smtplib
+import socketserver
+import threading
+import time
+from collections import namedtuple
+from uuid import uuid4
+from lmfdb.logger import critical
+from seminars.localstore import local_folder, pid_alive
+
+MAX_ATTEMPTS = 8
+# Delay before the first retry, doubled for each subsequent attempt
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+BATCH_SIZE = 50
+POLL_INTERVAL = 10
+# How often to look for messages claimed by processes that died
+RECOVER_INTERVAL = 60
+
+
+# Why a message wasn't sent, and whether the server's refusal was permanent (so not worth retrying)
+SendError = namedtuple("SendError", ["description", "permanent"])
+
+
+def _permanent(err):
+    # SMTP replies in the 500s are permanent failures, those in the 400s temporary ones
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return bool(err.recipients) and all(code >= 500 for (code, resp) in err.recipients.values())
+    if isinstance(err, smtplib.SMTPResponseException):
+        return err.smtp_code >= 500
+    return False
+
+
+def _folder(name):
+    return local_folder("mail", name)
+
+
+def _write(msg, when):
+    # File names start with the time the message is due, so that sorting them gives the sending order
+    name = "%013d-%s.json" % (int(when * 1000), uuid4().hex)
+    tmp = os.path.join(_folder("tmp"), name)
+    with open(tmp, "w") as F:
+        json.dump(msg, F)
+    # Renaming is atomic, so other processes never see a partially written message
+    os.rename(tmp, os.path.join(_folder("queue"), name))
+
+
+def enqueue(to, subject, html, sender):
+    """
+    Adds an email to the queue and wakes up the sender thread.
+    """
+    from html2text import html2text
+
+    msg = {
+        "to": to,
+        "subject": subject,
+        "html": html,
+        "body": html2text(html),  # a plain text version of our email
+        "sender": sender,
+        "attempts": 0,
+        "queued_at": time.time(),
+    }
+    _write(msg, time.time())
+    start_sender()
+    _wakeup.set()
+
+
+def deliver(messages, rate=None, per_connection=100):
+    """
+    Sends messages, reusing SMTP connections.
+
+    INPUT:
+
+    - ``messages`` -- a list of dictionaries with keys ``to``, ``subject``, ``html``, ``body`` and ``sender``
+    - ``rate`` -- if given, the maximum number of messages to send per second
+    - ``per_connection`` -- the number of messages to send before reconnecting
+
+    OUTPUT:
+
+    A list with an entry for each message: None if it was sent, and otherwise a ``SendError``.
+    """
+    from flask_mail import Message
+    from seminars.app import app, mail
+
+    errors = [None] * len(messages)
+    i = 0
+    with app.app_context():
+        while i < len(messages):
+            try:
+                with mail.connect() as conn:
+                    for msg in messages[i:i + per_connection]:
+                        started = time.time()
+                        try:
+                            conn.send(
+                                Message(
+                                    subject=msg["subject"],
+                                    html=msg["html"],
+                                    body=msg["body"],
+                                    sender=msg["sender"],
+                                    recipients=[msg["to"]],
+                                )
+                            )
+                        except smtplib.SMTPServerDisconnected:
+                            raise
+                        except smtplib.SMTPException as err:
+                            # A problem with this message, such as a refused recipient
+                            errors[i] = SendError(str(err), _permanent(err))
+                        i += 1
+                        if rate:
+                            time.sleep(max(0, 1 / rate - (time.time() - started)))
+            except (OSError, smtplib.SMTPException) as err:
+                # We can't reach the server, so give up on the remaining messages for now
+                for j in range(i, len(messages)):
+                    errors[j] = SendError(str(err), False)
+                break
+    return errors
+
+
+def _claim(limit):
+    # Move due messages to the sending folder, prefixed by our pid
+    queue, sending = _folder("queue"), _folder("sending")
+    now = int(time.time() * 1000)
+    claimed = []
+    for name in sorted(os.listdir(queue)):
+        if len(claimed) >= limit or int(name.split("-")[0]) > now:
+            break
+        path = os.path.join(sending, "%s-%s" % (os.getpid(), name))
+        try:
+            os.rename(os.path.join(queue, name), path)
+        except FileNotFoundError:
+            # claimed by another process
+            continue
+        claimed.append(path)
+    return claimed
+
+
+def recover():
+    """
+    Returns messages claimed by processes that no longer exist to the queue.
+    """
+    queue, sending = _folder("queue"), _folder("sending")
+    for name in os.listdir(sending):
+        pid, queued_name = name.split("-", 1)
+        if not pid_alive(int(pid)):
+            try:
+                os.rename(os.path.join(sending, name), os.path.join(queue, queued_name))
+            except FileNotFoundError:
+                pass
+
+
+def _retry(path, msg, error):
+    msg["attempts"] += 1
+    msg["error"] = error.description
+    if error.permanent or msg["attempts"] >= MAX_ATTEMPTS:
+        critical("Giving up on email to %s (%s) after %s attempts: %s" % (msg["to"], msg["subject"], msg["attempts"], error.description))
+        # Record the last error in the failed message
+        with open(path, "w") as F:
+            json.dump(msg, F)
+        os.rename(path, os.path.join(_folder("failed"), os.path.basename(path)))
+    else:
+        delay = min(RETRY_DELAY * 2 ** (msg["attempts"] - 1), MAX_RETRY_DELAY)
+        _write(msg, time.time() + delay)
+        os.remove(path)
+
+
+def send_queued(limit=BATCH_SIZE):
+    """
+    Sends up to ``limit`` queued messages that are due, returning the number of messages attempted.
+    """
+    paths = _claim(limit)
+    messages = []
+    for path in paths:
+        with open(path) as F:
+            messages.append(json.load(F))
+    if messages:
+        errors = deliver(messages)
+        for path, msg, error in zip(paths, messages, errors):
+            if error is None:
+                os.remove(path)
+            else:
+                _retry(path, msg, error)
+    return len(messages)
+
+
+_wakeup = threading.Event()
+_sender = None
+
+
+def _run_sender():
+    last_recovered = 0
+    while True:
+        try:
+            if time.time() - last_recovered > RECOVER_INTERVAL:
+                last_recovered = time.time()
+                recover()
+            while send_queued():
+                pass
+        except Exception as err:
+            critical("Error sending queued email: %s" % err)
+        _wakeup.wait(POLL_INTERVAL)
+        _wakeup.clear()
+
+
+def start_sender():
+    """
+    Starts the background thread sending queued email in this process, if it's not already running.
+    """
+    global _sender
+    if _sender is None or not _sender.is_alive():
+        _sender = threading.Thread(target=_run_sender, name="mailqueue", daemon=True)
+        _sender.start()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self.reply("220 localhost SMTP stand-in")
+        sender, recipients = None, []
+        for line in self.rfile:
+            line = line.decode("utf-8", "replace").rstrip("\r\n")
+            verb = line[:4].upper()
+            if verb == "EHLO":
+                self.reply("250-localhost")
+                self.reply("250 AUTH PLAIN")
+            elif verb == "HELO":
+                self.reply("250 localhost")
+            elif verb == "AUTH":
+                self.reply("235 Authentication successful")
+            elif verb == "MAIL":
+                sender, recipients = line.split(":", 1)[1].strip().strip("<>"), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(line.split(":", 1)[1].strip().strip("<>"))
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for dataline in self.rfile:
+                    if dataline in (b".\r\n", b".\n"):
+                        break
+                    if dataline.startswith(b".."):
+                        dataline = dataline[1:]
+                    data.append(dataline)
+                if server.delay:
+                    time.sleep(server.delay)
+                if server.fail:
+                    self.reply("451 Requested action aborted")
+                else:
+                    with server.lock:
+                        server.messages.append({"sender": sender, "recipients": recipients, "data": b"".join(data).decode("utf-8", "replace")})
+                    self.reply("250 OK")
+                sender, recipients = None, []
+            elif verb in ("RSET", "NOOP"):
+                sender, recipients = None, []
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    A minimal SMTP server for testing, which records messages in ``messages`` instead of delivering them.
+
+    Any credentials are accepted.  Set ``delay`` to simulate a slow server (in seconds per message)
+    and ``fail`` to make it reject messages.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, delay=0, fail=False):
+        socketserver.ThreadingTCPServer.__init__(self, ("localhost", port), _SMTPHandler)
+        self.port = self.server_address[1]
+        self.delay = delay
+        self.fail = fail
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="smtp-standin", daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the outbound email queue")
+    parser.add_argument("--flush", action="store_true", help="send all queued messages that are due")
+    parser.add_argument("--standin", type=int, metavar="PORT", help="run a local SMTP stand-in on PORT")
+    args = parser.parse_args()
+    if args.standin is not None:
+        server = LocalSMTPServer(args.standin)
+        print("SMTP stand-in listening on port %s" % server.port)
+        seen = 0
+        server.start()
+        while True:
+            time.sleep(1)
+            with server.lock:
+                for msg in server.messages[seen:]:
+                    print("Message from %s to %s:\n%s\n" % (msg["sender"], ", ".join(msg["recipients"]), msg["data"]))
+                seen = len(server.messages)
+    elif args.flush:
+        recover()
+        total = 0
+        while True:
+            sent = send_queued()
+            if not sent:
+                break
+            total += sent
+        print("Attempted to send %s messages" % total)
+    else:
+        parser.print_help()
@@ -0,0 +1,260 @@
+"""
+Metrics in the Prometheus text format, served at ``/metrics``.
+
+Each gunicorn worker counts its own requests, and every few seconds writes its totals to a file
+in ``local_folder("metrics")``, named by its pid and the time it first wrote (so that a new worker
+reusing the pid of one that exited doesn't overwrite its file).  The ``/metrics`` page adds up the
+files of all workers; the totals of workers that have exited are folded into an archive file, so
+that counters don't go backwards when gunicorn replaces a worker.
+
+The page is only available to admins and from localhost (see ``housekeeping``).
+"""
+import atexit
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from flask import g, request, make_response
+from seminars.app import app
+from seminars.cache import caches
+from seminars.dbpool import pool, replica_pool
+from seminars.localstore import local_folder, pid_alive
+from seminars.sqlstats import request_stats, totals as sql_totals
+from seminars.users.main import housekeeping
+
+FLUSH_INTERVAL = 5
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# name: (type, help)
+METRICS = {
+    "seminars_http_requests_total": ("counter", "Requests, by endpoint, method and status"),
+    "seminars_http_request_duration_seconds": ("histogram", "Time taken to respond, by endpoint"),
+    "seminars_db_queries_total": ("counter", "Database queries made while responding, by endpoint"),
+    "seminars_db_seconds_total": ("counter", "Time spent in database queries while responding, by endpoint"),
+    "seminars_db_all_queries_total": ("counter", "Database queries, including those made outside requests"),
+    "seminars_db_all_seconds_total": ("counter", "Time spent in database queries, including outside requests"),
+    "seminars_cache_hits_total": ("counter", "Cache hits, by cache"),
+    "seminars_cache_misses_total": ("counter", "Cache misses, by cache"),
+    "seminars_cache_entries": ("gauge", "Entries held in each cache"),
+    "seminars_db_pool_checkouts_total": ("counter", "Connections checked out of the pool"),
+    "seminars_db_pool_checkout_wait_seconds_total": ("counter", "Time spent waiting to check out connections"),
+    "seminars_db_pool_opened_total": ("counter", "Connections opened by the pool"),
+    "seminars_db_pool_discarded_total": ("counter", "Connections closed by the pool"),
+    "seminars_db_pool_health_check_failures_total": ("counter", "Idle connections found to be broken"),
+    "seminars_db_pool_connect_failures_total": ("counter", "Failed attempts to connect"),
+    "seminars_db_pool_timeouts_total": ("counter", "Checkouts that timed out waiting for a connection"),
+    "seminars_db_pool_active": ("gauge", "Connections in use"),
+    "seminars_db_pool_idle": ("gauge", "Idle connections in the pool"),
+    "seminars_workers": ("gauge", "Worker processes reporting metrics"),
+}
+
+_lock = threading.Lock()
+# (name, labels) -> value, for the requests served by this process
+_counters = defaultdict(float)
+_last_flush = [0]
+# The name of this process's file: pid and start time, set again after a fork
+_identity = {"pid": None, "name": None}
+
+
+def _key(name, **labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _start_timer():
+    g.metrics_start = time.time()
+
+
+def _record(response):
+    start = g.get("metrics_start")
+    if start is None:
+        return response
+    elapsed = time.time() - start
+    endpoint = request.endpoint or "none"
+    sql = request_stats()
+    with _lock:
+        _counters[_key("seminars_http_requests_total", endpoint=endpoint, method=request.method, status=str(response.status_code))] += 1
+        hist = "seminars_http_request_duration_seconds"
+        for bound in BUCKETS:
+            if elapsed <= bound:
+                _counters[_key(hist + "_bucket", endpoint=endpoint, le=str(bound))] += 1
+        _counters[_key(hist + "_bucket", endpoint=endpoint, le="+Inf")] += 1
+        _counters[_key(hist + "_sum", endpoint=endpoint)] += elapsed
+        _counters[_key(hist + "_count", endpoint=endpoint)] += 1
+        _counters[_key("seminars_db_queries_total", endpoint=endpoint)] += sql["queries"]
+        _counters[_key("seminars_db_seconds_total", endpoint=endpoint)] += sql["seconds"]
+    if time.time() - _last_flush[0] > FLUSH_INTERVAL:
+        flush()
+    return response
+
+
+def _lru_caches():
+    # Functions decorated with functools.lru_cache in our modules
+    for modname, module in list(sys.modules.items()):
+        if modname.split(".")[0] != "seminars" or module is None:
+            continue
+        for attr, obj in list(vars(module).items()):
+            if callable(getattr(obj, "cache_info", None)) and getattr(obj, "__module__", None) == modname:
+                yield "%s.%s" % (modname, attr), obj.cache_info()
+
+
+def snapshot():
+    """
+    Returns the counters and gauges for this process, as two dictionaries keyed by (name, labels).
+    """
+    with _lock:
+        counters = dict(_counters)
+    gauges = {}
+    counters[_key("seminars_db_all_queries_total")] = sql_totals["queries"]
+    counters[_key("seminars_db_all_seconds_total")] = sql_totals["seconds"]
+    for name, cache in list(caches.items()):
+        counters[_key("seminars_cache_hits_total", cache=name)] = cache.hits
+        counters[_key("seminars_cache_misses_total", cache=name)] = cache.misses
+        gauges[_key("seminars_cache_entries", cache=name)] = len(cache)
+    for name, info in _lru_caches():
+        counters[_key("seminars_cache_hits_total", cache=name)] = info.hits
+        counters[_key("seminars_cache_misses_total", cache=name)] = info.misses
+        gauges[_key("seminars_cache_entries", cache=name)] = info.currsize
+    for poolname, p in [("primary", pool), ("replica", replica_pool)]:
+        if p is None:
+            continue
+        stats = p.stats()
+        for stat in ["checkouts", "opened", "discarded", "health_check_failures", "connect_failures", "timeouts"]:
+            counters[_key("seminars_db_pool_%s_total" % stat, pool=poolname)] = stats[stat]
+        counters[_key("seminars_db_pool_checkout_wait_seconds_total", pool=poolname)] = stats["checkout_wait_seconds"]
+        gauges[_key("seminars_db_pool_active", pool=poolname)] = stats["active"]
+        gauges[_key("seminars_db_pool_idle", pool=poolname)] = stats["idle"]
+    gauges[_key("seminars_workers")] = 1
+    return counters, gauges
+
+
+def _dump(samples):
+    return [[name, dict(labels), value] for (name, labels), value in samples.items()]
+
+
+def _load(samples):
+    return {_key(name, **labels): value for name, labels, value in samples}
+
+
+def flush():
+    """
+    Writes this process's metrics to its file.
+    """
+    _last_flush[0] = time.time()
+    counters, gauges = snapshot()
+    if _identity["pid"] != os.getpid():
+        _identity.update(pid=os.getpid(), name="%s-%d.json" % (os.getpid(), time.time() * 1000))
+    folder = local_folder("metrics")
+    filename = os.path.join(folder, _identity["name"])
+    with open(filename + ".tmp", "w") as F:
+        json.dump({"counters": _dump(counters), "gauges": _dump(gauges)}, F)
+    os.rename(filename + ".tmp", filename)
+
+
+def collect():
+    """
+    Adds up the metrics of all worker processes, returning counters and gauges as in ``snapshot``.
+    """
+    flush()
+    folder = local_folder("metrics")
+    counters, gauges = defaultdict(float), defaultdict(float)
+    with open(os.path.join(folder, "archive.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_file = os.path.join(folder, "archive.json")
+        try:
+            with open(archive_file) as F:
+                archive = _load(json.load(F))
+        except (OSError, ValueError):
+            archive = {}
+        archived = False
+        # Files are named pid-started.json (or pid.json, by older versions); only the latest file
+        # for a pid can belong to a live process
+        files = {}
+        for name in os.listdir(folder):
+            if not name.endswith(".json") or name == "archive.json":
+                continue
+            pid, _, started = name[:-5].partition("-")
+            try:
+                pid, started = int(pid), int(started or 0)
+            except ValueError:
+                continue
+            files[name] = (pid, started)
+        latest = {}
+        for pid, started in files.values():
+            latest[pid] = max(latest.get(pid, started), started)
+        for name, (pid, started) in files.items():
+            path = os.path.join(folder, name)
+            try:
+                with open(path) as F:
+                    data = json.load(F)
+            except (OSError, ValueError):
+                continue
+            if started == latest[pid] and pid_alive(pid):
+                for key, value in _load(data["gauges"]).items():
+                    gauges[key] += value
+                for key, value in _load(data["counters"]).items():
+                    counters[key] += value
+            else:
+                # The worker has exited: keep its counters, and forget its gauges
+                for key, value in _load(data["counters"]).items():
+                    archive[key] = archive.get(key, 0) + value
+                os.remove(path)
+                archived = True
+        if archived:
+            with open(archive_file + ".tmp", "w") as F:
+                json.dump(_dump(archive), F)
+            os.rename(archive_file + ".tmp", archive_file)
+    for key, value in archive.items():
+        counters[key] += value
+    return counters, gauges
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _sort_key(sample):
+    # Buckets are sorted numerically, with +Inf last
+    labels = dict(sample[1])
+    le = labels.pop("le", None)
+    return sample[0], sorted(labels.items()), float(le) if le is not None else 0
+
+
+def render(counters, gauges):
+    """
+    Formats metrics in the Prometheus text format.
+    """
+    by_metric = defaultdict(list)
+    for samples in [counters, gauges]:
+        for (name, labels), value in samples.items():
+            base = name
+            for suffix in ["_bucket", "_sum", "_count"]:
+                if name.endswith(suffix) and name[: -len(suffix)] in METRICS:
+                    base = name[: -len(suffix)]
+            by_metric[base].append((name, labels, value))
+    lines = []
+    for base in sorted(by_metric):
+        typ, desc = METRICS.get(base, ("untyped", ""))
+        lines.append("# HELP %s %s" % (base, desc))
+        lines.append("# TYPE %s %s" % (base, typ))
+        for name, labels, value in sorted(by_metric[base], key=_sort_key):
+            if labels:
+                name += "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+            lines.append("%s %s" % (name, repr(float(value)) if isinstance(value, float) else value))
+    return "\n".join(lines) + "\n"
+
+
+@app.route("/metrics")
+@housekeeping
+def metrics():
+    response = make_response(render(*collect()))
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+app.before_request(_start_timer)
+app.after_request(_record)
+atexit.register(flush)
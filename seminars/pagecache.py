@@ -0,0 +1,160 @@
+"""
+Whole-page cache for visitors who aren't logged in.
+
+Most requests for the browse pages and the pages of series and talks are anonymous, and the html
+they get only depends on the url, on a few cookies (the topic, language and other filters, the
+search boxes and the browser's time zone) and on the domain.  Views decorated with ``cached_page``
+serve such requests
+
+- from a small cache in each process, and then
+- if the environment variable ``SEMINARS_SHARED_PAGE_CACHE`` is set to 1, from a SQLite file
+  shared by the workers on this machine (see ``seminars.localstore``), so that a page rendered
+  by one worker serves the others.
+
+Pages are kept for ``SEMINARS_PAGE_CACHE_TTL`` seconds (60 by default), since they show relative
+times and links that only appear shortly before a talk.  Any write to the tables they display
+moves the ``pages`` entry of ``data_versions`` on, which invalidates every cached page on the
+machine at once: such writes are rare, and the browse pages list every series anyway.
+
+Requests from logged in users, with flashed messages waiting or with a token in the url go to the
+view as usual, and a response is only stored if it is successful, sets no cookie and leaves the
+session untouched.  Within ``bypass()`` (used by the benchmarks) every request goes to the view.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, has_request_context, make_response, request, session
+from flask_login import current_user
+from lmfdb.logger import critical
+import seminars
+from seminars.cache import LRUCache
+from seminars.localstore import LocalStore, data_versions
+from seminars.utils import domain
+
+TTL = float(os.environ.get("SEMINARS_PAGE_CACHE_TTL", 60))
+# The cookies read when rendering pages, by name or prefix
+COOKIES = ("topics", "languages", "browser_timezone", "filter_", "visible_", "search_")
+# The tables whose contents show up on cached pages
+TABLES = ("seminars", "talks", "seminar_organizers", "institutions", "new_topics")
+
+page_cache = LRUCache("pages", maxsize=500, ttl=TTL)
+shared_pages = LocalStore("pages") if os.environ.get("SEMINARS_SHARED_PAGE_CACHE") == "1" else None
+_bypassed = [0]
+
+
+def _key():
+    # None if the version of the pages can't be read, in which case the cache isn't used
+    try:
+        version = data_versions.get("pages", 0)
+    except sqlite3.Error as err:
+        critical("Unable to read the version of cached pages: %s" % err)
+        return None
+    args = sorted(request.args.items(multi=True))
+    cookies = sorted((name, value) for (name, value) in request.cookies.items() if name.startswith(COOKIES))
+    key = repr((request.path, args, cookies, domain(), version))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+@contextmanager
+def bypass():
+    """
+    A context manager within which views decorated with ``cached_page`` are always rendered,
+    and their pages not stored.
+    """
+    _bypassed[0] += 1
+    try:
+        yield
+    finally:
+        _bypassed[0] -= 1
+
+
+def _cacheable():
+    return (not _bypassed[0]
+            and request.method in ["GET", "HEAD"]
+            and "token" not in request.args
+            and not current_user.is_authenticated
+            and "_flashes" not in session)
+
+
+def _lookup(key):
+    entry = page_cache.get(key)
+    if entry is None and shared_pages is not None:
+        try:
+            entry = shared_pages.get(key)
+        except sqlite3.Error as err:
+            critical("Shared page cache failed: %s" % err)
+        if entry is not None:
+            page_cache.set(key, entry)
+    # Entries copied from the shared cache shouldn't outlive the original
+    if entry is not None and entry[2] > time.time():
+        return entry
+
+
+def _store(key, response):
+    entry = [response.get_data(as_text=True), response.headers.get("Content-Type"), time.time() + TTL]
+    page_cache.set(key, entry)
+    if shared_pages is not None:
+        try:
+            shared_pages.set(key, entry, ttl=TTL)
+        except sqlite3.Error as err:
+            critical("Shared page cache failed: %s" % err)
+
+
+def cached_page(view):
+    """
+    A decorator for views whose pages can be cached for anonymous visitors (put it below ``app.route``).
+    """
+    @wraps(view)
+    def cached_view(*args, **kwds):
+        key = _key() if _cacheable() else None
+        if key is None:
+            return view(*args, **kwds)
+        entry = _lookup(key)
+        if entry is not None:
+            response = make_response(entry[0])
+            response.headers["Content-Type"] = entry[1]
+            response.headers["X-Page-Cache"] = "hit"
+            return response
+        response = make_response(view(*args, **kwds))
+        if (response.status_code == 200 and not response.direct_passthrough
+                and "Set-Cookie" not in response.headers and not session.modified):
+            _store(key, response)
+        return response
+
+    return cached_view
+
+
+def invalidate():
+    """
+    Invalidates all cached pages, in every process on this machine.
+    """
+    page_cache.clear()
+    try:
+        data_versions.set("pages", time.time())
+    except sqlite3.Error as err:
+        critical("Unable to invalidate cached pages: %s" % err)
+
+
+def record_write(tname):
+    # During a request, pages are invalidated once at the end, however many writes it makes
+    if tname in TABLES:
+        if has_request_context():
+            g.pages_changed = True
+        else:
+            invalidate()
+
+
+def _end_request(exc=None):
+    if g.pop("pages_changed", False):
+        invalidate()
+
+
+def init_app(app):
+    """
+    Invalidates cached pages at the end of requests to ``app`` that changed what they show.
+    """
+    seminars.write_hooks.append(record_write)
+    app.teardown_request(_end_request)
@@ -1,12 +1,16 @@
-from flask import redirect, url_for, render_template
+from flask import g, redirect, url_for, render_template
 from flask_login import current_user
 from seminars import db
+from seminars.cache import LRUCache
+from seminars.localstore import data_versions
 from seminars.utils import (
     adapt_datetime,
     adapt_weektimes,
     allowed_shortname,
     count_distinct,
+    domain,
     format_errmsg,
+    get_timezone,
     lucky_distinct,
     make_links,
     max_distinct,
@@ -15,6 +19,8 @@ from seminars.utils import (
     weekdays,
     sanitized_table,
     log_error,
+    row_iterator,
+    ListingRow,
 )
 from seminars.topic import topic_dag
 from seminars.toggle import toggle
@@ -30,6 +36,10 @@ import urllib.parse
 
 combine = datetime.combine
 
+# Rows rendered by WebSeminar.oneline, without the subscribe column.  The key includes edited_at;
+# the ttl covers changes made without updating it (such as save_admin).
+oneline_cache = LRUCache("seminar_oneline", maxsize=5000, ttl=3600)
+
 access_control_options = [
     (0, 'open'),
     (1, 'time-restricted'),
@@ -296,7 +306,7 @@ class WebSeminar(object):
 
     @property
     def tz(self):
-        return pytz.timezone(self.timezone)
+        return get_timezone(self.timezone)
 
     @property
     def series_type(self):
@@ -406,7 +416,7 @@ class WebSeminar(object):
     def is_subscribed(self):
         if current_user.is_anonymous:
             return False
-        return self.shortname in current_user.seminar_subscriptions
+        return current_user.is_subscribed_seminar(self.shortname)
 
     def show_subscribe(self):
         if current_user.is_anonymous:
@@ -449,16 +459,16 @@ class WebSeminar(object):
             content=Markup.escape(render_template("seminar-embed-code-knowl.html", seminar=self, daterange=daterange, uniqstr=uniqstr)),
         )
 
-    def oneline(
+    def _oneline(
         self,
         conference=False,
         include_institutions=True,
         include_datetime=True,
         include_topics=False,
         include_audience=False,
-        include_subscribe=True,
         show_attributes=False,
     ):
+        # The row shown in lists of series, except for the subscribe column
         datetime_tds = ""
         if include_datetime:
             if conference: # include start and end date instead
@@ -483,10 +493,34 @@ class WebSeminar(object):
             cols.append(('class="audience"', self.show_audience()))
         if include_topics:
             cols.append(('class="topics"', self.show_topics()))
-        if include_subscribe:
-            cols.append(('class="subscribe"', self.show_subscribe()))
         return datetime_tds + "".join("<td %s>%s</td>" % c for c in cols)
 
+    def oneline(
+        self,
+        conference=False,
+        include_institutions=True,
+        include_datetime=True,
+        include_topics=False,
+        include_audience=False,
+        include_subscribe=True,
+        show_attributes=False,
+    ):
+        if "institutions_version" not in g:
+            # Institution names are shown, so saving an institution invalidates the cached rows
+            g.institutions_version = data_versions.get("institutions", 0)
+        key = (self.shortname, self.edited_at, self.deleted,
+               self.next_talk_time if include_datetime and not conference else None,
+               str(current_user.tz), domain(), g.institutions_version, conference, include_institutions,
+               include_datetime, include_topics, include_audience, show_attributes)
+        row = oneline_cache.get(key)
+        if row is None:
+            row = self._oneline(conference, include_institutions, include_datetime, include_topics, include_audience, show_attributes)
+            oneline_cache.set(key, row)
+        if include_subscribe:
+            # The subscribe column depends on the user, so is added after caching
+            row += '<td class="subscribe">%s</td>' % self.show_subscribe()
+        return row
+
     def editors(self):
         emails =  [rec["email"].lower() for rec in self.organizers if rec["email"]]
         if self.owner:
@@ -573,7 +607,7 @@ class WebSeminar(object):
         query = {"seminar_id": self.shortname, "seminar_ctr": {"$gt": 0}, "display": True, "hidden": {"$or": [False, {"$exists": False}]}}
         if self.user_can_edit():
             query.pop("display")
-        return talks_search(query, projection=projection)
+        return talks_search(query, projection=projection, seminar_dict={self.shortname: self})
 
     @property
     def ics_link(self):
@@ -629,12 +663,57 @@ class WebSeminar(object):
                 ):
                     del talk_sub[self.shortname]
                     db.users.update({"id": i}, {"talk_subscriptions": talk_sub})
-            self.deleted = True
+                # Record the deletion as a new version, so that it appears in the API change feed
+                self.deleted = True
+                self.save_admin()
             return True
         else:
             return False
 
 
+class SeminarRow(ListingRow):
+    """
+    A compact, read-only series for listings, as returned by ``seminars_search(..., rows=True)``.
+
+    Supports the display methods of ``WebSeminar`` (``oneline``, ``show_name`` and so on)
+    but not editing or saving; use ``WebSeminar`` for those.
+    """
+    __slots__ = ("organizers", "more", "_next_talk_time")
+    _defaults = dict([(col, str) for col in optional_seminar_text_columns] + [("topics", list), ("institutions", list)])
+
+    def __init__(self, rec, cols, organizers):
+        ListingRow.__init__(self, rec, cols)
+        self.organizers = organizers
+
+    __repr__ = WebSeminar.__repr__
+    visible = WebSeminar.visible
+    searchable = WebSeminar.searchable
+    editors = WebSeminar.editors
+    user_can_edit = WebSeminar.user_can_edit
+    tz = WebSeminar.tz
+    series_type = WebSeminar.series_type
+    next_talk_time = WebSeminar.next_talk_time
+    show_audience = WebSeminar.show_audience
+    _show_date = WebSeminar._show_date
+    show_conference_dates = WebSeminar.show_conference_dates
+    show_seminar_times = WebSeminar.show_seminar_times
+    show_topics = WebSeminar.show_topics
+    show_name = WebSeminar.show_name
+    show_attributes = WebSeminar.show_attributes
+    show_visibility = WebSeminar.show_visibility
+    show_frequency = WebSeminar.show_frequency
+    show_homepage = WebSeminar.show_homepage
+    show_institutions = WebSeminar.show_institutions
+    show_comments = WebSeminar.show_comments
+    is_subscribed = WebSeminar.is_subscribed
+    show_subscribe = WebSeminar.show_subscribe
+    _oneline = WebSeminar._oneline
+    oneline = WebSeminar.oneline
+    ics_link = WebSeminar.ics_link
+    ics_gcal_link = WebSeminar.ics_gcal_link
+    ics_webcal_link = WebSeminar.ics_webcal_link
+
+
 def series_header(
     conference=False,
     include_institutions=True,
@@ -700,6 +779,17 @@ def _iterator(organizer_dict, objects=True, more=False):
     return object_iterator if objects else db.seminars._search_iterator
 
 
+def _row_iterator(organizer_dict):
+    def construct(rec, cols):
+        shortname = rec[cols["shortname"]]
+        # As in _iterator, series missing from organizer_dict are skipped
+        if shortname not in organizer_dict:
+            return None
+        return SeminarRow(rec, cols, organizer_dict[shortname])
+
+    return row_iterator(db.seminars, construct)
+
+
 def seminars_count(query={}, include_deleted=False):
     """
     Replacement for db.seminars.count to account for versioning.
@@ -716,12 +806,16 @@ def seminars_search(*args, **kwds):
     Replacement for db.seminars.search to account for versioning, return WebSeminar objects.
 
     Doesn't support split_ors or raw.  Always computes count.
+
+    If ``rows`` is set, returns ``SeminarRow`` objects instead of ``WebSeminar`` objects: these are
+    cheaper to construct and smaller, and suffice for displaying lists of series.
     """
     objects = kwds.pop("objects", True)
+    rows = kwds.pop("rows", False)
     col_projection = (len(args) > 1 and isinstance(args[1], str) or "projection" in kwds and isinstance(kwds["projection"], str))
     if "organizer_dict" in kwds:
         organizer_dict = kwds.pop("organizer_dict")
-    elif objects and not col_projection:
+    elif (objects or rows) and not col_projection:
         organizer_dict = all_organizers()
     else:
         organizer_dict = {} # unused in this case
@@ -730,10 +824,11 @@ def seminars_search(*args, **kwds):
         table = sanitized_table("seminars")
     else:
         table = db.seminars
-    more = kwds.get("more", False)
-    return search_distinct(
-        table, _selecter, _counter, _iterator(organizer_dict, objects=objects, more=more), *args, **kwds
-    )
+    if rows:
+        iterator = _row_iterator(organizer_dict)
+    else:
+        iterator = _iterator(organizer_dict, objects=objects, more=kwds.get("more", False))
+    return search_distinct(table, _selecter, _counter, iterator, *args, **kwds)
 
 
 def seminars_lucky(*args, **kwds):
@@ -773,13 +868,13 @@ def all_organizers(query={}):
     return organizers
 
 
-def all_seminars():
+def all_seminars(rows=False):
     """
-    A dictionary with keys the seminar ids and values a WebSeminar object.
+    A dictionary with keys the seminar ids and values a WebSeminar object (a SeminarRow if ``rows`` is set).
     """
     return {
         seminar.shortname: seminar
-        for seminar in seminars_search({}, organizer_dict=all_organizers())
+        for seminar in seminars_search({}, organizer_dict=all_organizers(), rows=rows)
     }
 
 def next_talks(query=None):
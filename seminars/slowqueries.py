@@ -0,0 +1,195 @@
+"""
+Slow query capture.
+
+Queries taking longer than ``SEMINARS_SLOW_QUERY_THRESHOLD`` seconds (0.25 by default) are recorded
+by shape: the SQL with literals replaced by ``?``, so that queries differing only in their values
+are counted together.  For each shape we keep the number of slow runs, the total and maximum time,
+and for some of them a plan.  Plans are only captured for plain SELECTs made outside of a
+``DelayCommit``, at most once an hour for each shape and a few times a minute overall; they are
+computed in a background thread, on a separate connection, so the request that ran the query doesn't
+wait for them.
+
+Plans come from ``EXPLAIN (ANALYZE, BUFFERS)``, which reruns the query, when a replica is configured
+(see ``seminars.dbpool``), and are computed there.  Otherwise they come from a plain ``EXPLAIN`` on
+the primary, so that slow queries aren't run twice, unless ``SEMINARS_SLOW_QUERY_ANALYZE`` is set to 1.
+
+String literals (which may be email addresses or names) are replaced by ``?`` in the plans, in the
+example queries and in the notes we keep.
+
+The data is kept in a ``LocalStore`` on each machine, and can be browsed by admins at
+``/user/slow_queries``.
+"""
+import hashlib
+import os
+import queue
+import random
+import re
+import threading
+import time
+from lmfdb.logger import critical
+from psycopg2 import Error as PGError
+from seminars import db
+from seminars.dbpool import pool, replica_pool
+from seminars.localstore import LocalStore, TokenBucket
+
+THRESHOLD = float(os.environ.get("SEMINARS_SLOW_QUERY_THRESHOLD", 0.25))
+# Whether to rerun queries on the primary with EXPLAIN ANALYZE when there is no replica
+ANALYZE_ON_PRIMARY = os.environ.get("SEMINARS_SLOW_QUERY_ANALYZE") == "1"
+# Minimum time between plans for the same shape
+EXPLAIN_INTERVAL = 3600
+# Number of shapes kept
+MAX_SHAPES = 200
+
+slow_queries = LocalStore("slow_queries")
+explain_limiter = TokenBucket("slow_query_explains", capacity=3, rate=1 / 60)
+_explain_queue = queue.Queue(maxsize=10)
+_explainer = None
+
+_string_re = re.compile(r"'(?:[^']|'')*'")
+_number_re = re.compile(r"\b\d+(?:\.\d+)?\b")
+_space_re = re.compile(r"\s+")
+
+
+def normalize(sql):
+    """
+    Replaces literals and placeholders in ``sql`` by ``?`` and collapses whitespace.
+    """
+    sql = _string_re.sub("?", sql)
+    sql = _number_re.sub("?", sql)
+    sql = sql.replace("%s", "?")
+    return _space_re.sub(" ", sql).strip()
+
+
+def redact(text):
+    """
+    Replaces the string literals in ``text`` (such as a query or a plan) by ``?``.
+    """
+    return _string_re.sub("?", text)
+
+
+def _redact_values(obj):
+    # The strings in a query dictionary, keeping its keys
+    if isinstance(obj, str):
+        return "?"
+    if isinstance(obj, dict):
+        return {key: _redact_values(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_redact_values(val) for val in obj]
+    return obj
+
+
+def _redact_note(note):
+    # Notes are tuples such as (table name, "analyze", query, projection, limit, offset)
+    if isinstance(note, tuple):
+        return tuple(_redact_values(x) if isinstance(x, dict) else x for x in note)
+    return note
+
+
+def _key(shape):
+    return hashlib.sha1(shape.encode()).hexdigest()
+
+
+def record(obj, sql, values, elapsed, note=None):
+    """
+    Records a query that took ``elapsed`` seconds, made through ``obj`` (``db`` or a table).
+
+    INPUT:
+
+    - ``sql`` -- the SQL, as a string, with placeholders for ``values``
+    - ``values`` -- the values passed with the query
+    - ``note`` -- the ``slow_note`` passed to ``_execute``, if any
+    """
+    shape = normalize(sql)
+    key = _key(shape)
+    now = time.time()
+    explain = [False]
+
+    def update(entry):
+        if entry is None:
+            entry = {"shape": shape, "count": 0, "total": 0.0, "max": 0.0, "first_seen": now,
+                     "plan": None, "plan_requested_at": 0}
+        entry["count"] += 1
+        entry["total"] += elapsed
+        entry["max"] = max(entry["max"], elapsed)
+        entry["last_seen"] = now
+        if note is not None:
+            entry["note"] = repr(_redact_note(note))[:1000]
+        if (shape.upper().startswith("SELECT") and not db._nocommit_stack
+                and now - entry["plan_requested_at"] > EXPLAIN_INTERVAL
+                and not explain_limiter.take("all")):
+            entry["plan_requested_at"] = now
+            explain[0] = True
+        return entry
+
+    try:
+        slow_queries.update(key, update)
+        if explain[0]:
+            with obj.conn.cursor() as cur:
+                query = cur.mogrify(sql, values).decode("utf-8")
+            _start_explainer()
+            _explain_queue.put_nowait((key, query))
+        if random.random() < 0.05:
+            prune()
+    except queue.Full:
+        pass
+    except Exception as err:
+        # Never let the bookkeeping break the request
+        critical("Unable to record slow query: %s" % err)
+
+
+def _explain(key, query):
+    t0 = time.time()
+    analyze = replica_pool is not None or ANALYZE_ON_PRIMARY
+    with (replica_pool or pool).connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(("EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN ") + query)
+                plan = redact("\n".join(row[0] for row in cur))
+        except PGError as err:
+            plan = "Unable to explain: %s" % redact(str(err))
+        finally:
+            conn.rollback()
+
+    def update(entry):
+        if entry is not None:
+            entry["plan"] = plan
+            entry["plan_analyzed"] = analyze
+            entry["plan_at"] = time.time()
+            entry["plan_example"] = redact(query)[:10000]
+            entry["plan_time"] = time.time() - t0
+        return entry
+
+    slow_queries.update(key, update)
+
+
+def _run_explainer():
+    while True:
+        key, query = _explain_queue.get()
+        try:
+            _explain(key, query)
+        except Exception as err:
+            critical("Unable to explain slow query: %s" % err)
+
+
+def _start_explainer():
+    global _explainer
+    if _explainer is None or not _explainer.is_alive():
+        _explainer = threading.Thread(target=_run_explainer, name="slowqueries", daemon=True)
+        _explainer.start()
+
+
+def top(n=50, sort="total"):
+    """
+    The recorded shapes with the largest ``sort`` (one of total, max, count or last_seen), with their keys.
+    """
+    entries = [dict(entry, key=key) for key, entry in slow_queries.items() if entry is not None]
+    entries.sort(key=lambda entry: -entry.get(sort, 0))
+    return entries[:n]
+
+
+def prune():
+    """
+    Deletes all but the ``MAX_SHAPES`` shapes with the largest total time.
+    """
+    for entry in top(None)[MAX_SHAPES:]:
+        slow_queries.delete(entry["key"])
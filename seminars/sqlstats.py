@@ -0,0 +1,118 @@
+"""
+Instrumentation of the queries made by each request.
+
+Every call to ``_execute`` (on ``db`` or on a table) is timed and its SQL template recorded.  At the
+end of a request the number of queries and the time spent in them are sent to the browser in a
+``Server-Timing`` header, and requests that are slow or that run the same query template many
+times (usually a query in a loop, which should be replaced by a single query) are logged as json.
+
+The thresholds can be set with the environment variables ``SEMINARS_SQL_REPEAT_THRESHOLD``
+(the number of times a template may run in one request, 10 by default) and
+``SEMINARS_SQL_SLOW_THRESHOLD`` (in seconds of database time per request, 0.5 by default).
+
+Queries slower than ``slowqueries.THRESHOLD`` are also recorded, with their plans (see
+``seminars.slowqueries``).
+
+Note that for unbuffered searches the time recorded covers executing the query but not fetching
+the results.
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter
+from flask import g, has_request_context, request
+from lmfdb.backend.base import PostgresBase
+from psycopg2.sql import Composable
+from seminars import slowqueries
+
+REPEAT_THRESHOLD = int(os.environ.get("SEMINARS_SQL_REPEAT_THRESHOLD", 10))
+SLOW_THRESHOLD = float(os.environ.get("SEMINARS_SQL_SLOW_THRESHOLD", 0.5))
+
+# Totals for this process, including queries made outside of requests
+totals = {"queries": 0, "seconds": 0.0}
+_totals_lock = threading.Lock()
+
+
+def _shape(obj, query):
+    if isinstance(query, Composable):
+        try:
+            return query.as_string(obj.conn)
+        except Exception:
+            return repr(query)
+    return str(query)
+
+
+def _instrumented(execute):
+    def _execute(self, query, *args, **kwds):
+        t0 = time.time()
+        try:
+            return execute(self, query, *args, **kwds)
+        finally:
+            elapsed = time.time() - t0
+            with _totals_lock:
+                totals["queries"] += 1
+                totals["seconds"] += elapsed
+            shape = None
+            if has_request_context():
+                stats = g.get("sql_stats")
+                if stats is None:
+                    stats = g.sql_stats = {"queries": 0, "seconds": 0.0, "shapes": Counter()}
+                shape = _shape(self, query)
+                stats["queries"] += 1
+                stats["seconds"] += elapsed
+                stats["shapes"][shape] += 1
+            if elapsed > slowqueries.THRESHOLD and not kwds.get("values_list"):
+                values = args[0] if args else kwds.get("values")
+                slowqueries.record(self, shape or _shape(self, query), values, elapsed, kwds.get("slow_note"))
+
+    _execute.__wrapped__ = execute
+    return _execute
+
+
+def request_stats():
+    """
+    The number of queries, time spent and repeated query templates so far in the current request.
+    """
+    stats = g.get("sql_stats")
+    if stats is None:
+        return {"queries": 0, "seconds": 0.0, "repeated": {}}
+    return {
+        "queries": stats["queries"],
+        "seconds": stats["seconds"],
+        "repeated": {shape: n for shape, n in stats["shapes"].items() if n > REPEAT_THRESHOLD},
+    }
+
+
+def _report(response):
+    stats = request_stats()
+    if stats["queries"]:
+        response.headers.add(
+            "Server-Timing", 'db;dur=%.1f;desc="%s queries"' % (1000 * stats["seconds"], stats["queries"])
+        )
+        if stats["repeated"] or stats["seconds"] > SLOW_THRESHOLD:
+            from seminars.app import app
+
+            record = {
+                "endpoint": request.endpoint,
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "queries": stats["queries"],
+                "db_seconds": round(stats["seconds"], 4),
+                "repeated": [{"count": n, "query": shape} for shape, n in sorted(stats["repeated"].items(), key=lambda x: -x[1])],
+            }
+            if stats["repeated"]:
+                app.logger.warning("repeated queries: " + json.dumps(record))
+            else:
+                app.logger.info("slow queries: " + json.dumps(record))
+    return response
+
+
+def init_app(app):
+    """
+    Starts recording queries, and reporting on them for each request to ``app``.
+    """
+    if not hasattr(PostgresBase._execute, "__wrapped__"):
+        PostgresBase._execute = _instrumented(PostgresBase._execute)
+    app.after_request(_report)
@@ -127,6 +127,65 @@ function toggle(element) {
   element.classList.toggle("open")
 }
 
+/*
+ * Content of knowls loaded from the server, by url.  Each entry records the content once loaded,
+ * and the callbacks waiting for it until then, so that a knowl prefetched on hover and then
+ * clicked is only requested once.
+ */
+var knowl_fetched = {}
+
+function knowl_url(knowl) {
+  return '/knowl/' + knowl.getAttribute("knowl") + "?" + knowl.getAttribute("kwargs");
+}
+
+function knowl_fetch(url, callback) {
+  var entry = knowl_fetched[url];
+  if (!entry) {
+    entry = knowl_fetched[url] = {content: null, callbacks: []};
+    var done = function (content, keep) {
+      if (keep) {
+        entry.content = content;
+      } else {
+        // try again next time
+        delete knowl_fetched[url];
+      }
+      entry.callbacks.forEach(function (cb) { cb(content); });
+      entry.callbacks = [];
+    }
+    var xhr = new XMLHttpRequest();
+    xhr.responseType = "document";
+    xhr.addEventListener("load", function(event) {
+      done(new XMLSerializer().serializeToString(this.responseXML), true);
+    });
+    xhr.addEventListener("error", function(event) { done("Failed loading knowl", false); });
+    xhr.addEventListener("abort", function(event) { done("Canceled loading knowl", false); });
+    console.log("Initiating fetch from " + url);
+    xhr.open("GET", url, true);
+    xhr.send();
+  }
+  if (callback) {
+    if (entry.content !== null) {
+      callback(entry.content);
+    } else {
+      entry.callbacks.push(callback);
+    }
+  }
+}
+
+// Start loading a knowl when the pointer rests on it, so that it opens without waiting
+var knowl_prefetch_timer = null
+function knowl_prefetch_start(evt) {
+  var knowl = evt.target || evt.srcElement
+  if (knowl.getAttribute("knowl") == "dynamic_show") return;
+  clearTimeout(knowl_prefetch_timer);
+  // ignore the pointer passing over a list on its way elsewhere
+  knowl_prefetch_timer = setTimeout(function () { knowl_fetch(knowl_url(knowl)); }, 100);
+}
+
+function knowl_prefetch_cancel(evt) {
+  clearTimeout(knowl_prefetch_timer);
+}
+
 function knowl_click_handler(evt) {
   var knowl = evt.target || evt.srcElement
   var uid = knowl.getAttribute("knowl-uid")
@@ -251,18 +310,8 @@ function knowl_click_handler(evt) {
     if(knowl_id == "dynamic_show") {
       finish_knowl(kwargs);
     } else {
-      var xhr = new XMLHttpRequest();
-      xhr.responseType = "document";
-      xhr.addEventListener("load", function(event) {
-        finish_knowl(new XMLSerializer().serializeToString(this.responseXML));
-      });
-      xhr.addEventListener("error", function(event) { knowl_content.innerHTML = "Failed loading knowl"; });
-      xhr.addEventListener("abort", function(event) { knowl_content.innerHTML = "Canceled loading knowl"; });
-      xhr.addEventListener("progress", function(event) { knowl_content.innerHTML += "."; });
-      fetchURL = '/knowl/' + knowl_id + "?" + kwargs;
-      console.log("Initiating fetch from " + fetchURL);
-      xhr.open("GET", fetchURL, true);
-      xhr.send();
+      // usually already requested when the pointer moved over the knowl
+      knowl_fetch(knowl_url(knowl), finish_knowl);
     }
     // even if the knowl is not loaded, this gives the user some feedback
     setTimeout(function () {
@@ -292,6 +341,8 @@ function knowl_register_onclick(element) {
   element.querySelectorAll('a[knowl]').forEach(
    (knowl) => {
      knowl.onclick = debounce(knowl_handle, 500, true)
+     knowl.onmouseenter = knowl_prefetch_start
+     knowl.onmouseleave = knowl_prefetch_cancel
    }
   )
 }
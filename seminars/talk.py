@@ -5,36 +5,50 @@ from flask import url_for, redirect, render_template
 from flask_login import current_user
 from lmfdb.backend.utils import DelayCommit, IdentifierWrapper
 from seminars import db
+from seminars.cache import LRUCache
 from seminars.utils import (
     search_distinct,
     lucky_distinct,
     count_distinct,
     max_distinct,
     adapt_datetime,
+    get_timezone,
     make_links,
     sanitized_table,
     how_long,
     topdomain,
+    domain,
     comma_list,
     log_error,
+    row_iterator,
+    ListingRow,
     SPEAKER_DELIMITER,
 )
 from seminars.language import languages
 from seminars.toggle import toggle
 from seminars.topic import topic_dag
-from seminars.seminar import WebSeminar, can_edit_seminar, audience_options
+from seminars.seminar import WebSeminar, can_edit_seminar, audience_options, seminars_search, all_organizers
 from lmfdb.utils import flash_error
 from markupsafe import Markup
 from psycopg2.sql import SQL
 import urllib.parse
-from icalendar import Event
 from lmfdb.logger import critical
 from datetime import datetime, timedelta
 import re
 
+# Rows rendered by WebTalk.oneline, without the subscribe column.  The key includes edited_at for the
+# talk and its series; the ttl covers changes made without updating edited_at (such as save_admin).
+oneline_cache = LRUCache("talk_oneline", maxsize=10000, ttl=3600)
+
 blackout_dates = [ # Use %Y-%m-%d format
     "2020-06-10",
 ]
+# The instants falling on a blackout date in some time zone (UTC offsets range from -12 to +14 hours)
+blackout_windows = [
+    (pytz.UTC.localize(datetime.strptime(d, "%Y-%m-%d")) - timedelta(hours=14),
+     pytz.UTC.localize(datetime.strptime(d, "%Y-%m-%d")) + timedelta(hours=36))
+    for d in blackout_dates
+]
 
 required_talk_columns = [
     "audience",
@@ -98,24 +112,26 @@ class WebTalk(object):
         include_pending=False,
     ):
         if data is None and not editing:
-            data = talks_lookup(seminar_id, seminar_ctr, include_deleted=include_deleted, include_pending=include_pending)
+            data = talks_lookup(seminar_id, seminar_ctr, include_deleted=include_deleted, include_pending=include_pending, objects=False)
             if data is None:
                 raise ValueError("Talk %s/%s does not exist" % (seminar_id, seminar_ctr))
-            data = dict(data.__dict__)
-        elif data is not None:
+        if data is not None:
             data = dict(data)
             # avoid Nones
             if data.get("topics") is None:
                 data["topics"] = []
         if data and data.get("deleted"):
             include_deleted = True
-        if seminar is None:
-            seminar = WebSeminar(seminar_id, include_deleted=include_deleted)
-        self.seminar = seminar
+        # If no seminar is given, it is looked up when first needed (see the seminar property)
+        self._seminar = seminar
+        self._seminars = None
+        self._include_deleted = include_deleted
         self.new = data is None
         if self.new:
+            # The seminar property looks up the series by seminar_id
             self.seminar_id = seminar_id
             self.seminar_ctr = None
+            seminar = self.seminar
             self.token = secrets.token_hex(8)
             self.by_api = False # reset by API code if needed
             self.timezone = seminar.timezone
@@ -139,7 +155,7 @@ class WebTalk(object):
         else:
             # The output from psycopg2 seems to always be given in the server's time zone
             if data.get("timezone"):
-                tz = pytz.timezone(data["timezone"])
+                tz = get_timezone(data["timezone"])
                 if data.get("start_time"):
                     data["start_time"] = adapt_datetime(data["start_time"], tz)
                 if data.get("end_time"):
@@ -147,6 +163,25 @@ class WebTalk(object):
             self.__dict__.update(data)
             self.cleanse()
 
+    @property
+    def seminar(self):
+        """
+        The WebSeminar for this talk.
+
+        Talks returned by ``talks_search`` share a ``_SeminarBatch``, so that the series of all
+        of them are looked up together the first time one is needed.
+        """
+        if self._seminar is None:
+            if self._seminars is not None:
+                self._seminar = self._seminars.get(self.seminar_id)
+            else:
+                self._seminar = WebSeminar(self.seminar_id, include_deleted=self._include_deleted)
+        return self._seminar
+
+    @seminar.setter
+    def seminar(self, seminar):
+        self._seminar = seminar
+
     def __repr__(self):
         title = self.title if self.title else "TBA"
         return "%s (%s) - %s, %s" % (
@@ -204,7 +239,8 @@ class WebTalk(object):
         """
         return self.display and not self.hidden and self.seminar.searchable()
 
-    def save(self, user=None):
+    def _save_data(self, user=None):
+        # The row inserted by save
         if user is None: user = current_user
         data = {col: getattr(self, col, None) for col in db.talks.search_cols}
         assert data.get("seminar_id") and data.get("seminar_ctr")
@@ -215,21 +251,26 @@ class WebTalk(object):
             data["edited_by"] = -1
         data["edited_at"] = datetime.now(tz=pytz.UTC)
         self.validate()
-        db.talks.insert_many([data])
+        return data
 
-    def save_admin(self):
-        # Like save, but doesn't change edited_at
+    def save(self, user=None):
+        db.talks.insert_many([self._save_data(user)])
+
+    def _admin_data(self):
         data = {col: getattr(self, col, None) for col in db.talks.search_cols}
         assert data.get("seminar_id") and data.get("seminar_ctr")
         data["edited_by"] = 0
-        db.talks.insert_many([data])
+        return data
+
+    def save_admin(self):
+        # Like save, but doesn't change edited_at
+        db.talks.insert_many([self._admin_data()])
 
     def user_is_registered(self, user=None):
         if user is None: user = current_user
         if user.is_anonymous:
             return False
-        rec = {'seminar_id': self.seminar_id, 'seminar_ctr': self.seminar_ctr, 'user_id': int(user.id)}
-        return True if db.talk_registrations.count(rec) else False
+        return user.is_registered_talk(self.seminar_id, self.seminar_ctr)
 
     def register_user(self, user=None):
         if user is None: user = current_user
@@ -238,7 +279,9 @@ class WebTalk(object):
             return False
         reg = rec
         reg["registration_time"] = datetime.now(tz=pytz.UTC)
-        return db.talk_registrations.upsert(rec,reg)
+        ans = db.talk_registrations.upsert(rec,reg)
+        user.registered_talks_add(self.seminar_id, self.seminar_ctr)
+        return ans
 
     def registered_users(self):
         """ returns a list of tuples (name, affiliation, homepage, email, registration_time) in reverse order by registration time """
@@ -274,7 +317,7 @@ class WebTalk(object):
 
     @property
     def tz(self):
-        return pytz.timezone(self.timezone)
+        return get_timezone(self.timezone)
 
     def show_start_time(self, tz=None):
         return adapt_datetime(self.start_time, tz).strftime("%H:%M")
@@ -308,6 +351,9 @@ class WebTalk(object):
         return adapt_datetime(self.start_time, newtz=tz).strftime(format)
 
     def blackout_date(self):
+        # Rules out most talks without converting the time
+        if not any(a <= self.start_time < b for (a, b) in blackout_windows):
+            return False
         return adapt_datetime(self.start_time, newtz=self.tz).strftime("%Y-%m-%d") in blackout_dates
 
     def show_time_and_duration(self, adapt=True, tz=None):
@@ -478,7 +524,7 @@ class WebTalk(object):
             else:
                 return show_link(self, user=user, raw=raw)
         elif self.access_control == 5:
-            if not user.is_anonymous and db.seminar_registrations.lucky({'seminar_id':self.seminar_id,'email':user.email}):
+            if not user.is_anonymous and user.is_registered_seminar(self.seminar_id):
                 if not user.email_confirmed:
                     return '<div class="access_button no_link">Please confirm your email address for livestream access</div>'
                 else:
@@ -565,9 +611,7 @@ Thank you,
     def is_subscribed(self):
         if current_user.is_anonymous:
             return False
-        if self.seminar_id in current_user.seminar_subscriptions:
-            return True
-        return self.seminar_ctr in current_user.talk_subscriptions.get(self.seminar_id, [])
+        return current_user.is_subscribed_talk(self.seminar_id, self.seminar_ctr)
 
     def details_link(self):
         # Submits the form and redirects to create.edit_talk
@@ -613,7 +657,10 @@ Thank you,
                     if self.seminar_ctr in talk_sub[self.seminar.shortname]:
                         talk_sub[self.seminar.shortname].remove(self.seminar_ctr)
                         db.users.update({"id": i}, {"talk_subscriptions": talk_sub})
-            self.deleted = True
+                # Record the deletion as a new version, so that it appears in the API change feed
+                self.deleted = True
+                self.deleted_with_seminar = False
+                self.save_admin()
             return True
         else:
             return False
@@ -637,7 +684,8 @@ Thank you,
         # We currently indicate that a talk has been rescheduled by giving it a negative seminar_ctr; the version with the new time will have id equal to the absolute value.
         return self.seminar_ctr < 0
 
-    def oneline(self, include_seminar=True, include_content=False, include_subscribe=True, tz=None, _external=False):
+    def _oneline(self, include_seminar=True, include_content=False, tz=None, _external=False):
+        # The row shown in lists of talks, except for the subscribe column
         rescheduled = self.rescheduled()
         t, now, e = adapt_datetime(self.start_time, newtz=tz), adapt_datetime(datetime.now(), newtz=tz), adapt_datetime(self.end_time, newtz=tz)
         if rescheduled:
@@ -658,12 +706,31 @@ Thank you,
             cols.append(('', self.show_slides_link()))
             cols.append(('', self.show_video_link()))
             cols.append(('', self.show_paper_link()))
+        return datetime_tds + ''.join('<td %s>%s</td>' % c for c in cols)
+
+    def oneline(self, include_seminar=True, include_content=False, include_subscribe=True, tz=None, _external=False):
+        rescheduled = self.rescheduled()
+        if rescheduled or _external or self.deleted:
+            # Rescheduled talks show the title of the new version, which can change without this talk
+            # changing.  External and deleted talks show the whole talk knowl in the title, which
+            # depends on the user (edit and registration links) and on the time (livestream links).
+            row = self._oneline(include_seminar, include_content, tz, _external)
+        else:
+            now = datetime.now(pytz.utc)
+            key = (self.seminar_id, self.seminar_ctr, self.edited_at, self.seminar.edited_at,
+                   str(tz or current_user.tz), domain(), include_seminar, include_content,
+                   self.start_time < now < self.end_time)
+            row = oneline_cache.get(key)
+            if row is None:
+                row = self._oneline(include_seminar, include_content, tz, _external)
+                oneline_cache.set(key, row)
         if include_subscribe:
+            # The subscribe column depends on the user, so is added after caching
             if rescheduled:
-                cols.append(("", ""))
+                row += '<td ></td>'
             else:
-                cols.append(('class="subscribe"', self.show_subscribe()))
-        return datetime_tds + ''.join('<td %s>%s</td>' % c for c in cols)
+                row += '<td class="subscribe">%s</td>' % self.show_subscribe()
+        return row
 
     def show_comments(self, prefix=""):
         if self.comments:
@@ -704,6 +771,7 @@ Email link to speaker
         )
 
     def event(self, user):
+        from icalendar import Event
         event = Event()
         #FIXME: code to remove hrefs from speaker name is a temporary hack to be
         # removed once we support multiple speakers
@@ -752,6 +820,70 @@ Email link to speaker
         event.add("UID", "%s/%s" % (self.seminar_id, self.seminar_ctr))
         return event
 
+
+class TalkRow(ListingRow):
+    """
+    A compact, read-only talk for listings, as returned by ``talks_search(..., rows=True)``.
+
+    Supports the display methods of ``WebTalk`` (``oneline``, ``show_time_and_duration``,
+    ``show_title`` and so on) but not editing or saving; use ``WebTalk`` for those.
+    Unlike ``WebTalk``, constructing a row does not validate it, and start and end times are
+    left as returned by the database rather than converted to the talk's time zone: the display
+    methods convert them as needed (see ``preconvert_times``).
+    """
+    __slots__ = ("_seminar", "_seminars", "_include_deleted", "more")
+    _defaults = dict([(col, str) for col in optional_talk_text_columns] + [("topics", list)])
+
+    def __init__(self, rec, cols, seminar=None, seminars=None):
+        ListingRow.__init__(self, rec, cols)
+        self._seminar = seminar
+        self._seminars = seminars
+        self._include_deleted = bool("deleted" in cols and rec[cols["deleted"]])
+
+    seminar = WebTalk.seminar
+    __repr__ = WebTalk.__repr__
+    visible = WebTalk.visible
+    searchable = WebTalk.searchable
+    user_is_registered = WebTalk.user_is_registered
+    user_can_edit = WebTalk.user_can_edit
+    tz = WebTalk.tz
+    show_audience = WebTalk.show_audience
+    show_start_time = WebTalk.show_start_time
+    show_end_time = WebTalk.show_end_time
+    show_daytimes = WebTalk.show_daytimes
+    show_date = WebTalk.show_date
+    blackout_date = WebTalk.blackout_date
+    show_time_and_duration = WebTalk.show_time_and_duration
+    show_title = WebTalk.show_title
+    show_link_title = WebTalk.show_link_title
+    show_knowl_title = WebTalk.show_knowl_title
+    show_lang_topics = WebTalk.show_lang_topics
+    show_seminar = WebTalk.show_seminar
+    show_speaker = WebTalk.show_speaker
+    show_speaker_and_seminar = WebTalk.show_speaker_and_seminar
+    show_password_hint = WebTalk.show_password_hint
+    show_stream_link = WebTalk.show_stream_link
+    show_live_link = WebTalk.show_live_link
+    show_paper_link = WebTalk.show_paper_link
+    show_slides_link = WebTalk.show_slides_link
+    show_video_link = WebTalk.show_video_link
+    show_chat_link = WebTalk.show_chat_link
+    show_content_links = WebTalk.show_content_links
+    show_comments = WebTalk.show_comments
+    show_abstract = WebTalk.show_abstract
+    ics_link = WebTalk.ics_link
+    ics_gcal_link = WebTalk.ics_gcal_link
+    ics_webcal_link = WebTalk.ics_webcal_link
+    is_past = WebTalk.is_past
+    is_starting_soon = WebTalk.is_starting_soon
+    is_subscribed = WebTalk.is_subscribed
+    show_subscribe = WebTalk.show_subscribe
+    rescheduled = WebTalk.rescheduled
+    _oneline = WebTalk._oneline
+    oneline = WebTalk.oneline
+    event = WebTalk.event
+
+
 def talks_header(include_seminar=True, include_content=False, include_subscribe=True, datetime_header="Your time"):
     cols = []
     cols.append((' colspan="3" class="yourtime"', datetime_header))
@@ -832,8 +964,49 @@ _maxer = SQL(
     "SELECT MAX({0}) FROM (SELECT DISTINCT ON (seminar_id, seminar_ctr) {1} FROM {2} ORDER BY seminar_id, seminar_ctr, id DESC) tmp{3}"
 )
 
+# Restricts to talks whose series is public, judged by the most recent displayable version of the series
+_public_series = "SELECT shortname FROM (SELECT DISTINCT ON (shortname) shortname, visibility, deleted FROM seminars WHERE display OR NOT by_api ORDER BY shortname, id DESC) sems WHERE visibility = 2 AND deleted IS NOT TRUE"
+_public_selecter = SQL(
+    "SELECT {0} FROM (SELECT * FROM (SELECT DISTINCT ON (seminar_id, seminar_ctr) {1} FROM {2} ORDER BY seminar_id, seminar_ctr, id DESC) tmp0 WHERE seminar_id IN (" + _public_series + ")) tmp{3}"
+)
+_public_counter = SQL(
+    "SELECT COUNT(*) FROM (SELECT 1 FROM (SELECT * FROM (SELECT DISTINCT ON (seminar_id, seminar_ctr) {0} FROM {1} ORDER BY seminar_id, seminar_ctr, id DESC) tmp0 WHERE seminar_id IN (" + _public_series + ")) tmp{2}) tmp2"
+)
+
 
-def _construct(seminar_dict, objects=True, more=False):
+class _SeminarBatch(object):
+    """
+    The series of talks returned by a search (other than those in the ``seminar_dict`` passed
+    to the search).  Talks add their ``seminar_id`` as they are constructed, and the series
+    are looked up with a single query the first time one of them is needed.  The searches
+    construct all their talks before returning any (see ``_materialized``), so this happens once.
+    """
+    def __init__(self):
+        self.seminars = {}
+        self.missing = set()
+
+    def add(self, seminar_id):
+        if seminar_id not in self.seminars:
+            self.missing.add(seminar_id)
+
+    def get(self, seminar_id):
+        if self.missing:
+            missing = sorted(self.missing)
+            self.missing = set()
+            # Series without organizers would be skipped by seminars_search if absent from organizer_dict
+            organizers = all_organizers({"seminar_id": {"$in": missing}})
+            for seminar in seminars_search(
+                {"shortname": {"$in": missing}},
+                organizer_dict={shortname: organizers[shortname] for shortname in missing},
+                include_deleted=True,
+            ):
+                self.seminars[seminar.shortname] = seminar
+        if seminar_id not in self.seminars:
+            raise ValueError("Seminar %s does not exist" % seminar_id)
+        return self.seminars[seminar_id]
+
+
+def _construct(seminar_dict, objects=True, more=False, seminars=None):
     def object_construct(rec):
         if not isinstance(rec, dict):
             return rec
@@ -846,6 +1019,9 @@ def _construct(seminar_dict, objects=True, more=False):
                 seminar=seminar_dict.get(rec["seminar_id"]),
                 data=rec,
             )
+            if seminars is not None and talk._seminar is None:
+                seminars.add(talk.seminar_id)
+                talk._seminars = seminars
             if more is not False:
                 talk.more = moreval
             return talk
@@ -855,12 +1031,35 @@ def _construct(seminar_dict, objects=True, more=False):
     return object_construct if objects else default_construct
 
 
+def _materialized(iterator):
+    # Constructs all the talks before returning the first, so that a caller using the series of
+    # each talk as it iterates over an unlimited search still has them looked up in one batch
+    def materialized_iterator(cur, search_cols, extra_cols, projection):
+        return iter(list(iterator(cur, search_cols, extra_cols, projection)))
+
+    return materialized_iterator
+
+
 def _iterator(seminar_dict, objects=True, more=False):
     def object_iterator(cur, search_cols, extra_cols, projection):
+        construct = _construct(seminar_dict, more=more, seminars=_SeminarBatch())
         for rec in db.talks._search_iterator(cur, search_cols, extra_cols, projection):
-            yield _construct(seminar_dict, more=more)(rec)
+            yield construct(rec)
+
+    return _materialized(object_iterator) if objects else db.talks._search_iterator
+
 
-    return object_iterator if objects else db.talks._search_iterator
+def _row_iterator(seminar_dict):
+    seminars = _SeminarBatch()
+
+    def construct(rec, cols):
+        seminar_id = rec[cols["seminar_id"]]
+        seminar = seminar_dict.get(seminar_id)
+        if seminar is None:
+            seminars.add(seminar_id)
+        return TalkRow(rec, cols, seminar, seminars)
+
+    return _materialized(row_iterator(db.talks, construct))
 
 
 def talks_count(query={}, include_deleted=False):
@@ -882,16 +1081,30 @@ def talks_search(*args, **kwds):
     Replacement for db.talks.search to account for versioning, return WebTalk objects.
 
     Doesn't support split_ors or raw.  Always computes count.
+
+    If ``public_series`` is set, only talks in series with visibility 2 are returned;
+    this filter is applied in the database, before limit and offset.
+
+    If ``rows`` is set, returns ``TalkRow`` objects instead of ``WebTalk`` objects: these are
+    cheaper to construct and smaller, and suffice for displaying lists of talks.
     """
     seminar_dict = kwds.pop("seminar_dict", {})
     objects = kwds.pop("objects", True)
+    rows = kwds.pop("rows", False)
     sanitized = kwds.pop("sanitized", False)
+    if kwds.pop("public_series", False):
+        selecter, counter = _public_selecter, _public_counter
+    else:
+        selecter, counter = _selecter, _counter
     if sanitized:
         table = sanitized_table("talks")
     else:
         table = db.talks
-    more = kwds.get("more", False)
-    return search_distinct(table, _selecter, _counter, _iterator(seminar_dict, objects=objects, more=more), *args, **kwds)
+    if rows:
+        iterator = _row_iterator(seminar_dict)
+    else:
+        iterator = _iterator(seminar_dict, objects=objects, more=kwds.get("more", False))
+    return search_distinct(table, selecter, counter, iterator, *args, **kwds)
 
 
 def talks_lucky(*args, **kwds):
@@ -908,6 +1121,23 @@ def talks_lucky(*args, **kwds):
     return lucky_distinct(table, _selecter, _construct(seminar_dict, objects=objects), *args, **kwds)
 
 
+def save_talks(talks, user=None):
+    """
+    Saves new versions of several talks at once, using a single insert.
+    """
+    if talks:
+        with DelayCommit(db):
+            db.talks.insert_many([talk._save_data(user) for talk in talks])
+
+
+def save_talks_admin(talks):
+    """
+    Saves new versions of several talks at once, like ``WebTalk.save_admin``.
+    """
+    if talks:
+        db.talks.insert_many([talk._admin_data() for talk in talks])
+
+
 def talks_lookup(seminar_id, seminar_ctr, projection=3, seminar_dict={}, include_deleted=False, include_pending=False, sanitized=False, objects=True):
     return talks_lucky(
         {"seminar_id": seminar_id, "seminar_ctr": seminar_ctr},
@@ -183,11 +183,11 @@
     self.addCSS("https://cdn.jsdelivr.net/npm/katex@0.10.2/dist/contrib/copy-tex.css");
 
 
-    self.addCSS("{{ url_for('static', filename='fontawesome/css/all.min.css', _external=True, _scheme=scheme) }}");
+    self.addCSS("{{ asset_url('fontawesome/css/all.min.css', _external=True, _scheme=scheme) }}");
 
 
 
-    self.addJS("{{ url_for('static', filename='katex-custom.js', _external=True, _scheme=scheme) }}",
+    self.addJS("{{ asset_url('katex-custom.js', _external=True, _scheme=scheme) }}",
                {"onload":
                 function() {
                   // After loading our customizations --
@@ -233,7 +233,7 @@
       this.knowlAdded = true;
       return;
     };
-    this.addJS("{{ url_for('static', filename='knowl.js', _external=True, _scheme=scheme) }}", {});
+    this.addJS("{{ asset_url('knowl.js', _external=True, _scheme=scheme) }}", {});
   }
 
   SeminarEmbedder.prototype.initialize = function(opts) {
@@ -241,7 +241,7 @@
       return;
 
     if (opts && opts.hasOwnProperty('addCSS') && opts['addCSS']) {
-      this.addCSS("{{ url_for('static', filename='embed_seminar.css', _external=True, _scheme=scheme) }}");
+      this.addCSS("{{ asset_url('embed_seminar.css', _external=True, _scheme=scheme) }}");
     };
 
     // addKatex is idempotent
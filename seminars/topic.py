@@ -36,25 +36,43 @@ class WebTopic(object):
 
 
 class TopicDAG(object):
+    # The topics are loaded from the database on first use, rather than when each worker starts
     def __init__(self):
-        self.by_id = {}
+        self._by_id = None
+        self._subjects = None
+
+    def _load(self):
+        by_id = {}
 
         def sort_key(x):
             return x.name.lower()
 
         for rec in db.new_topics.search():
-            self.by_id[rec["topic_id"]] = topic = WebTopic(rec["topic_id"], rec["name"])
+            by_id[rec["topic_id"]] = topic = WebTopic(rec["topic_id"], rec["name"])
             topic.children = rec["children"]
-        for topic in self.by_id.values():
+        for topic in by_id.values():
             for cid in topic.children:
-                self.by_id[cid].parents.append(topic)
-        for topic in self.by_id.values():
-            topic.children = [self.by_id[cid] for cid in topic.children]
+                by_id[cid].parents.append(topic)
+        for topic in by_id.values():
+            topic.children = [by_id[cid] for cid in topic.children]
             topic.children.sort(key=sort_key)
             topic.parents.sort(key=sort_key)
-        self.subjects = sorted(
-            (topic for topic in self.by_id.values() if not topic.parents), key=sort_key
+        self._subjects = sorted(
+            (topic for topic in by_id.values() if not topic.parents), key=sort_key
         )
+        self._by_id = by_id
+
+    @property
+    def by_id(self):
+        if self._by_id is None:
+            self._load()
+        return self._by_id
+
+    @property
+    def subjects(self):
+        if self._by_id is None:
+            self._load()
+        return self._subjects
 
     def add_topics(self, filename, dryrun=False):
         """
@@ -34,17 +34,18 @@ from seminars.utils import (
     format_input_errmsg,
     show_input_errors,
     timestamp,
-    timezones,
+    timezone_options,
     topdomain,
     flash_infomsg,
 )
 
+from seminars.slowqueries import THRESHOLD as SLOW_QUERY_THRESHOLD, top as top_slow_queries
 from seminars.tokens import generate_timed_token, read_timed_token, read_token
 from datetime import datetime
 
 def user_options():
     author_ids = sorted(list(db.author_ids.search({})),key=lambda r: r["name"].lower())
-    return { 'author_ids' : author_ids, 'timezones' : timezones }
+    return { 'author_ids' : author_ids, 'timezones' : timezone_options() }
 
 login_page = Blueprint("user", __name__, template_folder="templates")
 logger = make_logger(login_page)
@@ -326,6 +327,22 @@ def admin():
     return "success: only admins can read this!"
 
 
+@login_page.route("/slow_queries")
+@admin_required
+def slow_queries():
+    sort = request.args.get("sort", "total")
+    if sort not in ["total", "max", "count", "last_seen"]:
+        sort = "total"
+    return render_template(
+        "slow_queries.html",
+        title="Slow queries",
+        entries=top_slow_queries(100, sort),
+        sort=sort,
+        threshold=SLOW_QUERY_THRESHOLD,
+        now=datetime.now().timestamp(),
+    )
+
+
 @login_page.route("/loginas/<emailorid>")
 @admin_required
 def loginas(emailorid):
@@ -7,17 +7,19 @@ import urllib.parse
 from seminars import db
 from seminars.tokens import generate_token
 from seminars.seminar import WebSeminar, seminars_search, seminars_lucky, next_talk_sorted
-from seminars.talk import WebTalk
-from seminars.utils import pretty_timezone, log_error
+from seminars.talk import talks_search
+from seminars.utils import get_timezone, pretty_timezone, log_error
+from seminars.localstore import LocalStore
 from lmfdb.backend.searchtable import PostgresSearchTable
 from lmfdb.utils import flash_error
 from flask import flash
 from lmfdb.backend.utils import DelayCommit
 from lmfdb.logger import critical
 from datetime import datetime
-from pytz import UTC, all_timezones, timezone, UnknownTimeZoneError
+from pytz import UTC, all_timezones_set, UnknownTimeZoneError
 import bisect
 import secrets
+import time
 from .main import logger
 
 # Read about flask-login if you are unfamiliar with this UserMixin/Login
@@ -89,7 +91,7 @@ class PostgresUserTable(PostgresSearchTable):
         for col in ["name", "affiliation", "homepage", "timezone"]:
             kwargs[col] = kwargs.get(col, "")
         tz = kwargs.get("timezone", "")
-        assert tz == "" or tz in all_timezones
+        assert tz == "" or tz in all_timezones_set
         kwargs["api_access"] = kwargs.get("api_access", 0)
         kwargs["api_token"] = kwargs.get("api_token", secrets.token_urlsafe(32))
         kwargs["created"] = datetime.now(UTC)
@@ -129,6 +131,7 @@ class PostgresUserTable(PostgresSearchTable):
     def make_creator(self, email, endorser):
         with DelayCommit(self):
             db.users.update({"email": ilike_query(email)}, {"creator": True, "endorser": endorser}, restat=False)
+            self.auth_changed(self.lookup(email, projection="id"))
             # Update all of this user's created seminars and talks
             db.seminars.update({"owner": ilike_query(email)}, {"display": True})
             # Could do this with a join...
@@ -137,6 +140,7 @@ class PostgresUserTable(PostgresSearchTable):
 
     def save(self, data):
         data = dict(data)  # copy
+        uid = data.get("id")
         email = data.pop("email", None)
         if not email:
             raise ValueError("data must contain email")
@@ -161,6 +165,7 @@ class PostgresUserTable(PostgresSearchTable):
                 if key != "id":
                     critical("Need to update pwdmanager code to account for schema change key=%s" % key)
                 data.pop(key)
+        self.auth_changed(uid)
         with DelayCommit(db):
             if "email" in data:
                 newemail = data["email"]
@@ -182,12 +187,30 @@ class PostgresUserTable(PostgresSearchTable):
             db.seminar_organizers.delete({"email": ilike_query(email)})
             db.talks.update({"speaker_email": ilike_query(email)}, {"speaker_email": ""})
             self.update({"id": uid}, {key: None for key in self.search_cols}, restat=False)
+        self.auth_changed(uid)
 
     def reset_api_token(self, uid):
         new_token = secrets.token_urlsafe(32)
         self.update({"id": int(uid)}, {"api_token": new_token}, restat=False)
+        self.auth_changed(uid)
         return new_token
 
+    def auth_changed(self, uid):
+        """
+        Records that the user's token, email or rights may have changed, so that the authentication
+        records cached by the API (in every worker on this machine) are dropped.
+        """
+        if uid is not None:
+            auth_changes.set(str(int(uid)), time.time())
+
+    def auth_changed_at(self, uid):
+        """
+        The time (as returned by time.time) of the last call to ``auth_changed`` for the user, or 0.
+        """
+        return auth_changes.get(str(int(uid)), 0)
+
+auth_changes = LocalStore("auth_changes")
+
 userdb = PostgresUserTable()
 
 
@@ -197,8 +220,20 @@ class SeminarsUser(UserMixin):
     """
 
     properties = sorted(userdb.col_type) + ["id"]
+    # The columns needed to act on behalf of an authenticated user, as through the API
+    auth_properties = ["id", "email", "name", "homepage", "timezone", "email_confirmed",
+                       "creator", "admin", "subject_admin", "api_access"]
 
-    def __init__(self, uid=None, email=None):
+    def __init__(self, uid=None, email=None, record=None):
+        if record is not None:
+            # A user authenticated earlier, with the columns in auth_properties: no queries are made
+            self._authenticated = True
+            self._uid = str(record["id"])
+            self._dirty = False
+            self._data = dict(record)
+            self._registered_talks = self._registered_seminars = self._subscribed = None
+            self._organizer = None
+            return
         if email:
             if not isinstance(email, str):
                 raise Exception("Email is not a string, %s" % email)
@@ -211,8 +246,13 @@ class SeminarsUser(UserMixin):
 
         self._authenticated = False
         self._uid = None
+        self._organizer = None
         self._dirty = False  # flag if we have to save
         self._data = dict() # dict([(_, None) for _ in SeminarsUser.properties])
+        # Looked up on first use, and kept for the rest of the request (see is_registered_talk)
+        self._registered_talks = None
+        self._registered_seminars = None
+        self._subscribed = None
 
         user_row = userdb.lucky(query, projection=SeminarsUser.properties)
         if user_row:
@@ -315,9 +355,9 @@ class SeminarsUser(UserMixin):
     @property
     def tz(self):
         try:
-            return timezone(self.timezone)
+            return get_timezone(self.timezone)
         except UnknownTimeZoneError:
-            return timezone("UTC")
+            return UTC
 
     def show_timezone(self, dest="topmenu"):
         # dest can be 'browse', in which case "now" is inserted, or 'selecter', in which case fixed width is used.
@@ -388,6 +428,48 @@ class SeminarsUser(UserMixin):
     def seminar_subscriptions(self):
         return self._data.get("seminar_subscriptions", [])
 
+    def _subscription_sets(self):
+        # The subscriptions as sets, so that listings can check each row cheaply
+        if self._subscribed is None:
+            self._subscribed = (
+                set(self.seminar_subscriptions),
+                set((shortname, ctr) for shortname, ctrs in self.talk_subscriptions.items() for ctr in ctrs),
+            )
+        return self._subscribed
+
+    def is_subscribed_seminar(self, shortname):
+        return shortname in self._subscription_sets()[0]
+
+    def is_subscribed_talk(self, shortname, ctr):
+        seminars, talks = self._subscription_sets()
+        return shortname in seminars or (shortname, ctr) in talks
+
+    def is_registered_talk(self, shortname, ctr):
+        """
+        Whether this user has registered for the given talk.
+
+        The registrations of the user are fetched with one query the first time this is called,
+        since a listing asks about each of its talks and the user object only lasts for one request.
+        """
+        if self._registered_talks is None:
+            self._registered_talks = set(
+                (rec["seminar_id"], rec["seminar_ctr"])
+                for rec in db.talk_registrations.search({"user_id": int(self.id)}, ["seminar_id", "seminar_ctr"])
+            )
+        return (shortname, ctr) in self._registered_talks
+
+    def is_registered_seminar(self, shortname):
+        """
+        Whether this user's email is registered for the given series, fetching all of them on first use.
+        """
+        if self._registered_seminars is None:
+            self._registered_seminars = set(db.seminar_registrations.search({"email": self.email}, "seminar_id"))
+        return shortname in self._registered_seminars
+
+    def registered_talks_add(self, shortname, ctr):
+        if self._registered_talks is not None:
+            self._registered_talks.add((shortname, ctr))
+
     @property
     def seminars(self):
         ans = []
@@ -397,6 +479,7 @@ class SeminarsUser(UserMixin):
             except ValueError:
                 self._data["seminar_subscriptions"].remove(elt)
                 self._dirty = True
+                self._subscribed = None
         ans = next_talk_sorted(ans)
         if self._dirty:
             self.save()
@@ -408,6 +491,7 @@ class SeminarsUser(UserMixin):
             if shortname in self.talk_subscriptions:
                 self._data["talk_subscriptions"].pop(shortname)
             self._dirty = True
+            self._subscribed = None
             return 200, "Added to favorites"
         else:
             return 200, "Already added to favorites"
@@ -416,6 +500,7 @@ class SeminarsUser(UserMixin):
         if shortname in self._data["seminar_subscriptions"]:
             self._data["seminar_subscriptions"].remove(shortname)
             self._dirty = True
+            self._subscribed = None
             return 200, "Removed from favorites"
         else:
             return 200, "Already removed from favorites"
@@ -426,14 +511,17 @@ class SeminarsUser(UserMixin):
 
     @property
     def talks(self):
-        res = []
+        # All subscribed talks in one query; those that no longer exist are unsubscribed
+        query = [{"seminar_id": shortname, "seminar_ctr": {"$in": ctrs}}
+                 for shortname, ctrs in self.talk_subscriptions.items() if ctrs]
+        res = list(talks_search({"$or": query})) if query else []
+        found = set((talk.seminar_id, talk.seminar_ctr) for talk in res)
         for shortname, ctrs in self.talk_subscriptions.items():
-            for ctr in ctrs:
-                try:
-                    res.append(WebTalk(shortname, ctr))
-                except ValueError:
+            for ctr in list(ctrs):
+                if (shortname, ctr) not in found:
                     self._data["talk_subscriptions"][shortname].remove(ctr)
                     self._dirty = True
+                    self._subscribed = None
 
         if self._dirty:
             for shortname in self._data["talk_subscriptions"]:
@@ -455,6 +543,7 @@ class SeminarsUser(UserMixin):
             else:
                 self._data["talk_subscriptions"][shortname] = [ctr]
             self._dirty = True
+            self._subscribed = None
             return 200, "Added to favorites"
 
     def talk_subscriptions_remove(self, shortname, ctr):
@@ -463,6 +552,7 @@ class SeminarsUser(UserMixin):
         if ctr in self._data["talk_subscriptions"].get(shortname, []):
             self._data["talk_subscriptions"][shortname].remove(ctr)
             self._dirty = True
+            self._subscribed = None
             return 200, "Removed from favorites"
         else:
             return 200, "Already removed from favorites"
@@ -530,8 +620,16 @@ class SeminarsUser(UserMixin):
 
     @property
     def is_organizer(self):
+        if self.id and self._organizer is None:
+            self._organizer = db.seminar_organizers.count({"email": ilike_query(self.email)}, record=False) > 0
         return self.id and (self.is_admin or self.is_creator or self._organizer)
 
+    def auth_record(self):
+        """
+        The columns needed to rebuild this user with ``SeminarsUser(record=...)``.
+        """
+        return {col: self._data.get(col) for col in SeminarsUser.auth_properties}
+
     def check_password(self, pwd):
         """
         checks if the given password for the user is valid.
@@ -622,9 +720,9 @@ class SeminarsAnonymousUser(AnonymousUserMixin):
     @property
     def tz(self):
         try:
-            return timezone(self.timezone)
+            return get_timezone(self.timezone)
         except UnknownTimeZoneError:
-            return timezone("UTC")
+            return UTC
 
     @property
     def email_confirmed(self):
@@ -1,18 +1,19 @@
+from bisect import bisect_right
 from collections.abc import Iterable
 from datetime import datetime, timedelta
 from datetime import time as maketime
 from dateutil.parser import parse as parse_time
 from email_validator import validate_email
-from flask import url_for, flash, render_template, request, send_file
+from flask import g, has_request_context, url_for, flash, render_template, request, send_file
 from flask_login import current_user
 from functools import lru_cache
-from icalendar import Calendar
 from io import BytesIO
 from lmfdb.backend.utils import IdentifierWrapper
 from lmfdb.utils.search_boxes import SearchBox
 from markupsafe import Markup, escape
 from psycopg2.sql import SQL
 from seminars import db
+from seminars.dbpool import replica_reads
 from six import string_types
 from urllib.parse import urlparse, urlencode
 from psycopg2.sql import Placeholder
@@ -222,17 +223,95 @@ def make_links(x):
             tokens[i] = '<a href="%s">%s</a>'%(tokens[i], tokens[i][tokens[i].index("//")+2:])
     return ''.join(tokens)
 
+@lru_cache(maxsize=1024)
+def get_timezone(name):
+    """
+    Returns ``pytz.timezone(name)``, remembering the result for later calls.
+
+    Raises ``pytz.UnknownTimeZoneError`` for unknown names, as ``pytz.timezone`` does.
+    """
+    return pytz.timezone(name)
+
+
+class TimezoneCatalog(object):
+    """
+    The current UTC offsets of time zones, their display names and the options for time zone selecters.
+
+    Offsets only change at daylight saving transitions, so everything is computed once and
+    recomputed after the next transition in any of the zones involved, rather than on each request.
+    """
+    def __init__(self, names):
+        self.names = names
+        self._state = None
+
+    def _current(self):
+        now = datetime.utcnow()
+        state = self._state
+        if state is None or (state["expires"] is not None and now >= state["expires"]):
+            state = {"offsets": {}, "pretty": {}, "options": None, "expires": None}
+            for name in self.names:
+                self._add(state, name, now)
+            state["options"] = [
+                (name, self.pretty(name, state=state))
+                for name in sorted(self.names, key=state["offsets"].__getitem__)
+            ]
+            self._state = state
+        return state
+
+    @staticmethod
+    def _add(state, name, now):
+        tz = get_timezone(name)
+        state["offsets"][name] = pytz.UTC.localize(now).astimezone(tz).utcoffset()
+        transitions = getattr(tz, "_utc_transition_times", None)
+        if transitions:
+            i = bisect_right(transitions, now)
+            if i < len(transitions) and (state["expires"] is None or transitions[i] < state["expires"]):
+                state["expires"] = transitions[i]
+
+    def offset(self, name, state=None):
+        """
+        The current UTC offset of the time zone with the given name, as a timedelta.
+        """
+        if state is None:
+            state = self._current()
+        if name not in state["offsets"]:
+            # Not one of the common time zones; remember it until the next refresh
+            self._add(state, name, datetime.utcnow())
+        return state["offsets"][name]
+
+    def pretty(self, name, dest="selecter", state=None):
+        """
+        The display name of a time zone, as described in ``pretty_timezone``.
+        """
+        if state is None:
+            state = self._current()
+        key = (name, dest)
+        if key not in state["pretty"]:
+            state["pretty"][key] = _pretty_timezone(name, self.offset(name, state=state), dest)
+        return state["pretty"][key]
+
+    def options(self):
+        """
+        A list of pairs (name, display name) for the common time zones, sorted by UTC offset.
+        """
+        return self._current()["options"]
+
+
+timezone_catalog = TimezoneCatalog(pytz.common_timezones)
+
+
 def naive_utcoffset(tz):
-    if isinstance(tz, str):
-        tz = pytz.timezone(tz)
-    for h in range(10):
-        try:
-            return tz.utcoffset(datetime.now() + timedelta(hours=h))
-        except (
-            pytz.exceptions.NonExistentTimeError,
-            pytz.exceptions.AmbiguousTimeError,
-        ):
-            pass
+    """
+    The current UTC offset of a time zone (given as a string or a pytz time zone).
+    """
+    return timezone_catalog.offset(str(tz))
+
+
+def timezone_options():
+    """
+    The options for time zone selecters: pairs (name, display name) sorted by UTC offset.
+    """
+    return timezone_catalog.options()
 
 
 def timestamp():
@@ -249,7 +328,17 @@ def log_error(msg):
         app.logger.error(timestamp() + " ERROR message is:  " + msg)
 
 def pretty_timezone(tz, dest="selecter"):
-    foo = int(naive_utcoffset(tz).total_seconds())
+    """
+    Displays a time zone (a string or a pytz time zone) with its current UTC offset.
+
+    ``dest`` is ``"selecter"`` for time zone selecters (fixed width), ``"browse"`` for the browse
+    pages (where "now" is inserted) or anything else for the top menu.
+    """
+    return timezone_catalog.pretty(str(tz), dest)
+
+
+def _pretty_timezone(tz, offset, dest):
+    foo = int(offset.total_seconds())
     hours, remainder = divmod(abs(foo), 3600)
     minutes, seconds = divmod(remainder, 60)
     if dest == "selecter":  # used in time zone selecters
@@ -274,11 +363,6 @@ def pretty_timezone(tz, dest="selecter"):
             return "{} (UTC {})".format(tz, diff)
 
 
-timezones = [
-    (v, pretty_timezone(v)) for v in sorted(pytz.common_timezones, key=naive_utcoffset)
-]
-
-
 def is_nighttime(t):
     if t is None:
         return False
@@ -355,7 +439,8 @@ def count_distinct(table, counter, query={}, include_deleted=False):
     tbl = IdentifierWrapper(table.search_table)
     qstr, values = table._build_query(query, sort=[])
     counter = counter.format(cols, tbl, qstr)
-    cur = table._execute(counter, values)
+    with replica_reads(table):
+        cur = table._execute(counter, values)
     return int(cur.fetchone()[0])
 
 
@@ -372,6 +457,46 @@ def max_distinct(table, maxer, col, constraint={}, include_deleted=False):
     return cur.fetchone()[0]
 
 
+def changes_distinct(table, keys, since=0, limit=None, extra_cols=[]):
+    """
+    Returns the current version of each entry that has been saved since a given row id, ordered by id.
+
+    Versions pending approval after an API save are ignored.
+
+    INPUT:
+
+    - ``table`` -- a search table, such as db.talks or sanitized_table("talks")
+    - ``keys`` -- the columns identifying an entry across versions, e.g. ["shortname"]
+    - ``since`` -- only entries with a version whose id is larger than this are returned
+    - ``limit`` -- the maximum number of entries to return
+    - ``extra_cols`` -- columns to include that may not be among the search columns of ``table``
+
+    OUTPUT:
+
+    A list of dictionaries with keys ``id``, the search columns of ``table`` and ``extra_cols``,
+    together with ``created``, which records whether the entry had no version with id at most ``since``.
+    """
+    cols = ["id"] + table.search_cols + [col for col in extra_cols if col not in table.search_cols]
+    keycols = SQL(", ").join(map(IdentifierWrapper, keys))
+    match = SQL(" AND ").join(SQL("old.{0} = tmp.{0}").format(IdentifierWrapper(col)) for col in keys)
+    selecter = SQL(
+        "SELECT {0}, NOT EXISTS (SELECT 1 FROM {1} old WHERE {2} AND old.id <= %s) "
+        "FROM (SELECT DISTINCT ON ({3}) * FROM {1} WHERE id > %s AND (display OR NOT by_api) ORDER BY {3}, id DESC) tmp "
+        "ORDER BY id"
+    ).format(
+        SQL(", ").join(SQL("tmp.{0}").format(IdentifierWrapper(col)) for col in cols),
+        IdentifierWrapper(table.search_table),
+        match,
+        keycols,
+    )
+    values = [since, since]
+    if limit is not None:
+        selecter = selecter + SQL(" LIMIT %s")
+        values.append(limit)
+    cur = table._execute(selecter, values)
+    return [dict(zip(cols + ["created"], rec)) for rec in cur]
+
+
 def search_distinct(
     table,
     selecter,
@@ -433,19 +558,20 @@ def search_distinct(
     else:
         cols = SQL(", ").join(map(IdentifierWrapper, search_cols + extra_cols))
     fselecter = selecter.format(cols, all_cols, tbl, qstr)
-    cur = table._execute(
-        fselecter,
-        values,
-        buffered=(limit is None),
-        slow_note=(
-            table.search_table,
-            "analyze",
-            query,
-            repr(projection),
-            limit,
-            offset,
-        ),
-    )
+    with replica_reads(table):
+        cur = table._execute(
+            fselecter,
+            values,
+            buffered=(limit is None),
+            slow_note=(
+                table.search_table,
+                "analyze",
+                query,
+                repr(projection),
+                limit,
+                offset,
+            ),
+        )
     results = iterator(cur, search_cols, extra_cols, projection)
     if limit is None:
         if info is not None:
@@ -509,7 +635,8 @@ def lucky_distinct(
             tbl = tbl + SQL(" WHERE {0}").format(pqstr)
             values = pqvalues + values
     fselecter = selecter.format(cols, all_cols, tbl, qstr)
-    cur = table._execute(fselecter, values)
+    with replica_reads(table):
+        cur = table._execute(fselecter, values)
     if cur.rowcount > 0:
         rec = cur.fetchone()
         if projection == 0 or isinstance(projection, string_types):
@@ -519,6 +646,59 @@ def lucky_distinct(
         return construct(rec)
 
 
+class ListingRow(object):
+    """
+    Base class for the compact, read-only rows returned by ``talks_search`` and ``seminars_search``
+    when called with ``rows=True``.
+
+    A row keeps the tuple returned by the database and a dictionary (shared by all rows from
+    the same query) giving the position of each column, rather than copying every column into
+    an instance dictionary.  Columns are looked up when accessed, with ``None`` replaced as in
+    the ``cleanse`` methods of ``WebTalk`` and ``WebSeminar``.  Subclasses borrow the rendering
+    methods they need from those classes.
+    """
+    __slots__ = ("_rec", "_cols")
+    # Columns whose None values are replaced by the result of calling the given function
+    _defaults = {}
+
+    def __init__(self, rec, cols):
+        self._rec = rec
+        self._cols = cols
+
+    def __getattr__(self, name):
+        # Only called when normal lookup fails: for columns, and for slots that are not yet set
+        try:
+            val = self._rec[self._cols[name]]
+        except KeyError:
+            raise AttributeError(name)
+        if val is None and name in self._defaults:
+            return self._defaults[name]()
+        return val
+
+
+def row_iterator(table, construct):
+    """
+    An iterator suitable for ``search_distinct``, turning each record into a row via ``construct``.
+
+    INPUT:
+
+    - ``table`` -- a search table, used for projections onto a single column
+    - ``construct`` -- a function taking a tuple and a dictionary giving the position of each
+      column in that tuple, and returning a row or None (to skip the record)
+    """
+    def iterator(cur, search_cols, extra_cols, projection):
+        if projection == 0 or isinstance(projection, string_types):
+            for rec in table._search_iterator(cur, search_cols, extra_cols, projection):
+                yield rec
+            return
+        cols = {col: i for i, col in enumerate(search_cols + extra_cols)}
+        for rec in cur:
+            row = construct(rec, cols)
+            if row is not None:
+                yield row
+    return iterator
+
+
 def localize_time(t, newtz=None):
     """
     Takes a time or datetime object and adds in a timezone if not already present.
@@ -535,23 +715,70 @@ def adapt_datetime(t, newtz=None):
     """
     Converts a time-zone-aware datetime object into a specified time zone
     (current user's time zone by default).
+
+    Uses the conversions made by ``preconvert_times`` earlier in the request, if any.
     """
     if t is None:
         return None
     if newtz is None:
         newtz = current_user.tz
+    if has_request_context():
+        local = g.get("local_times", {}).get(newtz)
+        if local is not None:
+            ans = local.get(t)
+            if ans is not None:
+                return ans
     return t.astimezone(newtz)
 
 
+def localize_times(times, tz):
+    """
+    Converts many time-zone-aware datetimes into ``tz`` at once.
+
+    OUTPUT:
+
+    A dictionary with keys the distinct datetimes in ``times`` (Nones are ignored) and values
+    the same times in ``tz``, as given by ``astimezone``.  Times shared by several talks are only
+    converted once, and for pytz time zones with daylight saving time the UTC offset of each
+    time is found by bisecting the zone's table of transitions, as ``tz.fromutc`` does.
+    """
+    ans = {}
+    transitions = getattr(tz, "_utc_transition_times", None)
+    for t in times:
+        if t is None or t in ans:
+            continue
+        if transitions is None:
+            ans[t] = t.astimezone(tz)
+        else:
+            utc = t.replace(tzinfo=None) - t.utcoffset()
+            info = tz._transition_info[max(0, bisect_right(transitions, utc) - 1)]
+            ans[t] = (utc + info[0]).replace(tzinfo=tz._tzinfos[info])
+    return ans
+
+
+def preconvert_times(objects, tz=None, cols=("start_time", "end_time")):
+    """
+    Converts the given columns of a list of talks (or series) into ``tz`` (the current user's time
+    zone by default) in one pass, so that ``adapt_datetime`` finds them for the rest of the request
+    rather than converting them again for each display method.
+    """
+    if tz is None:
+        tz = current_user.tz
+    local = localize_times((getattr(obj, col) for obj in objects for col in cols), tz)
+    if "local_times" not in g:
+        g.local_times = {}
+    g.local_times.setdefault(tz, {}).update(local)
+
+
 def adapt_weektimes(weekday, daytimes, oldtz, newtz):
     """
     Converts a weekday in [0,7] and daytimes HH:MM-HH:MM from oldtz to newtz (returns integer in [0,7] and string HH:MM-HH:MM).
     Note that weekday is for the start time, the end time could be the following day (this is implied by end time <= start time)
     """
     if isinstance(oldtz, str):
-        oldtz = pytz.timezone(oldtz)
+        oldtz = get_timezone(oldtz)
     if isinstance(newtz, str):
-        newtz = pytz.timezone(newtz)
+        newtz = get_timezone(newtz)
     if newtz == oldtz:
         return weekday, daytimes
     oneday = timedelta(days=1)
@@ -632,7 +859,7 @@ def process_user_input(inp, col, typ, tz=None):
         raise ValueError("Invalid boolean")
     elif typ == "text":
         if col.endswith("timezone"):
-            return inp if pytz.timezone(inp) else ""
+            return inp if get_timezone(inp) else ""
         # should sanitize somehow?
         return "\n".join(inp.splitlines())
     elif typ in ["int", "smallint", "bigint", "integer"]:
@@ -730,6 +957,7 @@ class Toggle(SearchBox):
 
 
 def ics_file(talks, filename, user=None):
+    from icalendar import Calendar
     if user is None: user = current_user
     cal = Calendar()
     cal.add("VERSION", "2.0")
@@ -836,10 +1064,12 @@ def sanitized_table(name):
     # We remove the raw argument from search and lucky keywords since these allow the execution of arbitrary SQL
     def search(self, *args, **kwds):
         kwds.pop("raw", None)
-        return PostgresSearchTable.search(self, *args, **kwds)
+        with replica_reads(self):
+            return PostgresSearchTable.search(self, *args, **kwds)
     def lucky(self, *args, **kwds):
         kwds.pop("raw", None)
-        return PostgresSearchTable.lucky(self, *args, **kwds)
+        with replica_reads(self):
+            return PostgresSearchTable.lucky(self, *args, **kwds)
     from seminars import count
     table = PostgresSearchTable(db, *cur.fetchone())
     table.update = update.__get__(table)
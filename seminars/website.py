@@ -29,6 +29,9 @@ assert create
 from . import api
 assert api
 
+from . import metrics
+assert metrics
+
 
 from lmfdb.backend import db
 
@@ -36,6 +39,37 @@ if db.is_verifying:
     raise RuntimeError("Cannot start website while verifying (SQL injection vulnerabilities)")
 
 
+def warm():
+    """
+    Loads what pages need but is otherwise only loaded on first use: the topics, languages,
+    knowls and time zone offsets, the compiled templates, the asset manifest and style.css,
+    and the modules imported when needed.
+
+    gunicorn calls this in each worker before it accepts requests, or once in the master
+    when the app is preloaded (see configfiles/gunicorn-config-*), so that the first visitors
+    of a new worker don't wait for it.
+    """
+    from seminars.topic import topic_dag
+    from seminars.language import languages
+    from seminars.knowls import compile_knowls
+    from seminars.assets import manifest
+    from seminars.utils import timezone_options
+    from seminars.api.main import _highlight_css
+    import icalendar
+    assert icalendar
+
+    topic_dag.by_id
+    languages._data
+    timezone_options()
+    _highlight_css()
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+    # style.css refers to other assets, whose urls need a request context
+    with app.test_request_context():
+        compile_knowls()
+        manifest()
+
+
 def main():
     info("main: ...done.")
     from lmfdb.utils.config import Configuration
@@ -44,7 +78,7 @@ def main():
 
     if "profiler" in flask_options and flask_options["profiler"]:
         info("Profiling!")
-        from werkzeug.contrib.profiler import ProfilerMiddleware
+        from werkzeug.middleware.profiler import ProfilerMiddleware
 
         app.wsgi_app = ProfilerMiddleware(
             app.wsgi_app, restrictions=[30], sort_by=("cumulative", "time", "calls")